@@ -0,0 +1,102 @@
+# benchmarks/bench_autocomplete.py
+"""
+วัดเวลาตอบ autocomplete ของ /play ด้วย AutocompleteIndex เทียบกับการไล่หาในชื่อเพลงทุกเพลง
+และหน่วยความจำของ index ที่จำนวนเพลงต่าง ๆ (Discord ให้เวลาตอบ autocomplete ไม่เกิน 3 วินาที)
+
+คำที่ใช้ค้นหาเป็นต้นคำของชื่อเพลงสุ่มยาว 1-12 ตัวอักษร เหมือนตอนผู้ใช้กำลังพิมพ์
+
+    python benchmarks/bench_autocomplete.py
+    python benchmarks/bench_autocomplete.py --sizes 1000 5000 20000 -n 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark") # main.py ต้องมี token ตอน import
+
+from main import AUTOCOMPLETE_CHOICES, AutocompleteIndex
+
+WORDS = ("love", "night", "รัก", "ฝน", "คิดถึง", "dream", "fire", "heart", "เธอ", "summer", "blue", "ไม่", "หัวใจ", "light")
+
+
+def make_titles(size: int, rng: random.Random) -> list[tuple[str, str]]:
+    titles = []
+    for i in range(size):
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+        titles.append((f"https://www.youtube.com/watch?v={i:011d}", f"Artist {i % 500} - {words} (Official Video)"))
+    return titles
+
+
+def make_queries(titles: list[tuple[str, str]], count: int, rng: random.Random) -> list[str]:
+    queries = []
+    for _ in range(count):
+        words = rng.choice(titles)[1].split()
+        text = " ".join(words[rng.randrange(len(words)):])
+        queries.append(text[:rng.randint(1, 12)])
+    return queries
+
+
+def linear_search(titles: list[tuple[str, str]], plays: dict, text: str) -> list[tuple[str, str]]:
+    """แบบไม่มี index: หาในชื่อเพลงทุกเพลงแล้วเรียงตามจำนวนครั้งที่ขอ"""
+    text = text.casefold()
+    matches = [(title, url) for url, title in titles if text in title.casefold()]
+    matches.sort(key=lambda match: plays[match[1]], reverse=True)
+    return matches[:AUTOCOMPLETE_CHOICES]
+
+
+def measure(fn, queries: list[str]) -> list[float]:
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query)
+        timings.append((time.perf_counter() - start) * 1_000_000)
+    return timings
+
+
+def summary(timings: list[float]) -> str:
+    timings = sorted(timings)
+    return (f"p50={statistics.median(timings):9.1f} µs  p99={timings[int(len(timings) * 0.99)]:9.1f} µs  "
+            f"max={timings[-1]:9.1f} µs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--queries', type=int, default=1000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        titles = make_titles(size, rng)
+        plays = {url: rng.randint(1, 50) for url, _ in titles}
+        now = time.time()
+
+        tracemalloc.start()
+        index = AutocompleteIndex(size)
+        index.load([(url, title, now - rng.uniform(0, 30 * 86400)) for url, title in titles])
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for url, title in rng.sample(titles, min(size, 1000)):
+            index.add(title, url)
+        add_us = (time.perf_counter() - start) / min(size, 1000) * 1_000_000
+
+        queries = make_queries(titles, args.queries, rng)
+        indexed = measure(lambda query: index.search(query, AUTOCOMPLETE_CHOICES), queries)
+        linear = measure(lambda query: linear_search(titles, plays, query), queries)
+
+        print(f"titles={size} queries={len(queries)}")
+        print(f"  AutocompleteIndex  {summary(indexed)}")
+        print(f"  linear scan        {summary(linear)}")
+        print(f"  index memory={memory / 1024 ** 2:6.1f} MB ({memory / size:5.0f} B/title)  add={add_us:7.1f} µs/title")
+
+
+if __name__ == "__main__":
+    main()
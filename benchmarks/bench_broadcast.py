@@ -0,0 +1,127 @@
+# benchmarks/bench_broadcast.py
+"""
+วัด CPU ของการเล่นเพลงเดียวกันใน N guild: FFMPEG แยกต่อ guild (แบบ /play ปกติ) เทียบกับ BroadcastStation
+ที่เข้ารหัส Opus ครั้งเดียวแล้วให้ N guild อ่านแพ็กเก็ตจาก OpusRingBuffer เดียวกัน
+
+ผู้ฟังแต่ละ guild อ่านแพ็กเก็ตทุก 20 ms ใน thread ของตัวเองเหมือน AudioPlayer ของ discord.py (ไม่ส่งออก network)
+ไฟล์เสียงเป็น WAV ที่สร้างด้วย ffmpeg จึงต้องเข้ารหัส Opus จริงทุกแพ็กเก็ต ต้องมี ffmpeg ใน PATH
+
+    python benchmarks/bench_broadcast.py
+    python benchmarks/bench_broadcast.py --guilds 1 10 50 --seconds 20
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark") # main.py ต้องมี token ตอน import
+
+import discord
+
+from main import BROADCAST_BITRATE, BroadcastStation
+
+FRAME_SECONDS = 0.02
+
+
+def make_audio_file(directory: str, seconds: float) -> str:
+    path = os.path.join(directory, "track.wav")
+    subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+                    '-i', f'sine=frequency=440:duration={seconds}', '-ac', '2', '-ar', '48000', '-y', path], check=True)
+    return path
+
+
+def open_source(path: str) -> discord.FFmpegOpusAudio:
+    return discord.FFmpegOpusAudio(path, bitrate=BROADCAST_BITRATE // 1000, options='-vn', stderr=subprocess.DEVNULL)
+
+
+def listen(source: discord.AudioSource, seconds: float, counts: list, index: int):
+    """อ่านแพ็กเก็ตทุก 20 ms เหมือน AudioPlayer จนครบเวลาหรือ source หมด"""
+    next_at = time.perf_counter()
+    deadline = next_at + seconds
+    packets = 0
+    while time.perf_counter() < deadline:
+        if not source.read():
+            break
+        packets += 1
+        next_at += FRAME_SECONDS
+        time.sleep(max(0.0, next_at - time.perf_counter()))
+    counts[index] = packets
+
+
+def run_threads(sources: list, seconds: float) -> int:
+    counts = [0] * len(sources)
+    threads = [threading.Thread(target=listen, args=(source, seconds, counts, i), daemon=True) for i, source in enumerate(sources)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
+
+
+async def independent(path: str, guilds: int, seconds: float) -> tuple[int, str]:
+    sources = [open_source(path) for _ in range(guilds)]
+    try:
+        return await asyncio.to_thread(run_threads, sources, seconds), f"ffmpeg processes={guilds}"
+    finally:
+        for source in sources:
+            source.cleanup()
+
+
+async def broadcast(path: str, guilds: int, seconds: float) -> tuple[int, str]:
+    station = BroadcastStation("bench", 0, asyncio.get_running_loop())
+    station.add_tracks([object()])
+
+    async def open_station_source(track):
+        return open_source(path)
+
+    closed = asyncio.Event()
+    station.start(open_station_source, lambda _: closed.set())
+    listeners = [station.subscribe(guild_id) for guild_id in range(guilds)]
+    try:
+        packets = await asyncio.to_thread(run_threads, listeners, seconds)
+    finally:
+        station.close()
+        await closed.wait()
+    return packets, f"ffmpeg processes=1  skipped frames={station.buffer.skipped}"
+
+
+def cpu_seconds() -> tuple[float, float]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+async def measure(mode, path: str, guilds: int, seconds: float) -> str:
+    own_before, children_before = cpu_seconds()
+    started = time.perf_counter()
+    packets, detail = await mode(path, guilds, seconds)
+    await asyncio.sleep(0.3) # ให้ FFMPEG ที่ถูก cleanup ออกก่อนอ่าน rusage ของ child process
+    elapsed = time.perf_counter() - started
+    own_after, children_after = cpu_seconds()
+    own, ffmpeg = own_after - own_before, children_after - children_before
+    return (f"packets={packets:7d}  ffmpeg cpu={ffmpeg:6.2f}s  python cpu={own:6.2f}s  "
+            f"total={(own + ffmpeg) / elapsed * 100:6.1f}% of one core  {detail}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="musicbot-bench-") as directory:
+        path = make_audio_file(directory, args.seconds + 5)
+        for guilds in args.guilds:
+            print(f"guilds={guilds} seconds={args.seconds:g}")
+            print(f"  FFMPEG per guild    {await measure(independent, path, guilds, args.seconds)}")
+            print(f"  BroadcastStation    {await measure(broadcast, path, guilds, args.seconds)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+# benchmarks/bench_library.py
+"""
+วัดเวลาค้นหาเพลงใน MusicLibrary (SQLite FTS5) และเวลาสแกนซ้ำเมื่อไม่มีไฟล์เปลี่ยน ที่จำนวนไฟล์ต่าง ๆ
+
+สร้างไฟล์เปล่าตามจำนวนที่กำหนดในโฟลเดอร์ชั่วคราว แล้วใส่ข้อมูลเพลงสุ่มลง index ตรง ๆ
+(แทนการอ่าน tag ครั้งแรกซึ่งขึ้นกับ mutagen/FFMPEG) คำที่ใช้ค้นหาเป็นต้นคำของชื่อเพลงสุ่ม เหมือนตอนผู้ใช้พิมพ์ /play
+
+    python benchmarks/bench_library.py
+    python benchmarks/bench_library.py --sizes 1000 10000 50000 -n 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark") # main.py ต้องมี token ตอน import
+
+from main import AUTOCOMPLETE_CHOICES, MusicLibrary
+
+WORDS = ("love", "night", "รัก", "ฝน", "คิดถึง", "dream", "fire", "heart", "เธอ", "summer", "blue", "ไม่", "หัวใจ", "light")
+
+
+def make_library(directory: str, size: int, rng: random.Random) -> tuple[MusicLibrary, list[str]]:
+    """สร้างไฟล์เปล่า size ไฟล์ (100 ไฟล์ต่อโฟลเดอร์) แล้วเขียนข้อมูลเพลงของทุกไฟล์ลง index"""
+    music_dir = os.path.join(directory, "music")
+    rows, titles = [], []
+    for i in range(size):
+        folder = os.path.join(music_dir, f"Artist {i // 100}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{i:06d}.mp3")
+        open(path, 'wb').close()
+        stat = os.stat(path)
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+        titles.append(title)
+        rows.append((os.path.relpath(path, music_dir), stat.st_size, stat.st_mtime, title, f"Artist {i // 100}", "Album", 200.0))
+    library = MusicLibrary(music_dir, os.path.join(directory, "library.db"))
+    library._write(rows, [])
+    return library, titles
+
+
+def make_queries(titles: list[str], count: int, rng: random.Random) -> list[str]:
+    queries = []
+    for _ in range(count):
+        words = rng.choice(titles).split()
+        start = rng.randrange(len(words))
+        text = " ".join(words[start:start + rng.randint(1, 2)])
+        queries.append(text[:rng.randint(1, len(text))])
+    return queries
+
+
+def summary(timings: list[float]) -> str:
+    timings = sorted(timings)
+    return (f"p50={statistics.median(timings):8.3f} ms  p99={timings[int(len(timings) * 0.99)]:8.3f} ms  "
+            f"max={timings[-1]:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--queries', type=int, default=1000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory(prefix="musicbot-bench-") as directory:
+            library, titles = make_library(directory, size, rng)
+            queries = make_queries(titles, args.queries, rng)
+            for limit, label in ((1, "/play (1 result)"), (AUTOCOMPLETE_CHOICES, "autocomplete")):
+                timings = []
+                for query in queries:
+                    start = time.perf_counter()
+                    library.search(query, limit)
+                    timings.append((time.perf_counter() - start) * 1000)
+                print(f"files={size} {label:18s} {summary(timings)}")
+            library.scan()
+            library.close()
+            index_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.startswith("library.db"))
+            print(f"files={size} rescan (no changes) {library.scan_seconds * 1000:8.1f} ms  changed={library.scan_changes}  "
+                  f"index={index_bytes / 1024 ** 2:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# benchmarks/bench_queue.py
+"""
+เปรียบเทียบคิวเพลงแบบเดิม (collections.deque + dict ต่อเพลง) กับ TrackQueue + Track
+
+วัดการทำงานที่คำสั่งของบอทใช้บ่อยที่ขนาดคิวต่าง ๆ:
+  remove  - ลบเพลงกลางคิว (/remove แบบเดิม: คัดลอกเป็น list, pop, clear แล้ว extend กลับ)
+  move    - ย้ายเพลงจากท้ายคิวไปไว้หัวคิว
+  insert  - แทรกเพลงกลางคิว
+  page    - อ่านเพลง 10 เพลงจากกลางคิว (หนึ่งหน้าของ /queue)
+  popleft - เอาเพลงถัดไปออกจากหัวคิว
+และหน่วยความจำต่อเพลงของ record แต่ละแบบ
+
+TrackQueue เก็บเพลงใน list ธรรมดา (คิวยาวได้ไม่เกิน QUEUE_HARD_LIMIT = 10000 เพลง ขนาดค่าเริ่มต้นจึงหยุดที่ 10000)
+remove/move/page เร็วกว่าแบบเดิมตั้งแต่ราว 1k เพลงเพราะแบบเดิมคัดลอกทั้งคิว ส่วน popleft และ insert
+ช้ากว่า deque ไม่กี่ไมโครวินาทีในทุกขนาด (ค่าใช้จ่ายของ version/journal listener และการสร้าง Track)
+
+    python benchmarks/bench_queue.py
+    python benchmarks/bench_queue.py --sizes 50 1000 10000 -n 500
+"""
+import argparse
+import collections
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark") # main.py ต้องมี token ตอน import
+
+from main import Track, TrackQueue
+
+
+def make_song(i: int) -> dict:
+    return {'title': f'เพลงที่ {i}', 'webpage_url': f'https://www.youtube.com/watch?v={i:011d}', 'duration': 200,
+            'thumbnail': None, 'requester': '<@1>', 'stream_url': None, 'stream_expires': 0,
+            'stream_acodec': None, 'stream_abr': None, 'is_partial': True}
+
+
+def make_deque(size: int) -> collections.deque:
+    return collections.deque((make_song(i) for i in range(size)), maxlen=size + 1)
+
+
+def make_track_queue(size: int) -> TrackQueue:
+    queue = TrackQueue(size + 1)
+    queue.extend(Track(**make_song(i)) for i in range(size))
+    return queue
+
+
+# --- การทำงานแบบเดิม (ตามโค้ดของ /remove และ /queue ก่อนเปลี่ยน) ---
+def deque_remove(queue, index):
+    temp_list = list(queue)
+    song = temp_list.pop(index)
+    queue.clear()
+    queue.extend(temp_list)
+    return song
+
+def deque_move(queue, source, destination):
+    temp_list = list(queue)
+    temp_list.insert(destination, temp_list.pop(source))
+    queue.clear()
+    queue.extend(temp_list)
+
+def deque_insert(queue, index, song):
+    queue.insert(index, song)
+
+def deque_page(queue, start):
+    return list(queue)[start:start + 10]
+
+
+OPERATIONS = {
+    # เติมเพลงกลับหลังลบ/แทรก เพื่อให้ขนาดคิวคงที่ตลอดการวัด
+    'remove': (lambda q, n: (deque_remove(q, n // 2), q.append(make_song(0))),
+               lambda q, n: (q.pop(n // 2), q.append(Track(**make_song(0))))),
+    'move': (lambda q, n: deque_move(q, n - 1, 0),
+             lambda q, n: q.move(n - 1, 0)),
+    'insert': (lambda q, n: (deque_insert(q, n // 2, make_song(0)), q.pop()),
+               lambda q, n: (q.insert(n // 2, Track(**make_song(0))), q.pop())),
+    'page': (lambda q, n: deque_page(q, n // 2),
+             lambda q, n: q[n // 2:n // 2 + 10]),
+    'popleft': (lambda q, n: q.append(q.popleft()),
+                lambda q, n: q.append(q.popleft())),
+}
+
+
+def measure(fn, queue, size: int, iterations: int) -> float:
+    """คืนค่าเวลาเฉลี่ยต่อครั้ง (ไมโครวินาที)"""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn(queue, size)
+        timings.append((time.perf_counter() - start) * 1_000_000)
+    return statistics.mean(timings)
+
+
+def bytes_per_song(factory, size: int) -> float:
+    tracemalloc.start()
+    queue = factory(size)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del queue
+    return current / size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 1000, 10000])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(f"queue size={size} iterations={args.iterations}")
+        old_queue, new_queue = make_deque(size), make_track_queue(size)
+        for name, (old_fn, new_fn) in OPERATIONS.items():
+            old = measure(old_fn, old_queue, size, args.iterations)
+            new = measure(new_fn, new_queue, size, args.iterations)
+            print(f"  {name:<8} deque={old:10.2f} µs  TrackQueue={new:10.2f} µs  speedup={old / new:8.1f}x")
+        assert len(old_queue) == len(new_queue) == size
+        print(f"  memory   deque+dict={bytes_per_song(make_deque, size):8.0f} B/song  "
+              f"TrackQueue+Track={bytes_per_song(make_track_queue, size):8.0f} B/song")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# benchmarks/bench_startup.py
+"""
+วัดส่วนของ time-to-ready ที่อยู่ในเครื่อง (ไม่รวม login และการต่อ gateway ซึ่งขึ้นกับ network)
+
+1. เวลา import main.py ใน process ใหม่ เทียบ import yt_dlp ไปด้วย (แบบเดิมที่ import ตั้งแต่เริ่ม)
+2. เวลา setup_hook (โหลด MusicCog + sync slash commands) ตอนเริ่มครั้งแรก และตอนรีสตาร์ทโดยที่คำสั่งไม่เปลี่ยน
+   tree.sync ถูกแทนด้วยการหน่วงเวลา --sync-seconds (global sync จริงเป็น HTTP ที่ช้าและโดน rate limit)
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py -n 10 --sync-seconds 2
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark") # main.py ต้องมี token ตอน import
+
+IMPORT_SNIPPET = """
+import sys, time
+started = time.perf_counter()
+{imports}
+print((time.perf_counter() - started) * 1000, 'yt_dlp' in sys.modules)
+"""
+
+
+def time_import(imports: str, runs: int) -> tuple[list[float], bool]:
+    timings, loaded = [], False
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET.format(imports=imports)], cwd=ROOT,
+                                capture_output=True, text=True, check=True)
+        elapsed, loaded = result.stdout.split()[-2:]
+        timings.append(float(elapsed))
+    return timings, loaded == 'True'
+
+
+async def time_setup_hook(sync_seconds: float) -> tuple[float, int]:
+    """สร้างบอทใหม่แล้วเรียก setup_hook เหมือนตอน login คืน (เวลา ms, จำนวนครั้งที่ sync)"""
+    import main
+    bot = main.create_bot()
+    await bot._async_setup_hook() # ให้ bot.loop ใช้ได้เหมือนตอน login (ไม่ต่อ Discord จริง)
+    bot._connection.application_id = 1
+    syncs = 0
+
+    async def fake_sync(**kwargs):
+        nonlocal syncs
+        syncs += 1
+        await asyncio.sleep(sync_seconds)
+        return bot.tree.get_commands()
+
+    bot.tree.sync = fake_sync
+    started = time.perf_counter()
+    await bot.setup_hook()
+    elapsed = (time.perf_counter() - started) * 1000
+    await bot.remove_cog('MusicCog')
+    await bot.http.close()
+    return elapsed, syncs
+
+
+def summary(timings: list[float]) -> str:
+    return f"median={statistics.median(timings):8.1f} ms  min={min(timings):8.1f} ms"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('--sync-seconds', type=float, default=1.0)
+    args = parser.parse_args()
+
+    for label, imports in (("import main (yt_dlp lazy)", "import main"),
+                           ("import yt_dlp + main", "import yt_dlp, main")):
+        timings, loaded = await asyncio.to_thread(time_import, imports, args.runs)
+        print(f"{label:28s} {summary(timings)}  yt_dlp loaded={loaded}")
+
+    with tempfile.TemporaryDirectory(prefix="musicbot-bench-") as directory:
+        os.environ["METADATA_DB_PATH"] = os.path.join(directory, "metadata.db")
+        os.environ["COMMAND_SYNC_HASH_PATH"] = os.path.join(directory, "commands.sha256")
+        for label in ("setup_hook first start", "setup_hook restart"):
+            elapsed, syncs = await time_setup_hook(args.sync_seconds)
+            print(f"{label:28s} {elapsed:8.1f} ms  command syncs={syncs}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
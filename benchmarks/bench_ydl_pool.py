@@ -0,0 +1,72 @@
+# benchmarks/bench_ydl_pool.py
+"""
+วัด overhead ต่อการเรียกระหว่างการสร้าง yt_dlp.YoutubeDL ใหม่ทุกครั้ง (แบบเดิม)
+กับการใช้ YoutubeDLPool
+
+แบบ offline (ค่าเริ่มต้น) วัดเฉพาะส่วนที่ไม่ใช่ network: สร้าง instance + หา extractor + ปิด
+ถ้าใส่ --url จะเรียก extract_info จริงด้วย (ต้องต่ออินเทอร์เน็ต)
+
+    python benchmarks/bench_ydl_pool.py
+    python benchmarks/bench_ydl_pool.py --url "https://www.youtube.com/watch?v=dQw4w9WgXcQ" -n 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark") # main.py ต้องมี token ตอน import
+
+import yt_dlp
+from main import YDL_PROFILES, YoutubeDLPool
+
+
+def run_fresh(profile: str, url: str | None):
+    with yt_dlp.YoutubeDL(dict(YDL_PROFILES[profile])) as ydl:
+        if url:
+            ydl.extract_info(url, download=False)
+        else:
+            ydl.get_info_extractor('Youtube')
+
+
+def run_pooled(pool: YoutubeDLPool, profile: str, url: str | None):
+    ydl = pool.get(profile)
+    if url:
+        ydl.extract_info(url, download=False)
+    else:
+        ydl.get_info_extractor('Youtube')
+
+
+def measure(fn, iterations: int) -> list[float]:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--profile', default='single', choices=sorted(YDL_PROFILES))
+    parser.add_argument('--url', help="URL สำหรับ extract_info จริง (ไม่ใส่ = วัดแบบ offline)")
+    args = parser.parse_args()
+
+    pool = YoutubeDLPool(YDL_PROFILES)
+    run_pooled(pool, args.profile, args.url) # warm-up: สร้าง instance แรกของ thread นี้
+
+    fresh = measure(lambda: run_fresh(args.profile, args.url), args.iterations)
+    pooled = measure(lambda: run_pooled(pool, args.profile, args.url), args.iterations)
+
+    print(f"profile={args.profile} iterations={args.iterations} mode={'network' if args.url else 'offline'}")
+    for name, timings in (("fresh YoutubeDL", fresh), ("YoutubeDLPool", pooled)):
+        print(f"  {name:<16} mean={statistics.mean(timings):8.3f} ms  "
+              f"p50={statistics.median(timings):8.3f} ms  max={max(timings):8.3f} ms")
+    print(f"  saved per call ≈ {statistics.mean(fresh) - statistics.mean(pooled):.3f} ms "
+          f"(instances created by pool: {pool.created})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,566 @@
+# benchmarks/loadtest.py
+"""
+load test แบบ offline: ขับ MusicCog ตั้งแต่คำสั่งจนถึงการอ่านแพ็กเก็ตเสียง โดยไม่ต้องใช้ Discord หรือ YouTube
+
+  - Interaction / VoiceChannel / VoiceClient ปลอม; VoiceClient อ่านแพ็กเก็ตจาก audio source ทุก 20 ms
+    ใน thread ของตัวเองเหมือน AudioPlayer ของ discord.py (แต่ไม่เข้ารหัส Opus และไม่ส่งออก network)
+  - yt-dlp ปลอมที่หน่วงเวลาและสุ่มข้อผิดพลาดได้ตามที่กำหนด คืน stream URL ที่ชี้ไปยังไฟล์เสียงในเครื่อง
+    ซึ่งเปิดผ่าน HTTP (แทน googlevideo) จึงมี FFMPEG ทำงานจริงทุกเพลง
+  - N guild สุ่มสั่ง /play, /skip, /remove และ /queue แบบ Poisson ตามอัตราที่กำหนด
+
+รายงาน throughput, p50/p99 ของเวลาตอบคำสั่ง, ช่วงเงียบระหว่างเพลง, ความหน่วงของ event loop, CPU และหน่วยความจำ
+และเขียนผลเป็น JSON (--json) เพื่อเทียบกันระหว่างเวอร์ชัน ต้องมี ffmpeg ใน PATH
+
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --guilds 50 --duration 120 --rate 6 --latency-ms 400 --error-rate 0.05 --json result.json
+"""
+import argparse
+import asyncio
+import collections
+import http.server
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark") # main.py ต้องมี token ตอน import
+_workdir = tempfile.mkdtemp(prefix="musicbot-loadtest-")
+os.environ["METADATA_DB_PATH"] = os.path.join(_workdir, "metadata.db") # ไม่ใช้แคชบนดิสก์ของบอทจริง
+
+import discord
+import yt_dlp
+import main as musicbot
+
+FRAME_SECONDS = 0.02 # discord.py ส่งเสียงทีละ 20 ms
+COMMAND_WEIGHTS = {'play': 0.45, 'queue': 0.25, 'skip': 0.15, 'remove': 0.15}
+
+
+def percentile(values: list[float], q: float) -> float:
+    """percentile แบบ nearest-rank (0 ถ้าไม่มีข้อมูล)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def summarize(values: list[float]) -> dict:
+    """สรุปเวลา (วินาที) เป็นมิลลิวินาที"""
+    return {'count': len(values),
+            'mean_ms': round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'max_ms': round(max(values) * 1000, 2) if values else 0.0}
+
+
+# --- ไฟล์เสียงและ HTTP server แทน googlevideo ---
+def make_audio_file(directory: str, seconds: float) -> tuple[str, str, int]:
+    """สร้างไฟล์เสียงทดสอบด้วย ffmpeg คืนค่า (path, codec, bitrate kbps) ให้ตรงกับที่ yt-dlp ปลอมรายงาน"""
+    path = os.path.join(directory, "track.webm")
+    result = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+                             '-i', f'sine=frequency=440:duration={seconds}', '-c:a', 'libopus', '-b:a', '128k', '-y', path])
+    if result.returncode == 0:
+        return path, 'opus', 128
+    path = os.path.join(directory, "track.wav") # ffmpeg ที่ไม่มี libopus
+    subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+                    '-i', f'sine=frequency=440:duration={seconds}', '-y', path], check=True)
+    return path, 'pcm_s16le', 1411
+
+
+def serve_file(path: str) -> http.server.ThreadingHTTPServer:
+    """เปิด HTTP server ที่ตอบทุก path ด้วยไฟล์เดียวกัน (ทำงานใน thread แยก)"""
+    with open(path, 'rb') as f:
+        body = f.read()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError): # ffmpeg ถูกหยุดกลางเพลง (/skip)
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- yt-dlp ปลอม ---
+class StubExtractor:
+    """แทน yt_dlp.YoutubeDL: หน่วงเวลาเหมือนการเรียก network และสุ่ม DownloadError ตามอัตราที่กำหนด"""
+    def __init__(self, args, stream_base: str, codec: str, bitrate: int):
+        self.args = args
+        self.stream_base = stream_base
+        self.codec = codec
+        self.bitrate = bitrate
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(args.seed + 1)
+
+    def _call(self):
+        """จำลองเวลาและความล้มเหลวของการเรียก YouTube หนึ่งครั้ง (ทำงานใน thread ของ ExtractionScheduler)"""
+        with self._lock:
+            self.calls += 1
+            delay = self._rng.uniform(0.5, 1.5) * self.args.latency_ms / 1000
+            failed = self._rng.random() < self.args.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(delay)
+        if failed:
+            raise yt_dlp.utils.DownloadError("stub failure", exc_info=(None, yt_dlp.utils.ExtractorError("stub failure"), None))
+
+    def _video(self, video_id: str) -> dict:
+        return {'id': video_id, 'title': f'Load test track {video_id}', 'duration': self.args.track_seconds,
+                'webpage_url': f'https://www.youtube.com/watch?v={video_id}', 'thumbnail': None,
+                'url': f'{self.stream_base}/videoplayback?expire={int(time.time()) + 6 * 3600}&id={video_id}',
+                'acodec': self.codec, 'abr': self.bitrate}
+
+    def extract_info(self, url, download=False, process=True, ie_key=None):
+        self._call()
+        if url.startswith('ytsearch:'):
+            return {'_type': 'playlist', 'entries': [self._video(url[len('ytsearch:'):].replace(' ', '_')[:11])]}
+        if 'list=' in url:
+            playlist_id = url.split('list=')[-1]
+
+            def entries():
+                for i in range(self.args.playlist_length):
+                    video_id = f'{playlist_id[:5]}{i:06d}'
+                    yield {'_type': 'url', 'url': f'https://www.youtube.com/watch?v={video_id}',
+                           'title': f'Load test track {video_id}', 'duration': self.args.track_seconds}
+            return {'_type': 'playlist', 'entries': entries()}
+        return self._video(url.split('v=')[-1][:11])
+
+    def process_ie_result(self, info, download=False):
+        return info
+
+    def close(self):
+        pass
+
+
+# --- Discord ปลอม ---
+class Recorder:
+    """เก็บเวลาที่วัดได้จาก VoiceClient ปลอม (เรียกจากหลาย thread)"""
+    def __init__(self, cog: musicbot.MusicCog):
+        self.cog = cog
+        self.transition_gaps = []
+        self.tracks_started = 0
+        self.packets = 0
+        self._lock = threading.Lock()
+
+    def track_ended(self, voice_client: 'FakeVoiceClient', ended_at: float):
+        player = self.cog.players.get(voice_client.guild_id)
+        # นับช่วงเงียบเฉพาะเมื่อมีเพลงถัดไปรออยู่ (ไม่นับตอนคิวหมดแล้วมีคนสั่ง /play ใหม่ภายหลัง)
+        voice_client.ended_at = ended_at if player is not None and len(player.queue) else None
+
+    def first_packet(self, voice_client: 'FakeVoiceClient', sent_at: float):
+        with self._lock:
+            self.tracks_started += 1
+            if voice_client.ended_at is not None:
+                self.transition_gaps.append(sent_at - voice_client.ended_at)
+        voice_client.ended_at = None
+
+
+class FakeVoiceClient:
+    """แทน discord.VoiceClient: เล่น audio source ใน thread ของตัวเองตามจังหวะ 20 ms ต่อแพ็กเก็ต"""
+    def __init__(self, channel: 'FakeVoiceChannel', recorder: Recorder):
+        self.channel = channel
+        self.guild_id = channel.guild_id
+        self.recorder = recorder
+        self._playing = [None] # source ของการ play() ครั้งล่าสุด (list เพื่อให้ thread เห็นการเปลี่ยน source กลางเพลง)
+        self.ended_at = None
+        self._connected = True
+        self._stop = threading.Event()
+        self._paused = threading.Event()
+        self._thread = None
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set() and not self._paused.is_set()
+
+    def is_paused(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set() and self._paused.is_set()
+
+    @property
+    def source(self) -> discord.AudioSource | None:
+        return self._playing[0]
+
+    @source.setter
+    def source(self, value: discord.AudioSource):
+        """เปลี่ยน source กลางเพลงโดยไม่เรียก after เหมือน VoiceClient.source (ใช้กับ crossfade)"""
+        self._playing[0] = value
+
+    def play(self, source: discord.AudioSource, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        self._playing = [source]
+        self._stop = threading.Event()
+        self._paused.clear()
+        self._thread = threading.Thread(target=self._run, args=(self._playing, after, self._stop), daemon=True)
+        self._thread.start()
+
+    def _run(self, playing: list, after, stop: threading.Event):
+        error = None
+        first = True
+        next_at = time.perf_counter()
+        packets = 0
+        try:
+            while not stop.is_set():
+                if self._paused.is_set():
+                    time.sleep(FRAME_SECONDS)
+                    next_at = time.perf_counter()
+                    continue
+                data = playing[0].read()
+                if first:
+                    self.recorder.first_packet(self, time.perf_counter())
+                    first = False
+                if not data:
+                    break
+                packets += 1
+                next_at += FRAME_SECONDS
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            playing[0].cleanup()
+        if not stop.is_set(): # จบเอง (ถ้าถูก stop() เวลาจบคือเวลาที่สั่ง stop)
+            self.recorder.track_ended(self, time.perf_counter())
+        with self.recorder._lock:
+            self.recorder.packets += packets
+        if after:
+            after(error)
+
+    def stop(self):
+        if self._thread is not None and not self._stop.is_set():
+            self.recorder.track_ended(self, time.perf_counter())
+            self._stop.set()
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self._connected = False
+        self._stop.set()
+
+
+class FakeMember:
+    bot = False
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild_id: int, recorder: Recorder, listeners: int):
+        self.id = guild_id * 10
+        self.guild_id = guild_id
+        self.name = f'voice-{guild_id}'
+        self.bitrate = 64000
+        self.members = [FakeMember() for _ in range(listeners)]
+        self.recorder = recorder
+
+    async def connect(self, **kwargs) -> FakeVoiceClient:
+        return FakeVoiceClient(self, self.recorder)
+
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+    async def edit_message(self, **kwargs):
+        pass
+
+
+class FakeFollowup:
+    def __init__(self):
+        self.first_sent_at = None
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        if self.first_sent_at is None:
+            self.first_sent_at = time.perf_counter()
+        self.messages.append(content)
+
+
+class FakeMessage:
+    def __init__(self, channel: 'FakeTextChannel', message_id: int):
+        self.channel = channel
+        self.id = message_id
+
+    async def edit(self, **kwargs) -> 'FakeMessage':
+        self.channel.api_calls['edit'] += 1
+        return self
+
+    async def delete(self):
+        self.channel.api_calls['delete'] += 1
+
+
+class FakeTextChannel(discord.TextChannel):
+    """ช่องข้อความที่นับการเรียก API (สืบทอด TextChannel เพราะบอทส่งข้อความเฉพาะใน TextChannel)"""
+    def __init__(self, guild_id: int, api_calls: collections.Counter):
+        self.id = guild_id
+        self.last_message_id = None
+        self.api_calls = api_calls
+
+    async def send(self, content=None, **kwargs) -> FakeMessage:
+        self.api_calls['send'] += 1
+        self.last_message_id = self.api_calls['send']
+        return FakeMessage(self, self.last_message_id)
+
+
+class FakeUser:
+    def __init__(self, user_id: int, channel: FakeVoiceChannel):
+        self.id = user_id
+        self.mention = f'<@{user_id}>'
+        self.voice = type('VoiceState', (), {'channel': channel})()
+
+
+class FakeInteraction:
+    def __init__(self, guild_id: int, user: FakeUser, channel: FakeTextChannel):
+        self.guild_id = guild_id
+        self.user = user
+        self.channel = channel
+        self.guild = None
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+class FakeBot:
+    shard_ids = None
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.user = type('BotUser', (), {'id': 0})()
+
+    def get_guild(self, guild_id: int):
+        return None
+
+    async def wait_until_ready(self):
+        pass
+
+
+# --- ตัวสร้างโหลด ---
+class LoadStats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list) # {คำสั่ง: [วินาที]}
+        self.failures = collections.Counter()          # คำสั่งที่ raise exception
+        self.busy = collections.Counter()              # คำสั่งที่ได้คำตอบว่าบอทไม่ว่าง (ExtractionBusy)
+        self.channel_api_calls = collections.Counter() # send/edit/delete ในช่องข้อความ (ไม่นับคำตอบของ interaction)
+
+
+async def run_command(cog: musicbot.MusicCog, command: str, interaction: FakeInteraction, rng: random.Random, args):
+    if command == 'play':
+        if rng.random() < args.playlist_ratio:
+            query = f'https://www.youtube.com/playlist?list=PL{rng.randrange(args.catalog):05d}'
+        else:
+            # ความนิยมของเพลงแบบ Zipf: เพลงดังถูกขอซ้ำบ่อย แคชจึงได้ทำงานเหมือนใช้งานจริง
+            song = rng.choices(range(args.catalog), weights=[1 / (i + 1) for i in range(args.catalog)])[0]
+            query = f'song {song:05d}' if rng.random() < 0.7 else f'https://www.youtube.com/watch?v=lt{song:09d}'
+        await cog.play.callback(cog, interaction, query)
+    elif command == 'skip':
+        await cog.skip.callback(cog, interaction)
+    elif command == 'remove':
+        queue = cog.players[interaction.guild_id].queue if interaction.guild_id in cog.players else ()
+        await cog.remove.callback(cog, interaction, rng.randint(1, max(1, len(queue))))
+    else:
+        await cog.show_queue.callback(cog, interaction, rng.randint(1, 3))
+
+
+async def guild_session(cog: musicbot.MusicCog, guild_id: int, recorder: Recorder, stats: LoadStats,
+                        rng: random.Random, args, deadline: float):
+    channel = FakeVoiceChannel(guild_id, recorder, listeners=3)
+    text_channel = FakeTextChannel(guild_id, stats.channel_api_calls)
+    user = FakeUser(guild_id, channel)
+    commands_, weights = zip(*COMMAND_WEIGHTS.items())
+    await asyncio.sleep(rng.uniform(0, min(5.0, args.duration / 4))) # ไม่ให้ทุก guild เริ่มพร้อมกัน
+    command = 'play'
+    while time.perf_counter() < deadline:
+        interaction = FakeInteraction(guild_id, user, text_channel)
+        started_at = time.perf_counter()
+        try:
+            await run_command(cog, command, interaction, rng, args)
+        except Exception as e:
+            stats.failures[command] += 1
+            print(f"/{command} ใน guild {guild_id} ล้มเหลว: {e!r}")
+        else:
+            answered_at = interaction.followup.first_sent_at or time.perf_counter()
+            stats.latencies[command].append(answered_at - started_at)
+            if any(message and "หลายรายการ" in message for message in interaction.followup.messages):
+                stats.busy[command] += 1
+        await asyncio.sleep(rng.expovariate(args.rate / 60))
+        command = rng.choices(commands_, weights)[0]
+
+
+async def sample_loop_lag(lags: list[float], interval: float, stop: asyncio.Event):
+    """วัดว่า event loop ตื่นช้ากว่าที่ควรเท่าไร (บอกว่ามีงานที่บล็อก loop)"""
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - expected))
+
+
+def rss_bytes() -> int:
+    """RSS ปัจจุบันของ process (0 ถ้าอ่านไม่ได้)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    loop = asyncio.get_running_loop()
+    audio_path, codec, bitrate = make_audio_file(_workdir, args.track_seconds)
+    server = serve_file(audio_path)
+    stub = StubExtractor(args, f'http://127.0.0.1:{server.server_address[1]}', codec, bitrate)
+
+    cog = musicbot.MusicCog(FakeBot(loop))
+    cog.ydl_pool.get = lambda profile: stub
+    recorder = Recorder(cog)
+    await cog.cog_load()
+
+    stats = LoadStats()
+    lags = []
+    stop_sampling = asyncio.Event()
+    lag_task = loop.create_task(sample_loop_lag(lags, 0.05, stop_sampling))
+    rusage_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak_rss = rss_bytes()
+    started_at = time.perf_counter()
+    deadline = started_at + args.duration
+    rng = random.Random(args.seed)
+    sessions = [loop.create_task(guild_session(cog, guild_id, recorder, stats, random.Random(rng.random()), args, deadline))
+                for guild_id in range(1, args.guilds + 1)]
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(0.5)
+        peak_rss = max(peak_rss, rss_bytes())
+    await asyncio.gather(*sessions)
+    elapsed = time.perf_counter() - started_at
+    stop_sampling.set()
+    await lag_task
+
+    rusage_after = resource.getrusage(resource.RUSAGE_SELF)
+    for player in cog.players.values():
+        if player.voice_client:
+            await player.voice_client.disconnect()
+    await asyncio.sleep(0.2) # ให้ thread ของ VoiceClient ปลอมปิด FFMPEG ก่อนอ่าน rusage ของ child process
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    await cog.cog_unload()
+    server.shutdown()
+
+    process_cpu = (rusage_after.ru_utime + rusage_after.ru_stime) - (rusage_before.ru_utime + rusage_before.ru_stime)
+    ffmpeg_cpu = (children_after.ru_utime + children_after.ru_stime) - (children_before.ru_utime + children_before.ru_stime)
+    command_count = sum(len(values) for values in stats.latencies.values())
+    return {
+        'schema': 1,
+        'revision': git_revision(),
+        'config': {key: getattr(args, key) for key in ('guilds', 'duration', 'rate', 'latency_ms', 'error_rate',
+                                                         'track_seconds', 'catalog', 'playlist_ratio', 'playlist_length', 'seed')},
+        'playback_mode': musicbot.PLAYBACK_MODE,
+        'elapsed_s': round(elapsed, 2),
+        'throughput_cmd_per_s': round(command_count / elapsed, 2),
+        'commands': {command: {**summarize(stats.latencies[command]), 'failures': stats.failures[command],
+                               'busy': stats.busy[command]}
+                     for command in COMMAND_WEIGHTS},
+        'transition_gap': summarize(recorder.transition_gaps),
+        'tracks_started': recorder.tracks_started,
+        'preload': {'hits': cog.preload_hits, 'rejected': cog.preload_rejected, 'crossfades': cog.crossfades},
+        'governor': {'queued_starts': cog.governor.queued_starts, 'degraded_starts': cog.governor.degraded_starts,
+                     'load_bypassed': cog.governor.load_bypassed, 'running_at_end': cog.governor.running},
+        'channel_messages': {'api_calls': dict(stats.channel_api_calls),
+                             'now_playing_updates': cog.now_playing_stats['updates'],
+                             'now_playing_saved': cog.now_playing_stats['coalesced'] + cog.now_playing_stats['unchanged']},
+        'audio_packets': recorder.packets,
+        'loop_lag': summarize(lags),
+        'extractor': {'calls': stub.calls, 'errors': stub.errors, 'rejected': cog.extraction.rejected},
+        'cpu': {'bot_s': round(process_cpu, 2), 'ffmpeg_s': round(ffmpeg_cpu, 2),
+                'bot_utilization': round(process_cpu / elapsed, 3)},
+        'memory': {'peak_rss_mb': round(peak_rss / 1024 ** 2, 1),
+                   'max_rss_mb': round(rusage_after.ru_maxrss / 1024, 1)}, # ru_maxrss เป็น KB บน Linux
+    }
+
+
+def print_report(result: dict):
+    config = result['config']
+    print(f"revision={result['revision']} mode={result['playback_mode']} guilds={config['guilds']} "
+          f"duration={config['duration']}s rate={config['rate']}/min/guild latency={config['latency_ms']}ms "
+          f"error_rate={config['error_rate']}")
+    print(f"  throughput   {result['throughput_cmd_per_s']:.2f} commands/s")
+    for command, summary in result['commands'].items():
+        print(f"  /{command:<11} n={summary['count']:<6} p50={summary['p50_ms']:8.1f} ms  p99={summary['p99_ms']:8.1f} ms  "
+              f"busy={summary['busy']} failures={summary['failures']}")
+    gap = result['transition_gap']
+    print(f"  transitions  n={gap['count']:<6} p50={gap['p50_ms']:8.1f} ms  p99={gap['p99_ms']:8.1f} ms  max={gap['max_ms']:.1f} ms")
+    lag = result['loop_lag']
+    print(f"  loop lag     p50={lag['p50_ms']:8.1f} ms  p99={lag['p99_ms']:8.1f} ms  max={lag['max_ms']:.1f} ms")
+    print(f"  tracks started={result['tracks_started']} packets={result['audio_packets']} "
+          f"extractor calls={result['extractor']['calls']} errors={result['extractor']['errors']} "
+          f"rejected={result['extractor']['rejected']}")
+    print(f"  preload hits={result['preload']['hits']} rejected={result['preload']['rejected']} "
+          f"crossfades={result['preload']['crossfades']}")
+    print(f"  governor queued starts={result['governor']['queued_starts']} "
+          f"degraded starts={result['governor']['degraded_starts']} load bypassed={result['governor']['load_bypassed']}")
+    messages = result['channel_messages']
+    print(f"  channel api  send={messages['api_calls'].get('send', 0)} edit={messages['api_calls'].get('edit', 0)} "
+          f"delete={messages['api_calls'].get('delete', 0)}  now playing updates={messages['now_playing_updates']} "
+          f"saved={messages['now_playing_saved']}")
+    print(f"  cpu bot={result['cpu']['bot_s']} s ({result['cpu']['bot_utilization']:.0%}) ffmpeg={result['cpu']['ffmpeg_s']} s  "
+          f"memory peak rss={result['memory']['peak_rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, default=10, help="จำนวน guild ที่ใช้งานพร้อมกัน")
+    parser.add_argument('--duration', type=float, default=60, help="ระยะเวลาทดสอบ (วินาที)")
+    parser.add_argument('--rate', type=float, default=4, help="จำนวนคำสั่งต่อนาทีต่อ guild (เฉลี่ย)")
+    parser.add_argument('--latency-ms', type=float, default=300, help="เวลาเฉลี่ยต่อการเรียก yt-dlp ปลอม")
+    parser.add_argument('--error-rate', type=float, default=0.02, help="สัดส่วนการเรียก yt-dlp ที่ล้มเหลว")
+    parser.add_argument('--track-seconds', type=float, default=10, help="ความยาวของไฟล์เสียงทดสอบ")
+    parser.add_argument('--catalog', type=int, default=500, help="จำนวนเพลงที่แตกต่างกันที่ถูกขอ")
+    parser.add_argument('--playlist-ratio', type=float, default=0.05, help="สัดส่วนของ /play ที่เป็นเพลย์ลิสต์")
+    parser.add_argument('--playlist-length', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="เขียนผลเป็น JSON ลงไฟล์นี้ (บอทยัง print ข้อผิดพลาดลง stdout)")
+    args = parser.parse_args()
+    if not shutil.which('ffmpeg'):
+        parser.error("ไม่พบ ffmpeg ใน PATH")
+
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(_workdir, ignore_errors=True)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,33 @@
 import discord
 from discord.ext import commands, tasks
 import asyncio
-import yt_dlp
+import audioop # ใช้ร่วมกับ discord.py (import ไว้แล้วใน discord.player)
+import bisect
 import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import multiprocessing.connection
 import os
+import re
+import math
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv # สำหรับ .env (ถ้ามี)
 
+if TYPE_CHECKING:
+    import yt_dlp # import จริงเมื่อดึงข้อมูลครั้งแรก (ดู _yt_dlp)
+
 # --- การตั้งค่าพื้นฐาน ---
 # โหลดตัวแปรสภาพแวดล้อม (ถ้าคุณใช้ไฟล์ .env สำหรับ TOKEN)
 load_dotenv()
@@ -22,7 +44,18 @@ intents = discord.Intents.default()
 intents.message_content = True # ถ้าจะใช้คำสั่งแบบ prefix (เช่น !play) แต่เราจะเน้น slash commands
 intents.voice_states = True    # จำเป็นสำหรับติดตามสถานะ voice channel
 
-bot = commands.Bot(command_prefix=commands.when_mentioned_or("!"), intents=intents) # prefix แทบไม่ได้ใช้เมื่อมี slash commands
+# --- การแบ่ง shard หลาย process ---
+# SHARD_WORKERS > 1: process หลักเป็น supervisor ที่เปิด worker process ตามจำนวนนี้ แต่ละตัวรัน AutoShardedBot
+# กับ shard ส่วนหนึ่ง และเปิดใหม่อัตโนมัติเมื่อ worker ล่ม; worker ใช้ข้อมูลเพลงและ stream URL ร่วมกันผ่านไฟล์ SQLite
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "1"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or SHARD_WORKERS # จำนวน shard ทั้งหมด (ควรเป็นจำนวนเท่าของ SHARD_WORKERS)
+SHARD_RESTART_BACKOFF_MAX = 60 # วินาที; รอนานสุดเท่านี้ก่อนเปิด worker ที่ล่มซ้ำ ๆ ใหม่
+SHARD_WORKER_STABLE_SECONDS = 300 # worker ที่รันได้นานกว่านี้ก่อนล่มจะเริ่มนับ backoff ใหม่
+WORKER_EXIT_FATAL = 3 # exit code ของ worker เมื่อไม่ควรเปิดใหม่ (เช่น token ไม่ถูกต้อง)
+
+# --- การ sync slash commands ---
+# sync เฉพาะเมื่อ hash ของ command tree ต่างจากที่บันทึกไว้หลัง sync สำเร็จครั้งก่อน (global sync ช้าและโดน rate limit)
+COMMAND_SYNC_HASH_PATH = os.getenv("COMMAND_SYNC_HASH_PATH", "soulyu_commands.sha256") # ว่าง = sync ทุกครั้งที่เริ่มบอท
 
 # --- ตัวเลือกสำหรับ YDL และ FFMPEG ---
 YDL_OPTIONS_BASE = {
@@ -44,37 +77,2916 @@ YDL_OPTIONS_BASE = {
     # 'verbose': True, # เปิดเพื่อ debug yt-dlp
 }
 
-FFMPEG_OPTIONS = {
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5', # พยายามเชื่อมต่อใหม่หากสตรีมหลุด
-    'options': '-vn -filter:a "loudnorm=I=-16:LRA=11:tp=-1.5"', # -vn คือไม่เอาวิดีโอ, loudnorm สำหรับปรับระดับเสียงให้เท่ากัน
-}
+# ตัวเลือก YDL แยกตามลักษณะงาน (ใช้กับ YoutubeDLPool)
+YDL_PROFILES = {
+    'playlist': YDL_OPTIONS_BASE,                                                # URL เพลง/เพลย์ลิสต์ (flat)
+    'single': {**YDL_OPTIONS_BASE, 'extract_flat': False, 'noplaylist': True},  # ดึง stream URL ของเพลงเดียว
+    'search': {**YDL_OPTIONS_BASE, 'extract_flat': False, 'noplaylist': True},  # ค้นหาด้วย ytsearch:
+}
+
+def _yt_dlp():
+    """import yt_dlp ตอนดึงข้อมูลครั้งแรก (import ใช้เวลานาน ไม่ให้หน่วงการเริ่มบอท)"""
+    import yt_dlp
+    return yt_dlp
+
+class YoutubeDLPool:
+    """
+    เก็บ yt_dlp.YoutubeDL ที่ตั้งค่าไว้แล้ว แยกตาม thread และ profile เพื่อใช้ซ้ำ
+    ไม่ต้องลงทะเบียน extractor/อ่านตัวเลือกใหม่ทุกครั้ง และได้ใช้ HTTP connection เดิมต่อ
+    (YoutubeDL ไม่ thread-safe จึงให้แต่ละ worker thread มีชุดของตัวเอง)
+    """
+    def __init__(self, profiles: dict[str, dict]):
+        self._profiles = profiles
+        self._local = threading.local()
+        self.created = 0 # จำนวน instance ที่สร้างทั้งหมด (ไว้ดูว่าใช้ซ้ำได้จริง)
+
+    def get(self, profile: str) -> 'yt_dlp.YoutubeDL':
+        """คืน YoutubeDL ของ thread ปัจจุบันสำหรับ profile ที่ระบุ (สร้างใหม่ถ้ายังไม่มี)"""
+        instances = getattr(self._local, 'instances', None)
+        if instances is None:
+            instances = self._local.instances = {}
+        ydl = instances.get(profile)
+        if ydl is None:
+            ydl = _yt_dlp().YoutubeDL(dict(self._profiles[profile]))
+            instances[profile] = ydl
+            self.created += 1
+        return ydl
+
+    def discard(self, profile: str):
+        """ทิ้ง instance ของ thread ปัจจุบัน (ใช้หลังข้อผิดพลาดที่ไม่คาดคิด เผื่อสถานะภายในเสีย)"""
+        instances = getattr(self._local, 'instances', {})
+        ydl = instances.pop(profile, None)
+        if ydl is not None:
+            ydl.close()
+
+FFMPEG_OPTIONS = {
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5', # พยายามเชื่อมต่อใหม่หากสตรีมหลุด
+    'options': '-vn -filter:a "loudnorm=I=-16:LRA=11:tp=-1.5"', # -vn คือไม่เอาวิดีโอ, loudnorm สำหรับปรับระดับเสียงให้เท่ากัน
+}
+
+# --- โหมดการเล่นเสียง ---
+# "transcode": FFmpeg แปลงเป็น PCM + loudnorm แล้ว discord.py เข้ารหัส Opus เอง (แบบเดิม)
+# "passthrough": ส่งแพ็กเก็ต Opus จาก YouTube ตรงไปเลยถ้า codec/bitrate เข้ากับห้อง ไม่เช่นนั้นให้ FFmpeg เข้ารหัส Opus เอง
+PLAYBACK_MODE = os.getenv("PLAYBACK_MODE", "transcode").lower()
+# ยอมให้ bitrate ของ stream สูงกว่าของห้องได้กี่เท่า (YouTube Opus 251 ≈ 130–160 kbps เทียบกับห้องปกติ 64 kbps)
+OPUS_PASSTHROUGH_MAX_BITRATE_RATIO = float(os.getenv("OPUS_PASSTHROUGH_MAX_BITRATE_RATIO", "2.5"))
+# YouTube ปรับเสียงไว้ราว -14 LUFS อยู่แล้ว ลดลงเล็กน้อยด้วย volume ให้ใกล้ -16 LUFS ของ loudnorm แทนการวิเคราะห์แบบ realtime
+PASSTHROUGH_VOLUME_FILTER = 'volume=0.75'
+
+# --- การดึง stream URL ล่วงหน้า (prefetch) ---
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD", "2")) # จำนวนเพลงถัดไปในคิวที่จะดึง stream URL เตรียมไว้ (0 = ปิด)
+STREAM_URL_EXPIRY_MARGIN = 120 # วินาที; ถือว่า URL หมดอายุก่อนเวลาจริงเล็กน้อย เผื่อเวลาเชื่อมต่อของ FFMPEG
+STREAM_URL_DEFAULT_TTL = 3600  # วินาที; ใช้เมื่อ URL ไม่มีพารามิเตอร์ expire=
+
+_EXPIRE_PARAM_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+def _parse_stream_expiry(stream_url: str) -> float:
+    """อ่านเวลาหมดอายุ (epoch) จากพารามิเตอร์ expire= ของ googlevideo URL"""
+    match = _EXPIRE_PARAM_RE.search(stream_url or '')
+    if match:
+        return float(match.group(1))
+    return time.time() + STREAM_URL_DEFAULT_TTL
+
+def _stream_info(info: dict | None) -> dict:
+    """ดึงข้อมูล stream (URL, เวลาหมดอายุ, codec, bitrate) จากผลลัพธ์ของ yt-dlp สำหรับเก็บไว้ในข้อมูลเพลง"""
+    stream_url = info.get('url') if info else None
+    return {
+        'stream_url': stream_url,
+        'stream_expires': _parse_stream_expiry(stream_url) if stream_url else 0,
+        'stream_acodec': info.get('acodec') if stream_url else None,
+        'stream_abr': info.get('abr') if stream_url else None,
+    }
+
+def _song_from_entry(entry: dict, with_stream: bool) -> dict:
+    """แปลง entry ในเพลย์ลิสต์/ผลการค้นหาของ yt-dlp เป็นข้อมูลเพลง (ยังไม่มีผู้ขอ)"""
+    # ผลการค้นหา (ไม่ใช่ flat) มี stream URL มาด้วยแล้ว ส่วน playlist แบบ flat 'url' คือหน้าเว็บ
+    return {
+        'title': entry.get('title', 'เพลงไม่ทราบชื่อ'),
+        'webpage_url': entry.get('webpage_url', entry.get('url')),
+        'duration': entry.get('duration'),
+        'thumbnail': entry.get('thumbnail') or (entry.get('thumbnails') or [{}])[-1].get('url'),
+        **_stream_info(entry if with_stream else None),
+        'is_partial': True 
+    }
+
+def _song_from_video(data: dict) -> dict:
+    """แปลงผลลัพธ์ของวิดีโอเดียวจาก yt-dlp เป็นข้อมูลเพลง (ยังไม่มีผู้ขอ)"""
+    return {
+        'title': data.get('title', 'เพลงไม่ทราบชื่อ'),
+        'webpage_url': data.get('webpage_url'),
+        'duration': data.get('duration'),
+        'thumbnail': data.get('thumbnail'),
+        **_stream_info(data),
+        'is_partial': not (data.get('url') and not data.get('is_live'))
+    }
+
+def _is_playlist_url(query_or_url: str) -> bool:
+    """URL ของเพลย์ลิสต์หรือ Mix (มี list=) ซึ่งควรทยอยเพิ่มเข้าคิว"""
+    return query_or_url.startswith(('http://', 'https://')) and ('list=' in query_or_url or '/playlist' in query_or_url)
+
+PLAYLIST_BATCH_SIZE = 25          # จำนวนเพลงที่เพิ่มเข้าคิวต่อครั้งระหว่างโหลดเพลย์ลิสต์
+PLAYLIST_BATCH_FLUSH_SECONDS = 1.0 # เพิ่มเพลงที่ได้มาแล้วเข้าคิวเลยถ้ารอเพลงถัดไปนานกว่านี้
+
+def _stream_info_of(song_data: dict) -> dict:
+    """คัดเฉพาะข้อมูล stream ออกจากข้อมูลเพลง"""
+    return {key: song_data.get(key) for key in ('stream_url', 'stream_expires', 'stream_acodec', 'stream_abr')}
+
+# --- แคชในหน่วยความจำ ---
+STREAM_CACHE_MAX_ENTRIES = int(os.getenv("STREAM_CACHE_MAX_ENTRIES", "2000")) # จำนวน stream URL สูงสุดในแคช
+SEARCH_CACHE_MAX_SONGS = int(os.getenv("SEARCH_CACHE_MAX_SONGS", "20000"))    # จำนวนเพลงรวมสูงสุดในแคชผลการค้นหา/เพลย์ลิสต์
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "1800"))                # วินาที
+
+def _normalize_query(query_or_url: str) -> str:
+    """ทำให้คำค้นหาที่ต่างกันแค่ตัวพิมพ์/ช่องว่างใช้ key แคชเดียวกัน (URL คงไว้ตามเดิม)"""
+    query_or_url = query_or_url.strip()
+    if query_or_url.startswith('http://') or query_or_url.startswith('https://'):
+        return query_or_url
+    return "ytsearch:" + " ".join(query_or_url.lower().split())
+
+class TTLCache:
+    """
+    แคช LRU ที่แต่ละรายการมีเวลาหมดอายุของตัวเอง
+    จำกัดขนาดด้วยน้ำหนักรวม (เช่น จำนวนเพลง) และนับ hit/miss ไว้ดูสถิติ
+    """
+    def __init__(self, max_weight: int, default_ttl: float):
+        self.max_weight = max_weight
+        self.default_ttl = default_ttl
+        self._entries = collections.OrderedDict() # {key: (expires_at, weight, value)}
+        self.total_weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        """คืนค่าในแคช หรือ None ถ้าไม่มี/หมดอายุแล้ว"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, weight, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.total_weight -= weight
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl: float | None = None, expires_at: float | None = None, weight: int = 1):
+        """เพิ่ม/แทนที่ค่าในแคช แล้วลบรายการที่ใช้ล่าสุดนานที่สุดออกจนน้ำหนักรวมไม่เกินกำหนด"""
+        if expires_at is None:
+            expires_at = time.time() + (self.default_ttl if ttl is None else ttl)
+        if weight > self.max_weight or expires_at <= time.time():
+            return
+        self.pop(key)
+        self._entries[key] = (expires_at, weight, value)
+        self.total_weight += weight
+        while self.total_weight > self.max_weight:
+            _, (_, old_weight, _) = self._entries.popitem(last=False)
+            self.total_weight -= old_weight
+            self.evictions += 1
+
+    def pop(self, key):
+        """ลบรายการออกจากแคช (ถ้ามี)"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_weight -= entry[1]
+
+    def stats(self) -> dict:
+        """สรุปสถิติการใช้งานแคช"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'weight': self.total_weight,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+# --- ที่เก็บข้อมูลเพลงบนดิสก์ (SQLite) ---
+METADATA_DB_PATH = os.getenv("METADATA_DB_PATH", "soulyu_metadata.db")
+METADATA_REFRESH_AGE = int(os.getenv("METADATA_REFRESH_AGE", "86400")) # วินาที; ข้อมูลที่เก่ากว่านี้จะถูกดึงใหม่เบื้องหลัง
+METADATA_MAX_TRACKS = int(os.getenv("METADATA_MAX_TRACKS", "200000"))   # จำนวนเพลงสูงสุดที่เก็บ
+METADATA_MAX_LOOKUPS = int(os.getenv("METADATA_MAX_LOOKUPS", "50000"))  # จำนวนผลการค้นหา/เพลย์ลิสต์สูงสุดที่เก็บ
+METADATA_COMPACT_INTERVAL_HOURS = 1
+# แบ่ง shard หลาย process: เก็บ stream URL ลง SQLite ด้วยเพื่อไม่ให้แต่ละ worker ดึงเพลงเดียวกันซ้ำ
+# (googlevideo URL ผูกกับ IP และทุก worker อยู่บนเครื่องเดียวกัน จึงใช้แทนกันได้)
+SHARED_STREAM_CACHE = SHARD_WORKERS > 1
+
+class MetadataStore:
+    """
+    เก็บข้อมูลเพลง (ชื่อ, ความยาว, ภาพปก, URL) และผลการค้นหา/รายการเพลงในเพลย์ลิสต์ลง SQLite
+    เพื่อให้ยังใช้ได้หลังรีสตาร์ท และใช้ร่วมกันระหว่าง worker process เมื่อแบ่ง shard
+    stream URL หมดอายุเร็ว จึงเก็บเฉพาะตอนแบ่ง shard เพื่อให้ worker อื่นใช้ต่อได้ (ดู SHARED_STREAM_CACHE)
+    """
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL") # มีผลเฉพาะตอนสร้างไฟล์ใหม่
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                webpage_url TEXT PRIMARY KEY,
+                title TEXT,
+                duration REAL,
+                thumbnail TEXT,
+                updated_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS lookups (
+                query_key TEXT PRIMARY KEY,
+                track_urls TEXT NOT NULL, -- JSON list ตามลำดับในเพลย์ลิสต์/ผลการค้นหา
+                updated_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS loudness (
+                video_id TEXT PRIMARY KEY,
+                integrated REAL NOT NULL, -- LUFS
+                true_peak REAL NOT NULL,  -- dBTP
+                measured_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS stream_urls (
+                webpage_url TEXT PRIMARY KEY,
+                stream_info TEXT NOT NULL, -- JSON จาก _stream_info
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS queue_journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                guild_id INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                args TEXT NOT NULL, -- JSON list
+                at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS queue_snapshots (
+                guild_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL, -- JSON: ช่องเสียง/ช่องข้อความ, เพลงที่กำลังเล่น, เพลงในคิว
+                position REAL NOT NULL, -- วินาทีที่เล่นไปแล้วของเพลงที่กำลังเล่น
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS guild_settings (
+                guild_id INTEGER PRIMARY KEY,
+                queue_max_length INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS audio_cache (
+                video_id TEXT PRIMARY KEY, -- ไฟล์ <video_id>.mka ใน AUDIO_CACHE_DIR
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS tracks_last_used ON tracks(last_used);
+            CREATE INDEX IF NOT EXISTS queue_journal_guild ON queue_journal(guild_id, seq);
+            CREATE INDEX IF NOT EXISTS lookups_last_used ON lookups(last_used);
+            CREATE INDEX IF NOT EXISTS audio_cache_last_used ON audio_cache(last_used);
+        """)
+
+    def get_lookup(self, query_key: str) -> tuple[list[dict], float] | None:
+        """คืนค่า (list ของข้อมูลเพลง, เวลาที่อัปเดตล่าสุด) หรือ None ถ้าไม่มี/ข้อมูลไม่ครบ"""
+        with self._lock:
+            row = self._db.execute("SELECT track_urls, updated_at FROM lookups WHERE query_key = ?", (query_key,)).fetchone()
+            if row is None:
+                return None
+            urls = json.loads(row[0])
+            tracks = {}
+            for start in range(0, len(urls), 500): # SQLite จำกัดจำนวนพารามิเตอร์ต่อคำสั่ง
+                chunk = urls[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for url, title, duration, thumbnail in self._db.execute(
+                        f"SELECT webpage_url, title, duration, thumbnail FROM tracks WHERE webpage_url IN ({placeholders})", chunk):
+                    tracks[url] = {'title': title, 'webpage_url': url, 'duration': duration, 'thumbnail': thumbnail,
+                                   'stream_url': None, 'stream_expires': 0, 'is_partial': True}
+            if len(tracks) < len(set(urls)): # บางเพลงถูกลบไปตอน compact แล้ว
+                return None
+            self._db.execute("UPDATE lookups SET last_used = ? WHERE query_key = ?", (time.time(), query_key))
+        return [dict(tracks[url]) for url in urls], row[1]
+
+    def put_lookup(self, query_key: str, songs: list[dict]):
+        """บันทึกผลการค้นหา/เพลย์ลิสต์และข้อมูลของทุกเพลงในนั้น"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT INTO tracks (webpage_url, title, duration, thumbnail, updated_at, last_used) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(webpage_url) DO UPDATE SET title = excluded.title, duration = excluded.duration, "
+                    "thumbnail = excluded.thumbnail, updated_at = excluded.updated_at, last_used = excluded.last_used",
+                    [(song['webpage_url'], song.get('title'), song.get('duration'), song.get('thumbnail'), now, now)
+                     for song in songs if song.get('webpage_url')])
+                self._db.execute(
+                    "INSERT OR REPLACE INTO lookups (query_key, track_urls, updated_at, last_used) VALUES (?, ?, ?, ?)",
+                    (query_key, json.dumps([song['webpage_url'] for song in songs if song.get('webpage_url')]), now, now))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def recent_titles(self, limit: int) -> list[tuple[str, str, float]]:
+        """คืนค่า [(webpage_url, title, last_used)] ของเพลงที่ใช้ล่าสุด limit เพลง (สำหรับสร้าง index ของ autocomplete)"""
+        with self._lock:
+            return self._db.execute("SELECT webpage_url, title, last_used FROM tracks WHERE title IS NOT NULL "
+                                    "ORDER BY last_used DESC LIMIT ?", (limit,)).fetchall()
+
+    def get_loudness(self, video_id: str) -> tuple[float, float] | None:
+        """คืนค่า (integrated loudness, true peak) ที่วัดไว้ของเพลง หรือ None ถ้ายังไม่เคยวัด"""
+        with self._lock:
+            return self._db.execute("SELECT integrated, true_peak FROM loudness WHERE video_id = ?", (video_id,)).fetchone()
+
+    def put_loudness(self, video_id: str, integrated: float, true_peak: float):
+        """บันทึกผลการวัดความดังของเพลง"""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO loudness (video_id, integrated, true_peak, measured_at) VALUES (?, ?, ?, ?)",
+                             (video_id, integrated, true_peak, time.time()))
+
+    def get_stream_info(self, webpage_url: str) -> tuple[dict, float] | None:
+        """คืนค่า (ข้อมูล stream, เวลาที่ควรถือว่าหมดอายุ) ที่ worker ใดก็ได้ดึงไว้ หรือ None ถ้าไม่มี/หมดอายุแล้ว"""
+        with self._lock:
+            row = self._db.execute("SELECT stream_info, expires_at FROM stream_urls WHERE webpage_url = ? AND expires_at > ?",
+                                   (webpage_url, time.time())).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def put_stream_infos(self, entries: list[tuple[str, dict, float]]):
+        """บันทึกข้อมูล stream [(webpage_url, ข้อมูล stream, เวลาหมดอายุ)] ให้ worker อื่นใช้ได้"""
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO stream_urls (webpage_url, stream_info, expires_at) VALUES (?, ?, ?)",
+                                 [(webpage_url, json.dumps(stream_info), expires_at)
+                                  for webpage_url, stream_info, expires_at in entries])
+
+    def use_audio_cache_file(self, video_id: str) -> int | None:
+        """คืนขนาดไฟล์ของเพลงใน AudioCache และบันทึกเวลาที่ใช้ล่าสุด หรือ None ถ้าไม่มีในแคช"""
+        with self._lock:
+            row = self._db.execute("SELECT size FROM audio_cache WHERE video_id = ?", (video_id,)).fetchone()
+            if row:
+                self._db.execute("UPDATE audio_cache SET last_used = ? WHERE video_id = ?", (time.time(), video_id))
+        return row[0] if row else None
+
+    def put_audio_cache_files(self, files: list[tuple[str, int, float]]):
+        """เพิ่ม/แทนที่ไฟล์ (video_id, ขนาด, เวลาที่ใช้ล่าสุด) ใน index ของ AudioCache"""
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO audio_cache (video_id, size, last_used) VALUES (?, ?, ?)", files)
+
+    def remove_audio_cache_files(self, video_ids: list[str]):
+        with self._lock:
+            self._db.executemany("DELETE FROM audio_cache WHERE video_id = ?", [(video_id,) for video_id in video_ids])
+
+    def audio_cache_files(self) -> list[str]:
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT video_id FROM audio_cache")]
+
+    def audio_cache_totals(self) -> tuple[int, int]:
+        """คืนค่า (จำนวนไฟล์, ขนาดรวม) ของ AudioCache รวมทุก worker"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio_cache").fetchone()
+
+    def evict_audio_cache(self, max_bytes: int) -> list[str]:
+        """ลบไฟล์ที่ใช้ล่าสุดนานที่สุดออกจาก index จนขนาดรวมไม่เกิน max_bytes คืน video_id ที่ต้องลบไฟล์"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE") # worker อื่นเพิ่ม/ลบไฟล์ระหว่างนี้ไม่ได้ ยอดรวมจึงไม่นับซ้ำ
+            try:
+                total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM audio_cache").fetchone()[0]
+                evicted = []
+                if total > max_bytes:
+                    for video_id, size in self._db.execute("SELECT video_id, size FROM audio_cache ORDER BY last_used"):
+                        evicted.append(video_id)
+                        total -= size
+                        if total <= max_bytes:
+                            break
+                    self._db.executemany("DELETE FROM audio_cache WHERE video_id = ?", [(video_id,) for video_id in evicted])
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return evicted
+
+    def append_journal(self, entries: list[tuple[int, str, str, float]]):
+        """เพิ่มรายการ (guild_id, op, args JSON, เวลา) ต่อท้าย journal ของคิว"""
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT INTO queue_journal (guild_id, op, args, at) VALUES (?, ?, ?, ?)", entries)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def write_queue_snapshots(self, snapshots: dict[int, tuple[str, float] | None], positions: dict[int, float]):
+        """
+        เขียน snapshot ของ guild ที่เปลี่ยน ({guild_id: (state JSON, position)} หรือ None = ลบ) แล้วลบ journal ของ guild นั้น
+        และอัปเดตแค่ตำแหน่งเพลงของ guild ที่กำลังเล่นแต่คิวไม่เปลี่ยน
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for guild_id, snapshot in snapshots.items():
+                    if snapshot is None:
+                        self._db.execute("DELETE FROM queue_snapshots WHERE guild_id = ?", (guild_id,))
+                    else:
+                        self._db.execute("INSERT OR REPLACE INTO queue_snapshots (guild_id, state, position, updated_at) "
+                                         "VALUES (?, ?, ?, ?)", (guild_id, snapshot[0], snapshot[1], now))
+                    self._db.execute("DELETE FROM queue_journal WHERE guild_id = ?", (guild_id,))
+                self._db.executemany("UPDATE queue_snapshots SET position = ?, updated_at = ? WHERE guild_id = ?",
+                                     [(position, now, guild_id) for guild_id, position in positions.items()])
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def load_queue_sessions(self, max_age: float) -> dict[int, tuple[dict | None, float, list[tuple[str, list]]]]:
+        """คืนค่า {guild_id: (state จาก snapshot หรือ None, position, [(op, args) ใน journal ตามลำดับ])} ที่ไม่เก่ากว่า max_age"""
+        cutoff = time.time() - max_age
+        sessions, updated = {}, {}
+        with self._lock:
+            for guild_id, state, position, updated_at in self._db.execute(
+                    "SELECT guild_id, state, position, updated_at FROM queue_snapshots"):
+                sessions[guild_id] = (json.loads(state), position, [])
+                updated[guild_id] = updated_at
+            for guild_id, op, args, at in self._db.execute("SELECT guild_id, op, args, at FROM queue_journal ORDER BY seq"):
+                if guild_id not in sessions:
+                    sessions[guild_id] = (None, 0.0, [])
+                sessions[guild_id][2].append((op, json.loads(args)))
+                updated[guild_id] = max(updated.get(guild_id, 0.0), at)
+        # journal ต่อจาก snapshot เสมอ จึงตัดทั้ง guild ตามเวลาที่เปลี่ยนล่าสุด ไม่ตัดแยกเป็นรายการ
+        return {guild_id: session for guild_id, session in sessions.items() if updated[guild_id] > cutoff}
+
+    def queue_limits(self) -> dict[int, int]:
+        """คืนค่า {guild_id: จำนวนเพลงสูงสุดในคิว} ของทุก guild ที่ตั้งไว้ (guild ที่ไม่มีใช้ค่าเริ่มต้น)"""
+        with self._lock:
+            return dict(self._db.execute("SELECT guild_id, queue_max_length FROM guild_settings "
+                                         "WHERE queue_max_length IS NOT NULL"))
+
+    def put_queue_limit(self, guild_id: int, queue_max_length: int):
+        """บันทึกจำนวนเพลงสูงสุดในคิวของ guild"""
+        with self._lock:
+            self._db.execute("INSERT INTO guild_settings (guild_id, queue_max_length) VALUES (?, ?) "
+                             "ON CONFLICT(guild_id) DO UPDATE SET queue_max_length = excluded.queue_max_length",
+                             (guild_id, queue_max_length))
+
+    def compact(self):
+        """ลบข้อมูลที่ไม่ได้ใช้นานที่สุดจนไม่เกินขนาดที่กำหนด แล้วคืนพื้นที่ไฟล์"""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM lookups WHERE query_key IN (SELECT query_key FROM lookups ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (METADATA_MAX_LOOKUPS,))
+            self._db.execute(
+                "DELETE FROM tracks WHERE webpage_url IN (SELECT webpage_url FROM tracks ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (METADATA_MAX_TRACKS,))
+            self._db.execute("DELETE FROM stream_urls WHERE expires_at <= ?", (time.time(),))
+            # guild ที่หยุดเล่นนานเกินกว่าจะกู้คืน (journal ของ guild ที่ยังเปลี่ยนอยู่จะถูกรวมเป็น snapshot เองทุก 30 วินาที)
+            self._db.execute("DELETE FROM queue_snapshots WHERE updated_at <= ?", (time.time() - QUEUE_RESTORE_MAX_AGE,))
+            self._db.execute("DELETE FROM queue_journal WHERE at <= ? AND guild_id NOT IN (SELECT guild_id FROM queue_snapshots)",
+                             (time.time() - QUEUE_RESTORE_MAX_AGE,))
+            self._db.execute("PRAGMA incremental_vacuum")
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# --- คำแนะนำเพลงตอนพิมพ์ /play (autocomplete) ---
+AUTOCOMPLETE_MAX_TITLES = int(os.getenv("AUTOCOMPLETE_MAX_TITLES", "5000")) # จำนวนเพลงสูงสุดใน index (0 = ปิด autocomplete)
+AUTOCOMPLETE_HALF_LIFE = 7 * 86400 # วินาที; น้ำหนักจากจำนวนครั้งที่ขอลดลงครึ่งหนึ่งทุก ๆ เท่านี้
+AUTOCOMPLETE_WORDS_PER_TITLE = 8   # พิมพ์ตั้งแต่ต้นคำไหนของชื่อเพลงก็ได้ ถึงคำที่เท่านี้
+AUTOCOMPLETE_KEY_CHARS = 48        # เก็บ key แค่เท่านี้ตัวอักษร (พิมพ์ยาวกว่านี้จะเทียบแค่ช่วงต้น)
+AUTOCOMPLETE_SCAN_LIMIT = 256      # จำนวน key ที่ตรงกับคำที่พิมพ์ที่นำมาจัดอันดับต่อครั้ง
+AUTOCOMPLETE_CHOICES = 25          # จำนวนตัวเลือกสูงสุดที่ Discord แสดง
+AUTOCOMPLETE_CHOICE_MAX_CHARS = 100 # ความยาวสูงสุดของชื่อและค่าของตัวเลือก
+
+_AUTOCOMPLETE_PUNCTUATION_RE = re.compile(r'[!-/:-@\[-`{-~“”‘’「」『』【】《》]') # ไม่ต้องพิมพ์ "(" หรือ "-" ก็หาเจอ
+_UNSPACED_SCRIPT_RE = re.compile(r'[\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]') # ไทย ลาว พม่า เขมร ญี่ปุ่น จีน: เขียนติดกันไม่เว้นวรรคระหว่างคำ
+
+class AutocompleteIndex:
+    """
+    index ของชื่อเพลงที่บอทเคยดึงข้อมูลมาแล้ว สำหรับ autocomplete ของ /play (ไม่เรียก network)
+    เก็บชื่อเพลงตั้งแต่ต้นคำที่ n ที่ normalize แล้วเรียงไว้ใน list (คู่กับ list ของ URL) แล้วหาช่วงที่ขึ้นต้นด้วยคำที่พิมพ์ด้วย bisect
+    คะแนนคือจำนวนครั้งที่ขอที่ลดลงครึ่งหนึ่งทุก AUTOCOMPLETE_HALF_LIFE; เกินจำนวนที่กำหนดจะลบเพลงคะแนนต่ำสุดออกทีละชุด
+    ทุก method ต้องเรียกจาก event loop
+    """
+    def __init__(self, max_titles: int):
+        self.max_titles = max_titles
+        self._titles = {} # {webpage_url: [title, คะแนน ณ เวลาที่ขอล่าสุด, เวลาที่ขอล่าสุด, อันดับ]}
+        self._keys = []   # key ที่เรียงแล้ว
+        self._urls = []   # webpage_url ของ key ในตำแหน่งเดียวกัน
+        self.lookups = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._titles)
+
+    @staticmethod
+    def _words(text: str) -> list[str]:
+        return _AUTOCOMPLETE_PUNCTUATION_RE.sub(" ", text.casefold()).split()
+
+    @classmethod
+    def _keys_of(cls, title: str) -> list[str]:
+        words = cls._words(title)
+        return [" ".join(words[i:])[:AUTOCOMPLETE_KEY_CHARS] for i in range(min(len(words), AUTOCOMPLETE_WORDS_PER_TITLE))]
+
+    @staticmethod
+    def _entry(title: str, score: float, requested_at: float) -> list:
+        # log2(คะแนน ณ ตอนนี้) + ค่าคงที่ เรียงได้เหมือนกันโดยไม่ต้องรู้เวลาปัจจุบัน จึงคำนวณอันดับเก็บไว้ได้เลย
+        return [title, score, requested_at, math.log2(score) + requested_at / AUTOCOMPLETE_HALF_LIFE]
+
+    def load(self, rows: list[tuple[str, str, float]]):
+        """เพิ่มเพลงจากที่เก็บข้อมูล [(webpage_url, title, เวลาที่ใช้ล่าสุด)] ทีเดียว (เรียงใหม่ครั้งเดียวแทนการแทรกทีละ key)"""
+        pairs = list(zip(self._keys, self._urls))
+        for webpage_url, title, used_at in rows:
+            if (title and webpage_url and len(webpage_url) <= AUTOCOMPLETE_CHOICE_MAX_CHARS
+                    and webpage_url not in self._titles):
+                self._titles[webpage_url] = self._entry(title, 1.0, used_at)
+                pairs.extend((key, webpage_url) for key in self._keys_of(title))
+        pairs.sort()
+        self._keys = [key for key, _ in pairs]
+        self._urls = [webpage_url for _, webpage_url in pairs]
+        if len(self._titles) > self.max_titles:
+            self._evict()
+
+    def add(self, title: str | None, webpage_url: str | None):
+        """นับการขอเพลงหนึ่งครั้ง (เพิ่มเข้า index ถ้ายังไม่มี)"""
+        # Discord ส่งค่าของตัวเลือกได้ไม่เกิน 100 ตัวอักษร URL ที่ยาวกว่านั้นจึงใช้เป็นตัวเลือกไม่ได้
+        if not title or not webpage_url or len(webpage_url) > AUTOCOMPLETE_CHOICE_MAX_CHARS:
+            return
+        now = time.time()
+        entry = self._titles.get(webpage_url)
+        score = 1.0
+        if entry is not None:
+            score += entry[1] * 0.5 ** ((now - entry[2]) / AUTOCOMPLETE_HALF_LIFE)
+            if entry[0] != title:
+                self._remove_keys(entry[0], webpage_url) # ชื่อเพลงบน Youtube เปลี่ยน
+                entry = None
+        self._titles[webpage_url] = self._entry(title, score, now)
+        if entry is not None:
+            return
+        for key in self._keys_of(title):
+            index = bisect.bisect_left(self._keys, key)
+            self._keys.insert(index, key)
+            self._urls.insert(index, webpage_url)
+        # ลบทีละประมาณ 10% เพื่อไม่ต้องสร้าง list ใหม่ทุกครั้งที่มีเพลงใหม่
+        if len(self._titles) > self.max_titles + max(1, self.max_titles // 10):
+            self._evict()
+
+    def _remove_keys(self, title: str, webpage_url: str):
+        for key in self._keys_of(title):
+            index = bisect.bisect_left(self._keys, key)
+            while index < len(self._keys) and self._keys[index] == key:
+                if self._urls[index] == webpage_url:
+                    del self._keys[index], self._urls[index]
+                    break
+                index += 1
+
+    def _evict(self):
+        keep = heapq.nlargest(self.max_titles, self._titles.items(), key=lambda item: item[1][3])
+        self.evictions += len(self._titles) - len(keep)
+        self._titles = dict(keep)
+        kept = [i for i, webpage_url in enumerate(self._urls) if webpage_url in self._titles]
+        self._keys = [self._keys[i] for i in kept]
+        self._urls = [self._urls[i] for i in kept]
+
+    def search(self, text: str, limit: int) -> list[tuple[str, str]]:
+        """คืนค่า [(title, webpage_url)] ที่ชื่อมีคำที่ขึ้นต้นด้วย text เรียงตามคะแนน (ว่าง = ไม่แนะนำ)"""
+        prefix = " ".join(self._words(text))[:AUTOCOMPLETE_KEY_CHARS]
+        if not prefix:
+            return []
+        self.lookups += 1
+        keys, titles = self._keys, self._titles
+        start = bisect.bisect_left(keys, prefix)
+        end = min(len(keys), start + AUTOCOMPLETE_SCAN_LIMIT)
+        # key ที่ขึ้นต้นด้วย prefix อยู่ติดกันเสมอ จึงหาจุดสิ้นสุดด้วย bisect ได้โดยไม่ต้องเทียบทีละตัว
+        end = bisect.bisect_left(keys, prefix + "\U0010ffff", start, end)
+        best = heapq.nlargest(limit, set(self._urls[start:end]), key=lambda webpage_url: titles[webpage_url][3])
+        return [(titles[webpage_url][0], webpage_url) for webpage_url in best]
+
+# --- การวัดความดังของเพลง (แทน loudnorm แบบ realtime) ---
+LOUDNESS_TARGET_I = -16.0   # LUFS (เท่ากับค่าใน FFMPEG_OPTIONS)
+LOUDNESS_TARGET_TP = -1.5   # dBTP
+LOUDNESS_ANALYSIS_WORKERS = int(os.getenv("LOUDNESS_ANALYSIS_WORKERS", "1")) # จำนวน FFMPEG ที่วัดความดังพร้อมกันได้ (0 = ปิด)
+LOUDNESS_ANALYSIS_MAX_SECONDS = 900 # วัดแค่ช่วงต้นของเพลงที่ยาวมาก
+LOUDNESS_QUEUE_SIZE = 200
+LOUDNESS_CACHE_MAX_ENTRIES = 20000 # ค่าความดังในหน่วยความจำ (ไม่ต้อง query SQLite บน event loop ทุกครั้งที่เริ่มเพลง)
+LOUDNESS_CACHE_TTL = 86400         # วินาที; ค่าที่วัดแล้วไม่เปลี่ยน แต่ให้หมดอายุบ้างเพื่อไม่ให้ค้างในหน่วยความจำตลอด
+LOUDNESS_UNMEASURED_TTL = 300      # วินาที; จำว่าเพลงยังไม่ถูกวัด (worker อื่นอาจวัดเสร็จและบันทึกลง SQLite ที่ใช้ร่วมกัน)
+
+def _ffmpeg_before_options(source: str, start_offset: float = 0) -> str:
+    """ตัวเลือก reconnect ใช้ได้กับ URL เท่านั้น ไฟล์ในเครื่องต้องไม่ใส่; start_offset > 0 จะเริ่มเล่นจากวินาทีนั้น"""
+    options = FFMPEG_OPTIONS['before_options'] if source.startswith(('http://', 'https://')) else ''
+    if start_offset > 0:
+        options = f'{options} -ss {start_offset:.1f}'.strip()
+    return options
+
+_YOUTUBE_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/live/)([A-Za-z0-9_-]{11})')
+_YOUTUBE_ID_ONLY_RE = re.compile(r'[A-Za-z0-9_-]{11}')
+
+def _video_id(webpage_url: str | None) -> str | None:
+    """ดึง video ID ของ YouTube จาก URL (ถ้าไม่ใช่ YouTube ใช้ URL ทั้งหมดเป็น key แทน)"""
+    if not webpage_url:
+        return None
+    match = _YOUTUBE_ID_RE.search(webpage_url)
+    return match.group(1) if match else webpage_url
+
+def _loudness_gain(integrated: float, true_peak: float) -> float:
+    """คำนวณ gain เชิงเส้นที่ทำให้เพลงดังเท่า LOUDNESS_TARGET_I โดย true peak ไม่เกิน LOUDNESS_TARGET_TP"""
+    gain_db = min(LOUDNESS_TARGET_I - integrated, LOUDNESS_TARGET_TP - true_peak)
+    return 10 ** (gain_db / 20)
+
+class LoudnessAnalyzer:
+    """
+    วัด integrated loudness และ true peak ของเพลงเบื้องหลังด้วย loudnorm ของ FFMPEG (print_format=json)
+    แล้วบันทึกลง MetadataStore เพื่อให้ครั้งต่อไปใช้แค่ volume filter
+    เป็นงานความสำคัญต่ำ: วัดเมื่อ FFmpegGovernor มีช่องว่างและเครื่องไม่ได้ทำงานหนักเท่านั้น
+    และวัดจากไฟล์ใน AudioCache แทน stream ถ้ามี
+    """
+    def __init__(self, store: MetadataStore, workers: int, governor: 'FFmpegGovernor', local_path):
+        self.store = store
+        self.workers = workers
+        self.governor = governor
+        self._local_path = local_path # (video_id) -> path ของไฟล์ในเครื่อง หรือ None
+        self._cache = TTLCache(LOUDNESS_CACHE_MAX_ENTRIES, LOUDNESS_CACHE_TTL) # {video_id: (integrated, true_peak) หรือ () ถ้ายังไม่ได้วัด}
+        self._queue = asyncio.Queue(maxsize=LOUDNESS_QUEUE_SIZE)
+        self._queued = set() # video ID ที่อยู่ในคิว/กำลังวัด
+        self._tasks = []
+        self.measured = 0
+        self.failed = 0
+        self.running = 0 # จำนวน FFMPEG ที่กำลังวัดอยู่
+
+    def start(self):
+        self._tasks = [asyncio.get_running_loop().create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def lookup(self, video_id: str) -> tuple[float, float] | None:
+        """คืนค่า (integrated loudness, true peak) ที่วัดไว้ หรือ None ถ้ายังไม่เคยวัด (อ่าน SQLite ใน thread แยกเฉพาะเมื่อไม่มีในแคช)"""
+        measured = self._cache.get(video_id)
+        if measured is None:
+            measured = await asyncio.get_running_loop().run_in_executor(None, self.store.get_loudness, video_id)
+            if measured is None:
+                self._cache.put(video_id, (), ttl=LOUDNESS_UNMEASURED_TTL)
+                return None
+            measured = tuple(measured)
+            self._cache.put(video_id, measured)
+        return measured or None
+
+    def submit(self, video_id: str, stream_url: str):
+        """ขอให้วัดความดังของเพลง (ไม่ทำอะไรถ้าปิดอยู่ อยู่ในคิวแล้ว หรือคิวเต็ม)"""
+        if not self._tasks or video_id in self._queued or self._queue.full():
+            return
+        self._queued.add(video_id)
+        self._queue.put_nowait((video_id, stream_url))
+
+    async def _worker(self):
+        while True:
+            video_id, stream_url = await self._queue.get()
+            try:
+                while not self.governor.try_acquire(): # ให้การเล่นเพลงได้ FFMPEG ก่อนเสมอ
+                    await asyncio.sleep(FFMPEG_LOAD_SAMPLE_SECONDS)
+                try:
+                    result = await self._measure(self._local_path(video_id) or stream_url)
+                finally:
+                    self.governor.release()
+                if result:
+                    await asyncio.get_running_loop().run_in_executor(None, self.store.put_loudness, video_id, *result)
+                    self._cache.put(video_id, result)
+                    self.measured += 1
+                else:
+                    self.failed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"เกิดข้อผิดพลาดขณะวัดความดังของเพลง '{video_id}': {e}")
+            finally:
+                self._queued.discard(video_id)
+
+    async def _measure(self, stream_url: str) -> tuple[float, float] | None:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostdin', '-hide_banner', '-nostats', *_ffmpeg_before_options(stream_url).split(),
+            '-i', stream_url, '-t', str(LOUDNESS_ANALYSIS_MAX_SECONDS), '-vn',
+            '-af', f'loudnorm=I={LOUDNESS_TARGET_I}:LRA=11:tp={LOUDNESS_TARGET_TP}:print_format=json', '-f', 'null', '-',
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        self.running += 1
+        communicate = asyncio.ensure_future(process.communicate())
+        try:
+            while not (await asyncio.wait({communicate}, timeout=FFMPEG_LOAD_SAMPLE_SECONDS))[0]:
+                if self.governor.waiting: # มีเพลงรอเริ่มเล่น ยกช่องให้ก่อน (วัดใหม่ครั้งหน้าที่เล่นเพลงนี้)
+                    process.kill()
+                    await communicate
+                    return None
+            _, stderr = communicate.result()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        finally:
+            self.running -= 1
+        output = stderr.decode(errors='ignore')
+        start, end = output.rfind('{'), output.rfind('}')
+        if process.returncode != 0 or start == -1 or end < start:
+            return None
+        stats = json.loads(output[start:end + 1])
+        integrated, true_peak = float(stats['input_i']), float(stats['input_tp'])
+        if not (math.isfinite(integrated) and math.isfinite(true_peak)): # เพลงเงียบทั้งเพลง
+            return None
+        return integrated, true_peak
+
+# --- แคชไฟล์เสียงบนดิสก์ (เปิดใช้เมื่อตั้งค่า AUDIO_CACHE_DIR) ---
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "")                                       # ว่าง = ปิด
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))      # ขนาดรวมสูงสุดของไฟล์ในแคช
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))                     # เก็บเพลงที่เล่นมากกว่ากี่ครั้ง
+AUDIO_CACHE_MAX_TRACK_SECONDS = 1800 # ไม่เก็บเพลงที่ยาวกว่านี้
+AUDIO_CACHE_MAX_TRACKED_PLAYS = 50000 # จำนวนเพลงสูงสุดที่นับจำนวนครั้งที่เล่นไว้ในหน่วยความจำ
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # process ของผู้ใช้อื่น
+        return True
+    return True
+
+class AudioCache:
+    """
+    เก็บไฟล์เสียงของเพลงที่ถูกเล่นบ่อยไว้บนดิสก์ (คัดลอก stream เดิมลง .mka โดยไม่แปลงเสียง)
+    ลบไฟล์ที่ไม่ได้ใช้นานที่สุดเมื่อขนาดรวมเกินกำหนด และเขียนไฟล์แบบ atomic (เขียน .part แล้ว rename)
+    เมื่อแบ่ง shard ทุก worker ใช้โฟลเดอร์เดียวกัน: index และขนาดรวมอยู่ใน MetadataStore ที่ใช้ร่วมกัน
+    และไฟล์ .part มี pid ของ worker ที่เขียนอยู่ในชื่อ จึงไม่เขียนทับหรือลบไฟล์ที่ worker อื่นกำลังเขียน
+    """
+    def __init__(self, directory: str, max_bytes: int, min_plays: int, store: MetadataStore):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.store = store
+        self._plays = collections.Counter() # นับแยกต่อ worker (ใช้ตัดสินว่าจะเก็บไฟล์เท่านั้น ไม่ต้องแม่นยำ)
+        self._downloading = set()
+        self._download_lock = asyncio.Lock() # ดาวน์โหลดทีละไฟล์ต่อ worker
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _path(self, video_id: str) -> str:
+        return os.path.join(self.directory, f"{video_id}.mka")
+
+    def _scan(self):
+        """
+        ลบไฟล์ .part ที่ค้างจาก worker ที่ไม่ได้ทำงานแล้ว และทำให้ index ตรงกับไฟล์ที่มีอยู่
+        (เพิ่มไฟล์ที่ยังไม่อยู่ใน index เช่นแคชจากเวอร์ชันก่อน และลบรายการที่ไฟล์หายไปแล้ว)
+        """
+        on_disk = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.part'):
+                pid = entry.name[:-len('.part')].rpartition('.')[2]
+                if not pid.isdigit() or not _pid_alive(int(pid)):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(entry.path)
+            elif entry.name.endswith('.mka'):
+                stat = entry.stat()
+                on_disk.append((entry.name[:-len('.mka')], stat.st_size, stat.st_mtime))
+        indexed = set(self.store.audio_cache_files())
+        self.store.put_audio_cache_files([file for file in on_disk if file[0] not in indexed])
+        self.store.remove_audio_cache_files(list(indexed - {file[0] for file in on_disk}))
+        self._evict()
+
+    async def lookup(self, video_id: str, count: bool = True) -> str | None:
+        """
+        คืน path ของไฟล์ในแคช หรือ None ถ้ายังไม่มี (อ่าน/อัปเดต index ใน thread แยก)
+        count=False ไม่นับสถิติ (ผู้เรียกนับเองด้วย record_lookup เมื่อได้ใช้จริง เช่น preload ที่อาจถูกทิ้ง)
+        """
+        path, size = await asyncio.get_running_loop().run_in_executor(None, self._use_file, video_id)
+        if count:
+            self._count(path, size)
+        return path
+
+    def record_lookup(self, path: str | None):
+        """นับสถิติของผล lookup(count=False) ที่ได้ใช้จริง"""
+        size = 0
+        if path is not None:
+            with contextlib.suppress(OSError):
+                size = os.path.getsize(path)
+        self._count(path, size)
+
+    def _count(self, path: str | None, size: int):
+        if path is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.bytes_served += size
+
+    def _use_file(self, video_id: str) -> tuple[str | None, int]:
+        size = self.store.use_audio_cache_file(video_id)
+        path = self._path(video_id)
+        if size is None or not os.path.exists(path):
+            if size is not None: # ไฟล์ถูกลบจากภายนอก
+                self.store.remove_audio_cache_files([video_id])
+            return None, 0
+        return path, size
+
+    def cached_path(self, video_id: str) -> str | None:
+        """คืน path ของไฟล์ในแคชโดยไม่นับสถิติและไม่เปลี่ยนลำดับการใช้งาน (สำหรับงานเบื้องหลัง)"""
+        path = self._path(video_id)
+        return path if os.path.exists(path) else None
+
+    def record_play(self, video_id: str, stream_url: str):
+        """นับจำนวนครั้งที่เล่น และเริ่มเก็บไฟล์เบื้องหลังเมื่อเล่นเกิน min_plays ครั้ง"""
+        if len(self._plays) >= AUDIO_CACHE_MAX_TRACKED_PLAYS and video_id not in self._plays:
+            self._plays = collections.Counter(dict(self._plays.most_common(AUDIO_CACHE_MAX_TRACKED_PLAYS // 2)))
+        self._plays[video_id] += 1
+        if self._plays[video_id] > self.min_plays and video_id not in self._downloading and not os.path.exists(self._path(video_id)):
+            self._downloading.add(video_id)
+            asyncio.get_running_loop().create_task(self._download(video_id, stream_url))
+
+    async def _download(self, video_id: str, stream_url: str):
+        final_path = self._path(video_id)
+        part_path = os.path.join(self.directory, f"{video_id}.{os.getpid()}.part")
+        try:
+            async with self._download_lock:
+                if os.path.exists(final_path): # worker อื่นเก็บไว้แล้วระหว่างรอคิว
+                    return
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', *_ffmpeg_before_options(stream_url).split(),
+                    '-i', stream_url, '-vn', '-c:a', 'copy', '-f', 'matroska', '-y', part_path,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                print(f"เก็บไฟล์เสียงของ '{video_id}' ไม่สำเร็จ: {stderr.decode(errors='ignore').strip()}")
+                return
+            os.replace(part_path, final_path)
+            size = os.path.getsize(final_path)
+            # แทนที่รายการเดิมถ้า worker อื่นเก็บเพลงเดียวกันพร้อมกัน ขนาดรวมจึงไม่นับซ้ำ
+            await asyncio.get_running_loop().run_in_executor(None, self._add_and_evict, video_id, size)
+        except Exception as e:
+            print(f"เกิดข้อผิดพลาดขณะเก็บไฟล์เสียงของ '{video_id}': {e}")
+        finally:
+            self._downloading.discard(video_id)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    def _add_and_evict(self, video_id: str, size: int):
+        self.store.put_audio_cache_files([(video_id, size, time.time())])
+        self._evict()
+
+    def _evict(self):
+        for video_id in self.store.evict_audio_cache(self.max_bytes):
+            self.evictions += 1
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(video_id))
+
+    @property
+    def downloading(self) -> int:
+        """จำนวน FFMPEG ที่กำลังเก็บไฟล์อยู่ (ดาวน์โหลดทีละไฟล์)"""
+        return 1 if self._download_lock.locked() else 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        files, total_bytes = self.store.audio_cache_totals()
+        return {
+            'files': files,
+            'bytes': total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'bytes_served': self.bytes_served,
+            'evictions': self.evictions,
+        }
+
+# --- คลังเพลงในเครื่อง (เปิดใช้เมื่อตั้งค่า LIBRARY_DIR) ---
+# /play ค้นหาใน index ของคลังเพลงก่อน ถ้าเจอจะเล่นไฟล์จากดิสก์ทันทีโดยไม่เรียก yt-dlp
+LIBRARY_DIR = os.getenv("LIBRARY_DIR", "")                                # ว่าง = ปิด
+LIBRARY_DB_PATH = os.getenv("LIBRARY_DB_PATH", "soulyu_library.db")
+LIBRARY_RESCAN_MINUTES = float(os.getenv("LIBRARY_RESCAN_MINUTES", "30")) # สแกนหาไฟล์ที่เปลี่ยนทุก ๆ เท่านี้ (0 = สแกนตอนเริ่มบอทครั้งเดียว)
+LIBRARY_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.wma', '.webm', '.mka')
+LIBRARY_SCAN_BATCH = 500        # เขียนลง SQLite ทุก ๆ เท่านี้ไฟล์ระหว่างสแกน (เพลงที่สแกนแล้วค้นหาได้เลยไม่ต้องรอสแกนเสร็จ)
+LIBRARY_TAG_READ_TIMEOUT = 30   # วินาที; เวลาสูงสุดที่ให้ FFMPEG อ่าน tag ของไฟล์หนึ่งไฟล์
+LIBRARY_URL_PREFIX = 'library:' # webpage_url ของเพลงในคลัง (library:<id>) ใช้แทน URL ของ YouTube ในคิว, journal และ autocomplete
+_FFMPEG_TAG_RE = re.compile(r'^\s+(title|artist|album)\s*:\s?(.*)$', re.IGNORECASE | re.MULTILINE)
+_FFMPEG_DURATION_RE = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+def _is_library_url(webpage_url: str | None) -> bool:
+    return bool(webpage_url) and webpage_url.startswith(LIBRARY_URL_PREFIX)
+
+def _audio_cache_name(video_id: str) -> str:
+    """
+    ชื่อไฟล์ใน AudioCache ของ key จาก _video_id: video ID ของ YouTube ใช้ได้เลย
+    ส่วน key ที่เป็น URL ทั้งหมด (เว็บอื่น) มี / และ : ซึ่งใช้เป็นชื่อไฟล์ไม่ได้ จึงใช้ sha1 ของ URL แทน
+    """
+    return video_id if _YOUTUBE_ID_ONLY_RE.fullmatch(video_id) else hashlib.sha1(video_id.encode()).hexdigest()
+
+def _audio_cache_key(webpage_url: str | None) -> str | None:
+    """key ของเพลงใน AudioCache (เพลงในคลังเพลงอยู่บนดิสก์อยู่แล้ว จึงไม่เก็บซ้ำ)"""
+    if _is_library_url(webpage_url):
+        return None
+    video_id = _video_id(webpage_url)
+    return _audio_cache_name(video_id) if video_id else None
+
+def _link_url(webpage_url: str | None) -> str:
+    """URL สำหรับลิงก์ markdown ใน embed (เพลงในคลังเพลงไม่มีหน้าเว็บ)"""
+    return webpage_url if webpage_url and webpage_url.startswith(('http://', 'https://')) else '#'
+
+def _read_tags_mutagen(path: str) -> tuple[str | None, str | None, str | None, float | None]:
+    """อ่าน (title, artist, album, duration) ด้วย mutagen"""
+    import mutagen
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception:
+        return None, None, None, None
+    if audio is None:
+        return None, None, None, None
+    tags = audio.tags or {}
+
+    def first(key):
+        values = tags.get(key)
+        return str(values[0]).strip() or None if values else None
+    return first('title'), first('artist'), first('album'), getattr(audio.info, 'length', None)
+
+def _read_tags_ffmpeg(path: str) -> tuple[str | None, str | None, str | None, float | None]:
+    """อ่าน (title, artist, album, duration) จากข้อความที่ FFMPEG แสดงตอนเปิดไฟล์ (ใช้เมื่อไม่ได้ติดตั้ง mutagen)"""
+    try:
+        result = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-i', path], capture_output=True,
+                                timeout=LIBRARY_TAG_READ_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+        return None, None, None, None
+    output = result.stderr.decode(errors='replace')
+    tags = {}
+    for key, value in _FFMPEG_TAG_RE.findall(output):
+        tags.setdefault(key.lower(), value.strip() or None) # tag ของไฟล์มาก่อน tag ของ stream
+    match = _FFMPEG_DURATION_RE.search(output)
+    duration = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3)) if match else None
+    return tags.get('title'), tags.get('artist'), tags.get('album'), duration
+
+def _title_from_filename(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0].replace('_', ' ').strip() or path
+
+class MusicLibrary:
+    """
+    index ของไฟล์เพลงใน LIBRARY_DIR บน SQLite (FTS5) ค้นหาจากชื่อเพลง ศิลปิน อัลบั้ม และ path ของไฟล์ได้ในระดับมิลลิวินาที
+    สแกนแบบเพิ่มเติม: อ่าน tag ใหม่เฉพาะไฟล์ที่ขนาดหรือเวลาแก้ไขเปลี่ยน และลบไฟล์ที่หายไปออกจาก index
+    อ่าน tag ด้วย mutagen ถ้าติดตั้งไว้ ไม่เช่นนั้นใช้ FFMPEG (ช้ากว่ามาก แต่ทำครั้งเดียวต่อไฟล์)
+    """
+    def __init__(self, directory: str, db_path: str):
+        self.directory = os.path.abspath(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS library_files (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, -- ไม่ใช้ id ซ้ำ เพลงเก่าใน journal จึงไม่ชี้ไปที่ไฟล์อื่น
+                path TEXT UNIQUE NOT NULL, -- path เทียบกับ LIBRARY_DIR
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                title TEXT NOT NULL,
+                artist TEXT,
+                album TEXT,
+                duration REAL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS library_fts USING fts5(
+                title, artist, album, path, content='library_files', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            );
+            CREATE TRIGGER IF NOT EXISTS library_files_insert AFTER INSERT ON library_files BEGIN
+                INSERT INTO library_fts (rowid, title, artist, album, path) VALUES (new.id, new.title, new.artist, new.album, new.path);
+            END;
+            CREATE TRIGGER IF NOT EXISTS library_files_delete AFTER DELETE ON library_files BEGIN
+                INSERT INTO library_fts (library_fts, rowid, title, artist, album, path)
+                VALUES ('delete', old.id, old.title, old.artist, old.album, old.path);
+            END;
+            CREATE TRIGGER IF NOT EXISTS library_files_update AFTER UPDATE ON library_files BEGIN
+                INSERT INTO library_fts (library_fts, rowid, title, artist, album, path)
+                VALUES ('delete', old.id, old.title, old.artist, old.album, old.path);
+                INSERT INTO library_fts (rowid, title, artist, album, path) VALUES (new.id, new.title, new.artist, new.album, new.path);
+            END;
+        """)
+        self.trigram = self._create_trigram_index()
+        self.tracks = self._count()
+        self.searches = 0
+        self.hits = 0
+        self.scan_seconds = None # เวลาที่ใช้สแกนครั้งล่าสุด
+        self.scan_changes = 0    # ไฟล์ที่เพิ่ม/เปลี่ยน/ลบในการสแกนครั้งล่าสุด
+
+    def __len__(self) -> int:
+        return self.tracks
+
+    def _create_trigram_index(self) -> bool:
+        """
+        index แบบ trigram สำหรับคำในภาษาที่เขียนติดกัน (เช่น ภาษาไทย) ซึ่ง unicode61 ตัดคำไม่ได้ ทั้งชื่อเพลงจึงกลายเป็นคำเดียว
+        คืน False ถ้า SQLite เก่ากว่า 3.34 (ไม่มี trigram) ซึ่งจะค้นคำเหล่านี้ด้วย LIKE แทน
+        """
+        exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'library_trigram'").fetchone() is not None
+        try:
+            self._db.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS library_trigram USING fts5(
+                    title, artist, album, path, content='library_files', content_rowid='id', tokenize='trigram'
+                );
+                CREATE TRIGGER IF NOT EXISTS library_files_insert_trigram AFTER INSERT ON library_files BEGIN
+                    INSERT INTO library_trigram (rowid, title, artist, album, path) VALUES (new.id, new.title, new.artist, new.album, new.path);
+                END;
+                CREATE TRIGGER IF NOT EXISTS library_files_delete_trigram AFTER DELETE ON library_files BEGIN
+                    INSERT INTO library_trigram (library_trigram, rowid, title, artist, album, path)
+                    VALUES ('delete', old.id, old.title, old.artist, old.album, old.path);
+                END;
+                CREATE TRIGGER IF NOT EXISTS library_files_update_trigram AFTER UPDATE ON library_files BEGIN
+                    INSERT INTO library_trigram (library_trigram, rowid, title, artist, album, path)
+                    VALUES ('delete', old.id, old.title, old.artist, old.album, old.path);
+                    INSERT INTO library_trigram (rowid, title, artist, album, path) VALUES (new.id, new.title, new.artist, new.album, new.path);
+                END;
+            """)
+        except sqlite3.OperationalError as e:
+            print(f"SQLite ไม่รองรับ trigram ({e}) จะค้นคำภาษาไทยในคลังเพลงด้วย LIKE แทน")
+            return False
+        if not exists: # index ที่สร้างก่อนมีตารางนี้: เติมจากไฟล์ที่สแกนไว้แล้ว
+            self._db.execute("INSERT INTO library_trigram (library_trigram) VALUES ('rebuild')")
+        return True
+
+    def _count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM library_files").fetchone()[0]
+
+    @staticmethod
+    def _song(track_id: int, title: str, artist: str | None, duration: float | None) -> dict:
+        if artist and artist.casefold() not in title.casefold():
+            title = f"{artist} - {title}"
+        return {'title': title, 'webpage_url': f"{LIBRARY_URL_PREFIX}{track_id}", 'duration': duration, 'thumbnail': None,
+                'stream_url': None, 'stream_expires': 0, 'is_partial': False}
+
+    def _match_expression(self, text: str, prefix: bool) -> tuple[str | None, str | None, list[str]]:
+        """
+        แปลงข้อความที่ผู้ใช้พิมพ์เป็นคำค้น โดยทุกคำต้องตรง
+        prefix=True: คำที่พิมพ์ไม่ครบก็หาเจอ ในทุกคอลัมน์ (สำหรับ autocomplete)
+        prefix=False: ทุกคำต้องตรงทั้งคำในชื่อเพลงหรือศิลปิน (สำหรับ /play ที่จะข้ามการค้นหาใน YouTube)
+        คำในภาษาที่เขียนติดกันไม่มีขอบเขตของคำให้เทียบ จึงค้นเป็นส่วนหนึ่งของข้อความแทน: ผ่าน trigram ถ้ายาวอย่างน้อย 3 ตัวอักษร
+        ไม่เช่นนั้นผ่าน LIKE คืน (คำค้นของ library_fts, คำค้นของ library_trigram, คำที่ต้องค้นด้วย LIKE)
+        """
+        columns = "" if prefix else "{title artist} : "
+        tokens, substrings, short = [], [], []
+        for word in _AUTOCOMPLETE_PUNCTUATION_RE.sub(" ", text.casefold()).split():
+            quoted = '"' + word.replace('"', '""') + '"'
+            if not _UNSPACED_SCRIPT_RE.search(word):
+                tokens.append(columns + quoted + ("*" if prefix else ""))
+            elif self.trigram and len(word) >= 3:
+                substrings.append(columns + quoted)
+            else:
+                short.append(word)
+        return " AND ".join(tokens) or None, " AND ".join(substrings) or None, short
+
+    def search(self, text: str, limit: int, prefix: bool = True) -> list[dict]:
+        """คืนข้อมูลเพลง (แบบเดียวกับผลจาก yt-dlp) ที่ตรงกับ text มากที่สุด limit เพลง เรียงตาม bm25 (ชื่อเพลงมีน้ำหนักมากสุด)"""
+        tokens, substrings, short = self._match_expression(text, prefix)
+        if tokens is None and substrings is None and not short:
+            return []
+        joins, conditions, params, order = [], [], [], "length(library_files.title)"
+        if substrings is not None:
+            joins.append("JOIN library_trigram ON library_trigram.rowid = library_files.id")
+            conditions.append("library_trigram MATCH ?")
+            params.append(substrings)
+            order = "bm25(library_trigram, 10.0, 5.0, 2.0, 1.0)"
+        if tokens is not None:
+            joins.append("JOIN library_fts ON library_fts.rowid = library_files.id")
+            conditions.append("library_fts MATCH ?")
+            params.append(tokens)
+            order = "bm25(library_fts, 10.0, 5.0, 2.0, 1.0)"
+        columns = ('title', 'artist', 'album', 'path') if prefix else ('title', 'artist')
+        for word in short: # "%" และ "_" ถูกตัดออกไปพร้อมเครื่องหมายวรรคตอนแล้ว
+            conditions.append("(" + " OR ".join(f"library_files.{column} LIKE ?" for column in columns) + ")")
+            params.extend([f"%{word}%"] * len(columns))
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT library_files.id, library_files.title, library_files.artist, library_files.duration "
+                f"FROM library_files {' '.join(joins)} WHERE {' AND '.join(conditions)} ORDER BY {order} LIMIT ?",
+                (*params, limit)).fetchall()
+        self.searches += 1
+        self.hits += bool(rows)
+        return [self._song(*row) for row in rows]
+
+    def _row_of(self, webpage_url: str) -> tuple | None:
+        try:
+            track_id = int(webpage_url[len(LIBRARY_URL_PREFIX):])
+        except ValueError:
+            return None
+        with self._lock:
+            return self._db.execute("SELECT id, title, artist, duration, path FROM library_files WHERE id = ?",
+                                    (track_id,)).fetchone()
+
+    def get(self, webpage_url: str) -> dict | None:
+        """ข้อมูลเพลงของ library:<id> (เช่น ค่าที่ผู้ใช้เลือกจาก autocomplete) หรือ None ถ้าไม่มีใน index แล้ว"""
+        row = self._row_of(webpage_url)
+        return self._song(*row[:4]) if row else None
+
+    def path_of(self, webpage_url: str) -> str | None:
+        """path ของไฟล์สำหรับเล่น (เฉพาะไฟล์ที่อยู่ใน index และยังอยู่บนดิสก์ ผู้ใช้จึงสั่งเล่นไฟล์อื่นนอกคลังไม่ได้)"""
+        row = self._row_of(webpage_url)
+        if row is None:
+            return None
+        path = os.path.join(self.directory, row[4])
+        return path if os.path.isfile(path) else None
+
+    def _walk(self, unreadable: list[str]):
+        """คืน (path เทียบกับ directory, ขนาด, เวลาแก้ไข) ของไฟล์เพลงทุกไฟล์ (โฟลเดอร์ที่เปิดไม่ได้ถูกเพิ่มใน unreadable)"""
+        stack = [self.directory]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                print(f"ไม่สามารถอ่านโฟลเดอร์ของคลังเพลง '{directory}': {e}")
+                unreadable.append(os.path.relpath(directory, self.directory) + os.sep)
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(LIBRARY_EXTENSIONS):
+                        stat = entry.stat()
+                        yield os.path.relpath(entry.path, self.directory), stat.st_size, stat.st_mtime
+                except OSError: # ไฟล์ถูกลบระหว่างสแกน
+                    continue
+
+    def scan(self):
+        """สแกน directory แล้วปรับ index ให้ตรงกับไฟล์บนดิสก์ (ทำงานใน thread แยก)"""
+        if not os.path.isdir(self.directory): # เช่น ดิสก์ยังไม่ได้ mount ไม่ลบ index ทิ้งทั้งหมด
+            print(f"ไม่พบโฟลเดอร์ของคลังเพลง '{self.directory}' จึงข้ามการสแกน")
+            return
+        started_at = time.perf_counter()
+        try:
+            import mutagen # ไม่บังคับ: อ่าน tag ได้เร็วกว่าเปิด FFMPEG ทีละไฟล์มาก
+            read_tags = _read_tags_mutagen
+        except ImportError:
+            read_tags = _read_tags_ffmpeg
+        with self._lock:
+            known = {path: (size, mtime) for path, size, mtime in self._db.execute("SELECT path, size, mtime FROM library_files")}
+        seen, unreadable, changed = set(), [], []
+        changes = 0
+        for path, size, mtime in self._walk(unreadable):
+            seen.add(path)
+            if known.get(path) == (size, mtime):
+                continue
+            title, artist, album, duration = read_tags(os.path.join(self.directory, path))
+            changed.append((path, size, mtime, title or _title_from_filename(path), artist, album, duration))
+            if len(changed) >= LIBRARY_SCAN_BATCH:
+                self._write(changed, [])
+                changes += len(changed)
+                changed = []
+        removed = [path for path in known if path not in seen and not path.startswith(tuple(unreadable))]
+        self._write(changed, removed)
+        self.tracks = self._count()
+        self.scan_changes = changes + len(changed) + len(removed)
+        self.scan_seconds = time.perf_counter() - started_at
+
+    def _write(self, changed: list[tuple], removed: list[str]):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                # ON CONFLICT ... DO UPDATE เก็บ id เดิมไว้ เพลงที่อยู่ในคิวจึงยังเล่นไฟล์ที่แก้ tag แล้วได้
+                self._db.executemany(
+                    "INSERT INTO library_files (path, size, mtime, title, artist, album, duration) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, title = excluded.title, "
+                    "artist = excluded.artist, album = excluded.album, duration = excluded.duration", changed)
+                self._db.executemany("DELETE FROM library_files WHERE path = ?", [(path,) for path in removed])
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# --- ตัวจัดคิวงานดึงข้อมูลจาก yt-dlp ---
+EXTRACT_MAX_WORKERS = int(os.getenv("EXTRACT_MAX_WORKERS", "4"))                       # จำนวน thread ที่เรียก yt-dlp พร้อมกันได้
+EXTRACT_MAX_PENDING = int(os.getenv("EXTRACT_MAX_PENDING", "64"))                      # งานที่รอคิวได้ทั้งหมด ก่อนตอบว่า "ไม่ว่าง"
+EXTRACT_MAX_PENDING_PER_GUILD = int(os.getenv("EXTRACT_MAX_PENDING_PER_GUILD", "8"))  # งานที่รอคิวได้ต่อ guild
+
+# ลำดับความสำคัญของงาน (เลขน้อยได้ทำก่อน)
+PRIORITY_PLAYBACK = 0    # stream URL ของเพลงที่กำลังจะเล่น (ไม่ถูกปฏิเสธ และมี thread สำรองไว้ให้เสมอ)
+PRIORITY_INTERACTIVE = 1 # /play ที่ผู้ใช้กำลังรอคำตอบ
+PRIORITY_BACKGROUND = 2  # prefetch และการรีเฟรชข้อมูลเบื้องหลัง
+
+class ExtractionBusy(Exception):
+    """คิวงานดึงข้อมูลเต็ม จึงไม่รับงานใหม่"""
+
+class ExtractionScheduler:
+    """
+    รันงาน yt-dlp ใน thread pool ของตัวเอง (ไม่ใช้ default executor ร่วมกับส่วนอื่น)
+    เลือกงานตามลำดับความสำคัญก่อน แล้วสลับกันทีละ guild (round-robin) ภายในระดับเดียวกัน
+    เพื่อไม่ให้ guild เดียวแย่ง thread ทั้งหมด และปฏิเสธงานใหม่ทันทีเมื่อคิวเต็ม
+    """
+    def __init__(self, max_workers: int, max_pending: int, max_pending_per_guild: int):
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max_pending
+        self.max_pending_per_guild = max_pending_per_guild
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="extract")
+        # ต่อระดับความสำคัญ: {guild_id: deque ของ job} โดยลำดับ key คือลำดับ round-robin
+        self._queues = [collections.OrderedDict() for _ in (PRIORITY_PLAYBACK, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND)]
+        self._jobs_by_key = {}  # {key: job} สำหรับเลื่อนความสำคัญของงานที่ยังรออยู่
+        self._pending_per_guild = collections.Counter()
+        self.pending = 0
+        self.running = 0
+        self.rejected = 0
+
+    def submit(self, guild_id: int | None, fn, priority: int, key=None) -> asyncio.Future:
+        """ส่งงานเข้าคิว คืน future ของผลลัพธ์ หรือ raise ExtractionBusy ถ้าคิวเต็ม"""
+        if priority != PRIORITY_PLAYBACK and (self.pending >= self.max_pending or
+                                              self._pending_per_guild[guild_id] >= self.max_pending_per_guild):
+            self.rejected += 1
+            raise ExtractionBusy()
+        future = asyncio.get_running_loop().create_future()
+        job = [guild_id, fn, future, priority, key]
+        self._queues[priority].setdefault(guild_id, collections.deque()).append(job)
+        if key is not None:
+            self._jobs_by_key[key] = job
+        self.pending += 1
+        self._pending_per_guild[guild_id] += 1
+        self._dispatch()
+        return future
+
+    def promote(self, key, priority: int):
+        """เลื่อนงานที่ยังรอคิวอยู่ขึ้นไประดับความสำคัญที่สูงกว่า (เช่น prefetch ที่กลายเป็นเพลงที่ต้องเล่นทันที)"""
+        job = self._jobs_by_key.get(key)
+        if job is None or job[3] <= priority:
+            return
+        guild_id = job[0]
+        old_queue = self._queues[job[3]]
+        old_queue[guild_id].remove(job)
+        if not old_queue[guild_id]:
+            del old_queue[guild_id]
+        job[3] = priority
+        self._queues[priority].setdefault(guild_id, collections.deque()).append(job)
+        self._dispatch()
+
+    def _next_job(self) -> list | None:
+        # งานที่ไม่ใช่ playback ใช้ได้ไม่เกิน max_workers - 1 thread เพื่อให้เพลงถัดไปเริ่มได้เสมอ
+        levels = self._queues if self.running < self.max_workers - 1 or self.max_workers == 1 else self._queues[:1]
+        for guild_queues in levels:
+            if not guild_queues:
+                continue
+            guild_id, jobs = next(iter(guild_queues.items()))
+            job = jobs.popleft()
+            if jobs:
+                guild_queues.move_to_end(guild_id)
+            else:
+                del guild_queues[guild_id]
+            self.pending -= 1
+            self._pending_per_guild[guild_id] -= 1
+            if not self._pending_per_guild[guild_id]:
+                del self._pending_per_guild[guild_id]
+            if job[4] is not None and self._jobs_by_key.get(job[4]) is job:
+                del self._jobs_by_key[job[4]]
+            return job
+        return None
+
+    def _dispatch(self):
+        while self.running < self.max_workers:
+            job = self._next_job()
+            if job is None:
+                return
+            _, fn, future, _, _ = job
+            if future.cancelled(): # ผู้รอยกเลิกไปแล้วก่อนถึงคิว
+                continue
+            self.running += 1
+            executor_future = asyncio.get_running_loop().run_in_executor(self._executor, fn)
+            executor_future.add_done_callback(functools.partial(self._job_done, future))
+
+    def _job_done(self, future: asyncio.Future, executor_future: asyncio.Future):
+        self.running -= 1
+        if executor_future.cancelled():
+            future.cancel()
+        elif not future.cancelled():
+            if executor_future.exception() is not None:
+                future.set_exception(executor_future.exception())
+            else:
+                future.set_result(executor_future.result())
+        self._dispatch()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+class SingleFlight:
+    """
+    รวมการเรียกที่ key เดียวกันซึ่งเกิดขึ้นพร้อมกันให้ทำงานจริงเพียงครั้งเดียว
+    ผู้เรียกทุกคนรอผลจาก task เดียวกัน และนับจำนวนครั้งที่ประหยัดได้ไว้ดูสถิติ
+    """
+    def __init__(self):
+        self._inflight = {} # {key: asyncio.Task}
+        self.executed = 0   # จำนวนครั้งที่ทำงานจริง
+        self.coalesced = 0  # จำนวนครั้งที่ไปรอผลของงานที่ทำอยู่แล้วแทน
+
+    def __contains__(self, key) -> bool:
+        return key in self._inflight
+
+    def start(self, key, coro_factory) -> asyncio.Task:
+        """เริ่มงานของ key นี้ (หรือใช้งานที่กำลังทำอยู่แล้ว) คืน task ที่ผู้เรียกต้องรอผ่าน asyncio.shield"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(coro_factory())
+            self._inflight[key] = task
+            self.executed += 1
+
+            def _forget(done_task):
+                if self._inflight.get(key) is done_task:
+                    del self._inflight[key]
+            task.add_done_callback(_forget)
+        else:
+            self.coalesced += 1
+        return task
+
+    def forget(self, key):
+        """ให้การเรียกครั้งถัดไปของ key นี้เริ่มงานใหม่ (งานเดิมทำต่อจนจบ แต่ไม่มีผู้เรียกใหม่มารอผลของมัน)"""
+        self._inflight.pop(key, None)
+
+    async def do(self, key, coro_factory):
+        """รันงานของ key นี้ (หรือรอผลของงานที่กำลังทำอยู่แล้ว)"""
+        # shield: ผู้รอที่ถูกยกเลิกจะไม่ยกเลิกงานที่คนอื่นรออยู่ด้วย
+        return await asyncio.shield(self.start(key, coro_factory))
+
+class _PlaylistProgress:
+    """
+    เพลงของเพลย์ลิสต์ที่ yt-dlp ทยอยดึงมาได้แล้ว ผู้ขอเพลย์ลิสต์เดียวกันพร้อมกันทุกคนอ่านจากที่นี่ (แต่ละคนจำตำแหน่งที่อ่านถึงเอง)
+    """
+    def __init__(self):
+        self.songs = []
+        self.done = False
+        self.readers = 0
+        self.stop = threading.Event() # บอก thread ของ yt-dlp ให้หยุดเมื่อไม่มีใครอ่านแล้ว
+        self._arrived = asyncio.Event()
+
+    def add(self, song: dict):
+        self.songs.append(song)
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        self._arrived.set()
+        self._arrived = asyncio.Event()
+
+    def wait(self):
+        """awaitable ที่เสร็จเมื่อมีเพลงใหม่หรือดึงเสร็จ (ผูกกับ event ณ ตอนเรียก จึงไม่พลาดเพลงที่มาก่อนเริ่ม await)"""
+        return self._arrived.wait()
+
+# --- คิวเพลง ---
+QUEUE_MAX_LENGTH = int(os.getenv("QUEUE_MAX_LENGTH", "50")) # จำนวนเพลงสูงสุดในคิวเริ่มต้นของแต่ละ guild
+QUEUE_HARD_LIMIT = 10000                                     # ค่าสูงสุดที่ตั้งผ่าน /queuelimit ได้
+QUEUE_PAGE_SIZE = 10         # จำนวนเพลงต่อหน้าของ /queue
+QUEUE_TITLE_MAX_CHARS = 100  # ตัดชื่อเพลงที่ยาวเกินในรายการคิว (หนึ่งหน้าต้องไม่เกิน 4096 ตัวอักษรของ embed)
+QUEUE_VIEW_TIMEOUT = 180     # วินาที; ปุ่มเปลี่ยนหน้าของ /queue ใช้ได้นานเท่านี้
+
+class Track:
+    """ข้อมูลเพลงหนึ่งรายการในคิว (ใช้ __slots__ เพื่อประหยัดหน่วยความจำเมื่อคิวยาวหลายพันเพลง)"""
+    __slots__ = ('title', 'webpage_url', 'duration', 'thumbnail', 'requester',
+                 'stream_url', 'stream_expires', 'stream_acodec', 'stream_abr', 'is_partial', 'start_offset', '_queue_line')
+
+    def __init__(self, title: str, webpage_url: str | None, duration: float | None = None, thumbnail: str | None = None,
+                 requester: str = 'ไม่ระบุ', stream_url: str | None = None, stream_expires: float = 0,
+                 stream_acodec: str | None = None, stream_abr: float | None = None, is_partial: bool = True):
+        self.title = title
+        self.webpage_url = webpage_url
+        self.duration = duration
+        self.thumbnail = thumbnail
+        self.requester = requester
+        self.stream_url = stream_url
+        self.stream_expires = stream_expires
+        self.stream_acodec = stream_acodec
+        self.stream_abr = stream_abr
+        self.is_partial = is_partial
+        self.start_offset = 0.0 # วินาที; เริ่มเล่นจากตำแหน่งนี้ (ใช้ตอนกู้คืนเพลงที่เล่นค้างไว้หลังรีสตาร์ท)
+        self._queue_line = None
+
+    def to_record(self) -> dict:
+        """ข้อมูลที่จำเป็นสำหรับบันทึกลง journal (ไม่รวม stream URL เพราะหมดอายุ)"""
+        return {'title': self.title, 'webpage_url': self.webpage_url, 'duration': self.duration,
+                'thumbnail': self.thumbnail, 'requester': self.requester}
+
+    def queue_line(self) -> str:
+        """ข้อความของเพลงนี้ในรายการ /queue (ไม่รวมหมายเลข เพราะเปลี่ยนตามตำแหน่ง) สร้างครั้งเดียวแล้วใช้ซ้ำ"""
+        if self._queue_line is None:
+            title = self.title if len(self.title) <= QUEUE_TITLE_MAX_CHARS else self.title[:QUEUE_TITLE_MAX_CHARS - 3] + "..."
+            title = title.replace('[', '(').replace(']', ')') # กันไม่ให้ชื่อเพลงทำลิงก์ markdown เสีย
+            self._queue_line = f"[{title}]({_link_url(self.webpage_url)}) (ขอโดย: {self.requester})"
+        return self._queue_line
+
+    def apply_stream_info(self, stream_info: dict):
+        """ตั้งค่าข้อมูล stream จาก dict ของ _stream_info"""
+        for key, value in stream_info.items():
+            setattr(self, key, value)
+
+    def __repr__(self) -> str:
+        return f"Track({self.title!r}, {self.webpage_url!r})"
+
+class TrackQueue:
+    """
+    คิวเพลงที่เก็บใน list ธรรมดา: คิวยาวได้ไม่เกิน QUEUE_HARD_LIMIT การเพิ่ม/ลบ/ย้ายตามตำแหน่งจึงเป็นแค่ memmove ใน C
+    ใช้แทน collections.deque เดิม (มี maxlen, append, popleft, clear, len และวนอ่านได้เหมือนกัน)
+    และเพิ่ม insert/pop/move ตามตำแหน่ง, version และ listener สำหรับ journal
+    """
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self.version = 0 # เพิ่มขึ้นทุกครั้งที่คิวเปลี่ยน (ใช้ตรวจว่าสิ่งที่แสดงผลไว้ยังใช้ได้อยู่หรือไม่)
+        self.listener = None # callable(change) ที่รับ tuple ของการเปลี่ยนแปลง เช่น ('insert', index, track) ใช้บันทึก journal
+        self._items = []
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._items[index]
+        return self._items[self._normalize_index(index)]
+
+    def _normalize_index(self, index: int) -> int:
+        if index < 0:
+            index += len(self._items)
+        if not 0 <= index < len(self._items):
+            raise IndexError("ตำแหน่งในคิวไม่ถูกต้อง")
+        return index
+
+    def _changed(self, *change):
+        self.version += 1
+        if self.listener:
+            self.listener(change)
+
+    def append(self, track: Track):
+        self._items.append(track)
+        self._changed('append', track)
+
+    def extend(self, tracks):
+        for track in tracks:
+            self.append(track)
+
+    def insert(self, index: int, track: Track):
+        """แทรกเพลงที่ตำแหน่ง index (0 = หัวคิว)"""
+        index = max(0, min(index, len(self._items)))
+        self._items.insert(index, track)
+        self._changed('insert', index, track)
+
+    def pop(self, index: int = -1) -> Track:
+        """ลบและคืนเพลงที่ตำแหน่ง index"""
+        index = self._normalize_index(index)
+        track = self._items.pop(index)
+        self._changed('pop', index)
+        return track
+
+    def popleft(self) -> Track:
+        """เอาเพลงแรกออกจากคิว"""
+        if not self._items:
+            raise IndexError("คิวว่างเปล่า")
+        track = self._items.pop(0)
+        self._changed('pop', 0)
+        return track
+
+    def move(self, source: int, destination: int) -> Track:
+        """ย้ายเพลงจากตำแหน่ง source ไปอยู่ที่ตำแหน่ง destination (นับหลังจากเอาออกแล้ว)"""
+        track = self.pop(source)
+        self.insert(destination, track)
+        return track
+
+    def clear(self):
+        self._items = []
+        self._changed('clear')
+
+class QueuePageView(discord.ui.View):
+    """ปุ่มเปลี่ยนหน้าของ /queue (แต่ละหน้าสร้างจากแคชของ MusicCog จึงไม่ทำงานซ้ำถ้าคิวไม่เปลี่ยน)"""
+    def __init__(self, cog: 'MusicCog', guild_id: int, page: int, page_count: int):
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT)
+        self.cog = cog
+        self.guild_id = guild_id
+        self.page = page
+        self._update_buttons(page_count)
+
+    def _update_buttons(self, page_count: int):
+        self.previous_page.disabled = self.page <= 1
+        self.next_page.disabled = self.page >= page_count
+
+    async def _show(self, interaction: discord.Interaction, page: int):
+        embed, self.page, page_count = self.cog._queue_page_embed(self.guild_id, page)
+        self._update_buttons(page_count)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+# --- ตัดการเชื่อมต่ออัตโนมัติเมื่อไม่ได้ใช้งาน ---
+IDLE_TIMEOUT_SECONDS = float(os.getenv("IDLE_TIMEOUT_SECONDS", "60")) # ออกจากช่องเสียงหลังไม่ได้ใช้งานนานเท่านี้
+IDLE_WHEEL_TICK = 1.0   # วินาที; ความละเอียดของ timer
+IDLE_WHEEL_SLOTS = 64   # จำนวนช่องของ timer wheel (timer ที่ไกลกว่า 64 tick จะวนผ่านช่องเดิมหลายรอบ)
+
+class TimerWheel:
+    """
+    hashed timer wheel: ตั้ง/เลื่อน/ยกเลิก timer ได้ใน O(1) และใช้ task เดียวเดินเข็มทีละ tick สำหรับทุก timer
+    ใช้แทนการสร้าง asyncio.Task ที่ sleep หนึ่งตัวต่อหนึ่ง timer; callback(key) ถูกเรียกใน event loop เมื่อถึงเวลา
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, callback, tick: float, slots: int):
+        self._loop = loop
+        self._callback = callback
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)] # แต่ละช่อง: {key: tick ที่ครบกำหนด}
+        self._timers = {}                        # {key: หมายเลขช่อง}
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._resume_tick = 0 # tick ที่ตั้ง timer แรกหลังวงล้อว่าง (_run เดินเข็มต่อจากตรงนี้)
+        self.fired = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self._timers
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def _now_tick(self) -> int:
+        return int(time.monotonic() / self.tick)
+
+    def arm(self, key, delay: float):
+        """ตั้ง timer ให้ครบกำหนดในอีก delay วินาที (ถ้ามีอยู่แล้วจะเลื่อนเวลาใหม่)"""
+        self.cancel(key)
+        now = self._now_tick()
+        if not self._timers:
+            self._resume_tick = now
+        deadline = now + max(1, math.ceil(delay / self.tick))
+        index = deadline % len(self._slots)
+        self._slots[index][key] = deadline
+        self._timers[key] = index
+        if self._task is None or self._task.done():
+            self._task = self._loop.create_task(self._run())
+        self._wakeup.set()
+
+    def cancel(self, key):
+        index = self._timers.pop(key, None)
+        if index is not None:
+            del self._slots[index][key]
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self._timers.clear()
+        for slot in self._slots:
+            slot.clear()
+
+    async def _run(self):
+        current = self._resume_tick
+        while True:
+            if not self._timers:
+                # ไม่มี timer ให้รอจนกว่าจะมีการตั้งใหม่ แทนการตื่นทุก tick
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                # เดินต่อจาก tick ที่ตั้ง timer ไม่ใช่ tick ที่ตื่น: ถ้าตื่นช้ากว่ากำหนด ช่องที่ข้ามไปจะถูกไล่ทีละ tick ด้านล่าง
+                # แทนที่ timer จะรอจนเข็มวนกลับมาครบรอบ
+                current = self._resume_tick
+                continue
+            await asyncio.sleep(max(0.0, (current + 1) * self.tick - time.monotonic()))
+            now = self._now_tick()
+            while current < now: # ไล่ tick ที่ผ่านไปให้ครบ เผื่อ event loop ช้า
+                current += 1
+                slot = self._slots[current % len(self._slots)]
+                for key in [key for key, deadline in slot.items() if deadline <= current]:
+                    del slot[key]
+                    del self._timers[key]
+                    self.fired += 1
+                    try:
+                        self._callback(key)
+                    except Exception as e:
+                        print(f"เกิดข้อผิดพลาดใน timer '{key}': {e}")
+
+def _count_listeners(channel) -> int:
+    """จำนวนผู้ฟังในช่องเสียง (ไม่นับบอท)"""
+    return sum(1 for member in channel.members if not member.bot)
+
+# --- จำกัดจำนวน FFMPEG ที่เล่นเพลงพร้อมกัน และลดคุณภาพเมื่อเครื่องทำงานหนัก ---
+FFMPEG_MAX_PROCESSES = int(os.getenv("FFMPEG_MAX_PROCESSES", "0")) # จำนวน FFMPEG ที่เล่นเพลงพร้อมกันได้รวมทุก guild (0 = ไม่จำกัด)
+FFMPEG_LOAD_DEGRADED = float(os.getenv("FFMPEG_LOAD_DEGRADED", "0.8")) # load average ต่อ CPU core ที่เริ่มลดคุณภาพเสียงของเพลงที่เริ่มใหม่
+FFMPEG_LOAD_CRITICAL = float(os.getenv("FFMPEG_LOAD_CRITICAL", "1.5")) # load ที่ให้เพลงของเซิร์ฟเวอร์ที่ยังไม่ได้เล่นรอก่อน
+FFMPEG_LOAD_SAMPLE_SECONDS = 5.0  # อ่าน load average ใหม่ไม่บ่อยกว่านี้
+FFMPEG_LOAD_MAX_WAIT = 60.0       # รอเพราะ load สูงนานสุดเท่านี้แล้วเริ่มเล่นเลย (ยังรอช่องตาม FFMPEG_MAX_PROCESSES)
+# ตอนลดคุณภาพ: ใช้ volume แทน loudnorm, resample แบบถูกกว่า และเข้ารหัส Opus ด้วย complexity ต่ำลง
+FFMPEG_DEGRADED_RESAMPLE = 'aresample=48000:filter_size=8:phase_shift=6'
+FFMPEG_DEGRADED_OPUS_OPTIONS = '-compression_level 3'
+LOAD_NORMAL, LOAD_DEGRADED, LOAD_CRITICAL = 0, 1, 2
+
+class FFmpegGovernor:
+    """
+    นับ FFMPEG ที่เล่นเพลงอยู่ทั้ง process และดู load average ของเครื่อง เพื่อตัดสินว่าเพลงที่จะเริ่มใหม่
+    เริ่มได้ทันที ต้องลดคุณภาพ หรือต้องรอ (การเปลี่ยนเพลงของเซิร์ฟเวอร์ที่เล่นอยู่แล้วได้ช่องก่อนและไม่ต้องรอเพราะ load)
+    """
+    def __init__(self, max_processes: int):
+        self.max_processes = max_processes
+        self.running = 0
+        self.waiting = 0
+        self._transitions_waiting = 0
+        self._released = asyncio.Event()
+        self._load = 0.0
+        self._sampled_at = float('-inf')
+        self.queued_starts = 0   # เพลงที่ต้องรอก่อนเริ่ม
+        self.degraded_starts = 0 # เพลงที่เริ่มแบบลดคุณภาพ
+        self.load_bypassed = 0   # เพลงที่รอเพราะ load จนครบ FFMPEG_LOAD_MAX_WAIT แล้วเริ่มเลย
+
+    @property
+    def load(self) -> float:
+        """load average 1 นาทีต่อ CPU core (0 ถ้าระบบไม่รองรับ)"""
+        now = time.monotonic()
+        if now - self._sampled_at >= FFMPEG_LOAD_SAMPLE_SECONDS:
+            self._sampled_at = now
+            try:
+                self._load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            except (AttributeError, OSError):
+                self._load = 0.0
+        return self._load
+
+    @property
+    def level(self) -> int:
+        load = self.load
+        if load >= FFMPEG_LOAD_CRITICAL:
+            return LOAD_CRITICAL
+        return LOAD_DEGRADED if load >= FFMPEG_LOAD_DEGRADED else LOAD_NORMAL
+
+    def degraded(self) -> bool:
+        """ควรลดคุณภาพของ FFMPEG ที่กำลังจะเปิดหรือไม่ (นับสถิติด้วย)"""
+        if self.level >= LOAD_DEGRADED:
+            self.degraded_starts += 1
+            return True
+        return False
+
+    def _has_slot(self) -> bool:
+        return not self.max_processes or self.running < self.max_processes
+
+    def try_acquire(self) -> bool:
+        """จองช่องโดยไม่รอ (ใช้กับงานที่ข้ามได้ เช่น preload) ไม่จองถ้ามีเพลงรออยู่หรือเครื่องเริ่มทำงานหนัก"""
+        if self._has_slot() and not self.waiting and self.level == LOAD_NORMAL:
+            self.running += 1
+            return True
+        return False
+
+    async def acquire(self, transition: bool, on_wait) -> None:
+        """
+        รอจนกว่าจะเปิด FFMPEG ได้แล้วจองช่อง transition=True คือเพลงถัดไปของเซิร์ฟเวอร์ที่กำลังเล่นอยู่
+        on_wait() ถูกเรียกครั้งเดียวเมื่อต้องรอ ใช้แจ้งผู้ใช้
+        """
+        if self._can_start(transition, waited=0.0):
+            self.running += 1
+            return
+        self.queued_starts += 1
+        self.waiting += 1
+        self._transitions_waiting += transition
+        started_at = time.monotonic()
+        try:
+            on_wait()
+            while not self._can_start(transition, time.monotonic() - started_at):
+                self._released.clear()
+                try:
+                    await asyncio.wait_for(self._released.wait(), FFMPEG_LOAD_SAMPLE_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiting -= 1
+            self._transitions_waiting -= transition
+        if not transition and self.level == LOAD_CRITICAL:
+            self.load_bypassed += 1
+        self.running += 1
+
+    def _can_start(self, transition: bool, waited: float) -> bool:
+        if not self._has_slot():
+            return False
+        if transition:
+            return True
+        # เซิร์ฟเวอร์ที่ยังไม่ได้เล่นให้เซิร์ฟเวอร์ที่กำลังเปลี่ยนเพลงได้ช่องก่อน และรอ load ลดลง (ไม่เกิน FFMPEG_LOAD_MAX_WAIT)
+        return not self._transitions_waiting and (self.level < LOAD_CRITICAL or waited >= FFMPEG_LOAD_MAX_WAIT)
+
+    def release(self):
+        """คืนช่องเมื่อ FFMPEG ปิดแล้ว (เรียกใน event loop)"""
+        self.running -= 1
+        self._released.set()
+
+class _GovernedSource(discord.AudioSource):
+    """ครอบ audio source ของ FFMPEG เพื่อคืนช่องให้ FFmpegGovernor เมื่อ source ถูก cleanup (จาก thread ใดก็ได้)"""
+    def __init__(self, source: discord.AudioSource, release):
+        self.source = source
+        self._release = release # เรียกครั้งเดียว
+
+    def read(self) -> bytes:
+        return self.source.read()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+        release, self._release = self._release, None
+        if release:
+            release()
+
+# --- เปิด FFMPEG ของเพลงถัดไปล่วงหน้า (preload) และ crossfade ---
+PRELOAD_SECONDS = float(os.getenv("PRELOAD_SECONDS", "0"))        # เปิด FFMPEG ของเพลงถัดไปก่อนเพลงปัจจุบันจบเท่านี้ (0 = ปิด)
+PRELOAD_MAX_SOURCES = int(os.getenv("PRELOAD_MAX_SOURCES", "4"))  # จำนวน FFMPEG ที่เปิดรอไว้ได้พร้อมกันรวมทุก guild (guild ละไม่เกิน 1)
+PRELOAD_WARM_FRAMES = 5 # อ่านแพ็กเก็ตแรกเก็บไว้ก่อน (5 × 20 ms) เพื่อให้ FFMPEG เชื่อมต่อและ probe เสร็จ
+# ผสมเสียงท้ายเพลงกับต้นเพลงถัดไปนานเท่านี้ (0 = ปิด) ใช้ได้เฉพาะเสียงแบบ PCM และต้องเปิด preload ก่อนเริ่ม crossfade อย่างน้อย 1 วินาที
+CROSSFADE_SECONDS = max(0.0, min(float(os.getenv("CROSSFADE_SECONDS", "0")), PRELOAD_SECONDS - 1))
+PCM_FRAME_SECONDS = 0.02
+
+class _PreloadedSource(discord.AudioSource):
+    """audio source ของเพลงถัดไปที่เปิด FFMPEG และอ่านแพ็กเก็ตแรก ๆ เก็บไว้แล้ว จึงเริ่มเล่นได้ทันทีเมื่อถึงคิว"""
+    def __init__(self, source: discord.AudioSource, stream_url: str, from_cache: bool):
+        self.source = source
+        self.stream_url = stream_url
+        self.from_cache = from_cache # เล่นจากไฟล์ใน AudioCache
+        self._frames = collections.deque()
+
+    def warm(self):
+        """อ่านแพ็กเก็ตแรกเก็บไว้ (blocking จนกว่า FFMPEG จะพร้อม จึงต้องเรียกใน thread แยก)"""
+        for _ in range(PRELOAD_WARM_FRAMES):
+            data = self.source.read()
+            self._frames.append(data)
+            if not data:
+                return
+
+    def read(self) -> bytes:
+        if self._frames:
+            return self._frames.popleft()
+        return self.source.read()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+def _mix_pcm(first: bytes, second: bytes, first_gain: float, second_gain: float) -> bytes:
+    """
+    ผสมเฟรม PCM 16-bit สองเฟรมที่ยาวเท่ากันตามน้ำหนักที่กำหนด (ตัดค่าที่เกินช่วง 16-bit)
+    ใช้ audioop (C) เหมือน PCMVolumeTransformer ของ discord.py เพราะถูกเรียกใน thread ของ voice client ทุก 20 ms
+    """
+    return audioop.add(audioop.mul(first, 2, first_gain), audioop.mul(second, 2, second_gain), 2)
+
+class _CrossfadeSource(discord.AudioSource):
+    """
+    ค่อย ๆ ลดเสียงเพลงที่กำลังเล่น (outgoing) พร้อมเพิ่มเสียงเพลงถัดไป (incoming) ภายใน frames เฟรม แล้วเล่น incoming ต่อ
+    ใช้แทน source เดิมของ voice client (voice_client.source = ...) การเล่นจึงต่อเนื่องโดยไม่ต้องเริ่ม play() ใหม่
+    """
+    def __init__(self, outgoing: discord.AudioSource, incoming: discord.AudioSource, frames: int):
+        self.outgoing = outgoing
+        self.incoming = incoming
+        self.frames = frames
+        self._frame = 0
+
+    def read(self) -> bytes:
+        data = self.incoming.read()
+        if self.outgoing is None or not data:
+            return data
+        self._frame += 1
+        tail = self.outgoing.read()
+        if len(tail) != len(data) or self._frame >= self.frames: # เพลงเดิมจบก่อน หรือ crossfade ครบแล้ว
+            self.outgoing.cleanup()
+            self.outgoing = None
+            return data
+        gain = self._frame / self.frames
+        return _mix_pcm(tail, data, 1.0 - gain, gain)
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        if self.outgoing is not None:
+            self.outgoing.cleanup()
+            self.outgoing = None
+        self.incoming.cleanup()
+
+# --- โหมดกระจายเสียง (broadcast): ถอดรหัส/เข้ารหัสครั้งเดียวแล้วส่งแพ็กเก็ต Opus เดียวกันให้หลาย guild ---
+BROADCAST_MAX_STATIONS = int(os.getenv("BROADCAST_MAX_STATIONS", "4")) # จำนวนสถานีที่เปิดพร้อมกันได้ (0 = ปิด /broadcast)
+BROADCAST_BITRATE = int(os.getenv("BROADCAST_BITRATE", "96000"))      # bps ของ Opus ที่เข้ารหัสครั้งเดียวให้ทุกห้อง
+BROADCAST_BUFFER_FRAMES = 50  # แพ็กเก็ตล่าสุดที่เก็บไว้ (50 × 20 ms) ผู้ฟังที่ช้ากว่านี้จะถูกข้ามไปตำแหน่ง live
+BROADCAST_READ_TIMEOUT = 0.1  # วินาทีที่ผู้ฟังรอแพ็กเก็ตใหม่ ก่อนส่งความเงียบแทน (เช่น ระหว่างเปลี่ยนเพลง)
+OPUS_SILENCE_FRAME = b'\xf8\xff\xfe'
+
+def _station_key(name: str) -> str:
+    return " ".join(name.casefold().split())
+
+class OpusRingBuffer:
+    """
+    ring buffer ของแพ็กเก็ต Opus ที่มีผู้เขียนหนึ่งคน (thread ของ BroadcastStation) และผู้อ่านหลายคน (thread ของ voice client แต่ละ guild)
+    แพ็กเก็ตมีเลขลำดับต่อเนื่อง ผู้อ่านแต่ละคนเก็บลำดับของตัวเอง ผู้เขียนจึงไม่เคยรอผู้อ่าน
+    ผู้อ่านที่ช้าจนแพ็กเก็ตถูกเขียนทับจะถูกข้ามไปแพ็กเก็ตล่าสุด
+    """
+    def __init__(self, size: int):
+        self._frames = [b''] * size
+        self._size = size
+        self._cond = threading.Condition()
+        self.head = 0 # ลำดับของแพ็กเก็ตถัดไปที่จะเขียน
+        self.closed = False
+        self.skipped = 0 # แพ็กเก็ตที่ผู้อ่านที่ช้าไม่ได้อ่าน
+
+    def write(self, frame: bytes):
+        with self._cond:
+            self._frames[self.head % self._size] = frame
+            self.head += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def read(self, seq: int, timeout: float) -> tuple[bytes | None, int]:
+        """คืนค่า (แพ็กเก็ตลำดับ seq, ลำดับถัดไป) แพ็กเก็ตเป็น None ถ้าไม่มีแพ็กเก็ตใหม่ภายใน timeout และ b'' เมื่อปิดแล้ว"""
+        with self._cond:
+            if seq >= self.head and not self.closed:
+                self._cond.wait(timeout)
+            if self.closed:
+                return b'', seq
+            if seq >= self.head:
+                return None, seq
+            if self.head - seq > self._size:
+                self.skipped += self.head - 1 - seq
+                seq = self.head - 1
+            return self._frames[seq % self._size], seq + 1
+
+class _BroadcastListener(discord.AudioSource):
+    """audio source ของหนึ่ง guild ที่อ่านแพ็กเก็ต Opus จาก OpusRingBuffer ของสถานี (เริ่มที่ตำแหน่ง live)"""
+    def __init__(self, buffer: OpusRingBuffer):
+        self.buffer = buffer
+        self.seq = buffer.head
+
+    def read(self) -> bytes:
+        frame, self.seq = self.buffer.read(self.seq, BROADCAST_READ_TIMEOUT)
+        # ส่งความเงียบแทนการคืน b'' ซึ่งจะทำให้ discord.py หยุดเล่น
+        return OPUS_SILENCE_FRAME if frame is None else frame
+
+    def is_opus(self) -> bool:
+        return True
+
+class BroadcastStation:
+    """
+    สถานีกระจายเสียงหนึ่งสถานี: เล่นเพลงใน tracks ทีละเพลงด้วย FFMPEG ตัวเดียว (เข้ารหัส Opus ใน FFMPEG)
+    thread ของสถานีอ่านแพ็กเก็ตตามเวลาจริง (20 ms ต่อแพ็กเก็ต) ลง OpusRingBuffer แล้วทุก guild ที่ฟังอยู่อ่านจาก buffer เดียวกัน
+    CPU จึงขึ้นกับจำนวนสถานี ไม่ใช่จำนวน guild; ลำดับเพลงทำงานใน event loop ส่วน thread แค่อ่านแพ็กเก็ต
+    """
+    def __init__(self, name: str, owner_guild_id: int, loop: asyncio.AbstractEventLoop):
+        self.name = name
+        self.owner_guild_id = owner_guild_id
+        self.loop = loop
+        self.tracks = collections.deque() # Track ที่รอเล่น
+        self.current = None               # Track ที่กำลังเล่น
+        self.listeners = set()            # guild_id ที่กำลังฟัง
+        self.loading = False              # กำลังทยอยเพิ่มเพลงจากเพลย์ลิสต์
+        self.buffer = OpusRingBuffer(BROADCAST_BUFFER_FRAMES)
+        self._source = None               # audio source (Opus) ของเพลงปัจจุบันที่ thread กำลังอ่าน
+        self._source_ended = None         # asyncio.Future ที่ thread ตั้งค่าเมื่อเพลงปัจจุบันจบ
+        self._wake = threading.Event()    # ปลุก thread เมื่อมีเพลงใหม่หรือปิดสถานี
+        self._more_tracks = asyncio.Event()
+        self._thread = None
+        self._task = None
+
+    def subscribe(self, guild_id: int) -> _BroadcastListener:
+        self.listeners.add(guild_id)
+        return _BroadcastListener(self.buffer)
+
+    def unsubscribe(self, guild_id: int):
+        self.listeners.discard(guild_id)
+
+    def add_tracks(self, tracks):
+        self.tracks.extend(tracks)
+        self._more_tracks.set()
+
+    def finish_loading(self):
+        self.loading = False
+        self._more_tracks.set()
+
+    def start(self, open_source, on_closed):
+        """
+        เริ่มเล่น open_source(track) คือ coroutine ที่คืน audio source แบบ Opus ของเพลง (หรือ None ถ้าเปิดไม่ได้)
+        on_closed(station) ถูกเรียกเมื่อสถานีปิด (เพลงหมด ไม่มีผู้ฟัง หรือถูกสั่งปิด)
+        """
+        self._thread = threading.Thread(target=self._produce, name=f"broadcast-{self.name}", daemon=True)
+        self._thread.start()
+        self._task = self.loop.create_task(self._run(open_source))
+        self._task.add_done_callback(lambda _: on_closed(self))
+
+    def close(self):
+        """ปิดสถานี ผู้ฟังทุก guild จะได้ b'' และ discord.py เรียก after ของแต่ละ guild"""
+        self.buffer.close()
+        self._wake.set()
+        if self._task:
+            self._task.cancel()
+
+    @property
+    def closed(self) -> bool:
+        return self.buffer.closed
+
+    async def _run(self, open_source):
+        try:
+            while True:
+                if not self.tracks:
+                    if not self.loading:
+                        break
+                    self._more_tracks.clear()
+                    await self._more_tracks.wait()
+                    continue
+                if not self.listeners and self.current is not None:
+                    break # ไม่มีใครฟังแล้ว ไม่ต้องเปิดเพลงถัดไป
+                self.current = self.tracks.popleft()
+                source = await open_source(self.current)
+                if source is None:
+                    continue
+                self._source_ended = self.loop.create_future()
+                self._source = source
+                self._wake.set()
+                try:
+                    await self._source_ended
+                finally:
+                    self._source = None
+                    source.cleanup()
+        finally:
+            self.current = None
+            self.buffer.close()
+            self._wake.set()
+
+    def _produce(self):
+        next_at = time.perf_counter()
+        while not self.buffer.closed:
+            source = self._source
+            if source is None:
+                self._wake.wait(BROADCAST_READ_TIMEOUT)
+                self._wake.clear()
+                next_at = time.perf_counter() # เริ่มนับเวลาใหม่ ไม่ส่งแพ็กเก็ตที่ค้างรวดเดียว
+                continue
+            try:
+                frame = source.read()
+            except Exception as e:
+                if not self.buffer.closed: # ถูกปิดระหว่างอ่าน (source ถูก cleanup แล้ว) ไม่ใช่ข้อผิดพลาด
+                    print(f"เกิดข้อผิดพลาดขณะอ่านเสียงของสถานี '{self.name}': {e}")
+                frame = b''
+            if not frame:
+                ended, self._source = self._source_ended, None
+                self.loop.call_soon_threadsafe(lambda: ended.done() or ended.set_result(None))
+                continue
+            self.buffer.write(frame)
+            # FFMPEG อ่าน stream ช้ากว่าเวลาจริง (เช่น เครือข่ายสะดุด) ให้เริ่มนับใหม่ แทนการส่งแพ็กเก็ตที่ค้างรวดเดียว
+            next_at = max(next_at + PCM_FRAME_SECONDS, time.perf_counter() - BROADCAST_READ_TIMEOUT)
+            time.sleep(max(0.0, next_at - time.perf_counter()))
+
+# --- ข้อความเพลงที่กำลังเล่น (แก้ไขข้อความเดิมแทนการส่งใหม่) ---
+NOW_PLAYING_EDIT_INTERVAL = float(os.getenv("NOW_PLAYING_EDIT_INTERVAL", "3"))     # วินาที; แก้ข้อความของแต่ละ guild ไม่ถี่กว่านี้
+NOW_PLAYING_REFRESH_SECONDS = float(os.getenv("NOW_PLAYING_REFRESH_SECONDS", "0")) # อัปเดตแถบความคืบหน้าทุก ๆ เท่านี้ระหว่างเล่น (0 = เฉพาะตอนสถานะเปลี่ยน)
+NOW_PLAYING_UP_NEXT = 3     # จำนวนเพลงถัดไปที่แสดง
+NOW_PLAYING_MAX_NOTICES = 5 # จำนวนข้อความแจ้งเตือน (เช่น เพลงที่ข้ามไป) ที่แสดงต่อการเปลี่ยนเพลงหนึ่งครั้ง
+PROGRESS_BAR_WIDTH = 16
+
+def _progress_bar(position: float, duration: float) -> str:
+    filled = min(PROGRESS_BAR_WIDTH - 1, max(0, int(position / duration * PROGRESS_BAR_WIDTH)))
+    return "▬" * filled + "🔘" + "▬" * (PROGRESS_BAR_WIDTH - 1 - filled)
+
+class CoalescedMessage:
+    """
+    ข้อความหนึ่งข้อความในช่องข้อความที่แก้ไขแทนการส่งใหม่ (ใช้กับข้อความเพลงที่กำลังเล่นของแต่ละ guild)
+    update() แค่บอกว่าสถานะเปลี่ยน การเปลี่ยนแปลงที่เกิดถี่ ๆ ถูกรวมเป็นการเรียก API ไม่เกินหนึ่งครั้งต่อ interval
+    render() ถูกเรียกตอนจะเขียนจริงเท่านั้น ข้อความจึงแสดงสถานะล่าสุดเสมอ และไม่เขียนถ้าเนื้อหาไม่ต่างจากเดิม
+    stats เป็น Counter ที่ใช้ร่วมกันทุก guild: updates, writes, coalesced (รวมกับการเขียนที่รออยู่), unchanged (เนื้อหาเดิม)
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, render, interval: float, stats: collections.Counter):
+        self.loop = loop
+        self.render = render # callable() -> kwargs ของ send/edit เช่น {'embed': discord.Embed}
+        self.interval = interval
+        self.stats = stats
+        self.channel = None  # ช่องข้อความที่จะแสดง
+        self.message = None  # discord.Message ที่ส่งไปแล้ว
+        self._repost = False
+        self._written = None # เนื้อหาที่เขียนล่าสุด (ใช้ข้ามการเขียนที่ไม่เปลี่ยนอะไร)
+        self._last_write = -math.inf
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def update(self, channel=None, repost: bool = False):
+        """นัดเขียนสถานะล่าสุด repost=True ส่งเป็นข้อความใหม่ถ้าข้อความเดิมถูกข้อความอื่นดันขึ้นไปแล้ว"""
+        if channel is not None:
+            self.channel = channel
+        self._repost = self._repost or repost
+        self.stats['updates'] += 1
+        if self._task is None:
+            self._task = self.loop.create_task(self._flush())
+        else:
+            self.stats['coalesced'] += 1
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _flush(self):
+        delay = self._last_write + self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._task = None # update ที่มาระหว่างเขียนจะนัดเขียนครั้งถัดไปหลังครบ interval
+        async with self._lock:
+            await self._write()
+
+    async def _write(self):
+        channel = self.channel
+        if not isinstance(channel, discord.TextChannel):
+            return
+        kwargs = self.render()
+        content = {key: value.to_dict() if isinstance(value, discord.Embed) else value for key, value in kwargs.items()}
+        message, repost, self._repost = self.message, self._repost, False
+        if message is not None and message.channel.id != channel.id:
+            message = None # ย้ายไปช่องข้อความอื่น ข้อความในช่องเดิมคงไว้ตามเดิม
+        # ส่งใหม่เมื่อมีข้อความอื่นต่อท้ายข้อความเดิมแล้ว ผู้ใช้จะได้ไม่ต้องเลื่อนขึ้นไปหา
+        repost = repost and message is not None and channel.last_message_id != message.id
+        if message is not None and not repost and content == self._written:
+            self.stats['unchanged'] += 1
+            return
+        self._last_write = time.monotonic()
+        try:
+            if message is not None and not repost:
+                self.stats['writes'] += 1
+                try:
+                    self.message = await message.edit(**kwargs)
+                    self._written = content
+                    return
+                except discord.NotFound: # ข้อความถูกลบไปแล้ว ส่งใหม่แทน
+                    message = None
+            self.stats['writes'] += 1
+            self.message = await channel.send(**kwargs)
+            self._written = content
+        except discord.HTTPException as e:
+            print(f"ไม่สามารถอัปเดตข้อความในช่อง {channel.id}: {e}")
+            return
+        if message is not None:
+            self.stats['writes'] += 1
+            with contextlib.suppress(discord.HTTPException):
+                await message.delete()
+
+# --- ตัวเล่นเพลงของแต่ละ guild ---
+PLAYER_PLAY = 'play'   # มีเพลงเพิ่มเข้าคิว (เริ่มเล่นถ้ายังไม่ได้เล่นอยู่)
+PLAYER_SKIP = 'skip'   # ข้ามเพลงปัจจุบัน
+PLAYER_ENDED = 'ended' # เพลงเล่นจบ (ส่งมาจาก thread ของ discord.py)
+PLAYER_ERROR = 'error' # เพลงหยุดเพราะเกิดข้อผิดพลาดระหว่างเล่น
+PLAYER_PRELOAD = 'preload'     # เพลงปัจจุบันใกล้จบ เปิด FFMPEG ของเพลงถัดไปรอไว้
+PLAYER_CROSSFADE = 'crossfade' # เพลงปัจจุบันเหลือ CROSSFADE_SECONDS เริ่มผสมเสียงกับเพลงถัดไป
+PLAYER_BROADCAST = 'broadcast' # เปลี่ยนไปฟังสถานี broadcast (payload = BroadcastStation หรือ None = กลับมาเล่นคิวของตัวเอง)
+
+class GuildPlayer:
+    """
+    สถานะทั้งหมดของหนึ่ง guild (voice client, คิว, เพลงที่กำลังเล่น, timer) พร้อมลูปการเล่นเพลงหนึ่ง task ที่ทำงานตาม event ทีละตัว
+    การเปลี่ยนเพลงทุกครั้งเกิดในลูปนี้ที่เดียว จึงไม่มีการเริ่มเพลงซ้อนกันและไม่ต้องเก็บ Interaction ไว้ตลอดการเล่น
+    """
+    __slots__ = ('cog', 'guild_id', 'queue', 'voice_client', 'current',
+                 'text_channel', 'idle_channel', 'listeners',
+                 'prefetch_task', 'preload', 'queue_pages', 'now_playing', 'notices', 'broadcast',
+                 'play_requested_at', 'track_started', 'paused_at', 'journaled_session',
+                 'transitions', 'transition_total', 'transition_max',
+                 '_events', '_task', '_generation')
+
+    def __init__(self, cog: 'MusicCog', guild_id: int, queue: TrackQueue):
+        self.cog = cog
+        self.guild_id = guild_id
+        self.queue = queue
+        self.voice_client = None  # discord.VoiceClient
+        self.current = None       # Track ที่กำลังเล่น (หรือกำลังเตรียมเล่น)
+        self.text_channel = None  # ช่องข้อความล่าสุดที่สั่งเล่นเพลง ใช้แจ้งเพลงที่กำลังเล่น
+        self.idle_channel = None  # ช่องข้อความที่จะแจ้งเมื่อออกจากช่องเสียงเพราะไม่ได้ใช้งาน
+        self.listeners = 0        # จำนวนผู้ฟัง (ไม่นับบอท) ในช่องเสียงของบอท อัปเดตจาก on_voice_state_update
+        self.prefetch_task = None # asyncio.Task (ดึง stream URL ของเพลงถัดไปล่วงหน้า)
+        self.preload = None       # (Track, asyncio.Task ที่คืน _PreloadedSource) ของเพลงถัดไป เมื่อเปิด preload
+        self.queue_pages = None   # (((queue.version, queue.maxlen), เพลงที่กำลังเล่น), {หน้า: discord.Embed}) แคชหน้าของ /queue
+        self.now_playing = None   # CoalescedMessage ของเพลงที่กำลังเล่น (สร้างเมื่อมีเพลงเล่นในช่องข้อความครั้งแรก)
+        self.notices = []         # ข้อความแจ้งเตือนของการเปลี่ยนเพลงครั้งล่าสุด (เช่น เพลงที่ข้ามไป) แสดงในข้อความเพลงที่กำลังเล่น
+        self.broadcast = None     # BroadcastStation ที่กำลังฟังอยู่ (ระหว่างนั้นคิวของ guild รอไว้ก่อน)
+        self.play_requested_at = None # time.perf_counter() ตอนที่ /play สั่งเล่นขณะไม่มีเพลงเล่นอยู่ (ใช้เมื่อเปิด metrics)
+        self.track_started = 0.0  # time.monotonic() ตอนที่เพลงปัจจุบันอยู่ที่วินาทีที่ 0 (เลื่อนออกไปตามเวลาที่หยุดชั่วคราว)
+        self.paused_at = None     # time.monotonic() ตอนที่หยุดชั่วคราว
+        self.journaled_session = None # (voice channel id, text channel id) ที่บันทึกลง journal ล่าสุด
+        # เวลาตั้งแต่เพลงก่อนหน้าจบ/ถูกข้ามจนเพลงถัดไปเริ่มเล่น (วินาที)
+        self.transitions = 0
+        self.transition_total = 0.0
+        self.transition_max = 0.0
+        self._events = asyncio.Queue()
+        self._task = None
+        self._generation = 0 # เพิ่มขึ้นทุกครั้งที่เริ่ม/หยุดเพลง ใช้ทิ้ง event จบเพลงของเพลงก่อนหน้า
+
+    @property
+    def is_playing(self) -> bool:
+        return self.current is not None or self.broadcast is not None
+
+    def position(self) -> float:
+        """วินาทีที่เล่นเพลงปัจจุบันไปแล้ว"""
+        if self.current is None:
+            return 0.0
+        return (self.paused_at or time.monotonic()) - self.track_started
+
+    def pause(self):
+        self.voice_client.pause()
+        self.paused_at = time.monotonic()
+        # หยุดนานเท่าไรก็ได้ จึงไม่เก็บ FFMPEG ของเพลงถัดไปไว้ระหว่างหยุด
+        self.cog._cancel_track_timers(self.guild_id)
+        self.cog._discard_preload(self)
+        self.cog._update_now_playing(self)
+
+    def resume(self):
+        self.voice_client.resume()
+        if self.paused_at is not None:
+            self.track_started += time.monotonic() - self.paused_at
+            self.paused_at = None
+        self.cog._arm_track_timers(self)
+        self.cog._update_now_playing(self)
+
+    def post(self, event: str, payload=None):
+        """ส่ง event เข้าลูปการเล่นเพลง (เริ่มลูปถ้ายังไม่ทำงาน) ต้องเรียกจาก event loop"""
+        if self._task is None or self._task.done():
+            self._task = self.cog.loop.create_task(self._run())
+        self._events.put_nowait((event, payload))
+
+    def reset(self):
+        """ล้างสถานะการเล่นเมื่อบอทออกจากช่องเสียง (เพลงในคิวยังอยู่ ยกเว้นผู้เรียกจะล้างเอง)"""
+        self._generation += 1
+        self.current = None
+        self._leave_broadcast()
+        self.voice_client = None
+        self.play_requested_at = None
+        self.cog._cancel_idle_timer(self.guild_id)
+        self.cog._cancel_prefetch(self.guild_id)
+        self.cog._cancel_track_timers(self.guild_id)
+        self.cog._discard_preload(self)
+        self.cog._record_current(self)
+        self.cog._record_session(self)
+        self.cog._update_now_playing(self)
+
+    def close(self):
+        """หยุดลูปการเล่นเพลง (ตอน unload cog)"""
+        if self._task:
+            self._task.cancel()
+        if self.now_playing:
+            self.now_playing.close()
+
+    def _track_finished(self, generation: int, error: Exception | None):
+        """callback after= ของ voice_client.play (ทำงานใน thread ของ discord.py)"""
+        event = PLAYER_ERROR if error else PLAYER_ENDED
+        self.cog.loop.call_soon_threadsafe(self.post, event, (generation, error, time.perf_counter()))
+
+    async def _run(self):
+        while True:
+            event, payload = await self._events.get()
+            try:
+                await self._handle(event, payload)
+            except Exception as e:
+                print(f"เกิดข้อผิดพลาดในลูปการเล่นเพลงของ Guild {self.guild_id}: {e}")
+                self.current = None
+
+    async def _handle(self, event: str, payload):
+        if event == PLAYER_PLAY:
+            if self.broadcast is not None:
+                return # เล่นต่อหลังออกจาก broadcast
+            if self.current is None:
+                await self._advance()
+            else:
+                self.cog._schedule_prefetch(self.guild_id) # กำลังเล่นเพลงอื่นอยู่ เตรียม URL ของเพลงที่เพิ่งเพิ่มไว้ก่อน
+        elif event == PLAYER_SKIP:
+            if self.current is not None:
+                started_at = time.perf_counter()
+                self._generation += 1 # event จบเพลงที่ตามมาจาก stop() จะถูกทิ้ง
+                if self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused()):
+                    self.voice_client.stop()
+                await self._advance(started_at)
+        elif event == PLAYER_PRELOAD:
+            if self.current is not None and self.queue:
+                self.cog._start_preload(self, self.queue[0])
+        elif event == PLAYER_CROSSFADE:
+            if self.current is not None and self.queue and self.cog._crossfade(self, self.queue[0]):
+                # เพลงถัดไปเริ่มแล้วใน source เดิม event จบเพลงของ generation นี้จึงหมายถึงเพลงถัดไปจบ
+                self.current = self.queue.popleft()
+                self.notices.clear()
+                self.cog._record_current(self)
+                self.cog._arm_track_timers(self)
+                self.cog._schedule_prefetch(self.guild_id)
+                self.cog._update_now_playing(self, repost=True)
+        elif event == PLAYER_BROADCAST:
+            await self._tune(payload)
+        else:
+            generation, error, ended_at = payload
+            if generation != self._generation:
+                return
+            if error:
+                print(f"เกิดข้อผิดพลาดระหว่างเล่นเพลงใน Guild {self.guild_id}: {error}")
+            self._leave_broadcast() # สถานีที่ฟังอยู่ปิดแล้ว กลับมาเล่นคิวของตัวเอง
+            await self._advance(ended_at)
+
+    def _leave_broadcast(self):
+        if self.broadcast is not None:
+            self.broadcast.unsubscribe(self.guild_id)
+            self.broadcast = None
+
+    async def _tune(self, station: 'BroadcastStation | None'):
+        """เปลี่ยนไปฟังสถานี broadcast หรือกลับมาเล่นคิวของตัวเอง (เพลงที่เล่นค้างอยู่กลับไปไว้หัวคิวพร้อมตำแหน่งเดิม)"""
+        if station is self.broadcast:
+            return
+        self._generation += 1 # event จบเพลงที่ตามมาจาก stop() จะถูกทิ้ง
+        self.cog._cancel_track_timers(self.guild_id)
+        self.cog._discard_preload(self)
+        self._leave_broadcast()
+        if self.current is not None and station is not None:
+            self.current.start_offset = self.position()
+            self.queue.insert(0, self.current)
+            self.current = None
+            self.cog._record_current(self)
+        if self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused()):
+            self.voice_client.stop()
+        if station is None:
+            await self._advance()
+            return
+        if not self.voice_client or not self.voice_client.is_connected() or station.closed:
+            return
+        self.broadcast = station
+        self.cog._cancel_idle_timer(self.guild_id)
+        generation = self._generation
+        self.voice_client.play(station.subscribe(self.guild_id), after=lambda e: self._track_finished(generation, e))
+        self.cog._update_now_playing(self)
+
+    async def _advance(self, started_at: float | None = None):
+        """เล่นเพลงถัดไปในคิว ข้ามเพลงที่เล่นไม่ได้ไปเรื่อย ๆ จนกว่าจะเริ่มเล่นได้หรือคิวหมด"""
+        self._generation += 1
+        self.cog._cancel_track_timers(self.guild_id)
+        self.notices.clear()
+        while True:
+            if not self.voice_client or not self.voice_client.is_connected():
+                self.current = None
+                return
+            if not self.queue:
+                self.current = None
+                self.cog._record_current(self)
+                self.cog._update_now_playing(self)
+                self.cog._start_idle_timer(self.guild_id, self.text_channel)
+                return
+
+            self.cog._cancel_idle_timer(self.guild_id)
+            self.current = self.queue.popleft()
+            if await self.cog._play_song(self, self.current, self._generation, started_at):
+                self.cog._record_current(self)
+                if started_at is not None:
+                    elapsed = time.perf_counter() - started_at
+                    self.transitions += 1
+                    self.transition_total += elapsed
+                    self.transition_max = max(self.transition_max, elapsed)
+                return
+            self.current = None
+
+# --- บันทึกสถานะคิวเพื่อกู้คืนหลังรีสตาร์ท ---
+QUEUE_JOURNAL_ENABLED = os.getenv("QUEUE_JOURNAL", "1") != "0"
+QUEUE_JOURNAL_FLUSH_SECONDS = 1.0    # เขียนการเปลี่ยนแปลงที่สะสมไว้ลง journal ทุก ๆ เท่านี้
+QUEUE_JOURNAL_COMPACT_SECONDS = 30.0 # รวม journal เป็น snapshot และบันทึกตำแหน่งเพลงทุก ๆ เท่านี้
+QUEUE_RESTORE_INTERVAL = float(os.getenv("QUEUE_RESTORE_INTERVAL", "2")) # วินาทีระหว่างการกู้คืนแต่ละ guild (ไม่ให้ yt-dlp ทำงานพร้อมกันทีเดียว)
+QUEUE_RESTORE_MAX_AGE = 6 * 3600     # ไม่กู้คืนคิวที่ไม่ได้อัปเดตนานกว่านี้ (วินาที)
+
+class QueueJournal:
+    """
+    เก็บการเปลี่ยนแปลงคิวและสถานะการเล่นของทุก guild ไว้ในหน่วยความจำ แล้วให้ MusicCog เขียนลง SQLite เป็นชุด (append-only)
+    ต่อท้าย journal ทุก QUEUE_JOURNAL_FLUSH_SECONDS และรวมเป็น snapshot ต่อ guild ทุก QUEUE_JOURNAL_COMPACT_SECONDS
+    """
+    def __init__(self):
+        self._pending = []  # [(guild_id, op, args JSON, เวลา)]
+        self.dirty = set()  # guild ที่มีรายการใน journal ตั้งแต่ snapshot ล่าสุด
+        self.written = 0
+        self.compactions = 0
+
+    def record(self, guild_id: int, op: str, *args):
+        self._pending.append((guild_id, op, json.dumps(args), time.time()))
+        self.dirty.add(guild_id)
+
+    def take(self) -> list[tuple[int, str, str, float]]:
+        """เอารายการที่ยังไม่ได้เขียนออกไปทั้งหมด (เรียกจาก event loop)"""
+        pending, self._pending = self._pending, []
+        self.written += len(pending)
+        return pending
+
+# --- metrics สำหรับ Prometheus (เปิดใช้เมื่อตั้งค่า METRICS_PORT) ---
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))       # 0 = ปิด (ไม่วัดอะไรเลย); แบ่ง shard แล้ว worker ที่ i ใช้พอร์ต METRICS_PORT + i
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # วินาที
+METRICS_HISTOGRAMS = {
+    'musicbot_fetch_song_data_seconds': "เวลาที่ใช้ดึงข้อมูลเพลงของ /play (รวมที่ได้จากแคช)",
+    'musicbot_stream_url_seconds': "เวลาที่ใช้หา stream URL ของเพลงที่กำลังจะเล่น (รวมที่ได้จากแคช)",
+    'musicbot_play_to_first_packet_seconds': "เวลาตั้งแต่ /play จนส่งแพ็กเก็ตเสียงแรก (เฉพาะตอนที่ไม่มีเพลงเล่นอยู่)",
+    'musicbot_track_transition_seconds': "เวลาตั้งแต่เพลงก่อนหน้าจบ/ถูกข้ามจนส่งแพ็กเก็ตเสียงแรกของเพลงถัดไป",
+}
+METRICS_COUNTERS = {
+    'musicbot_extraction_errors_total': ('type', "ข้อผิดพลาดของ yt-dlp แยกตามชนิด"),
+}
+
+class Histogram:
+    """histogram ของ Prometheus (เก็บจำนวนต่อ bucket แล้วสะสมตอน export)"""
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # ช่องสุดท้าย = +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    """
+    เก็บ histogram และ counter ในหน่วยความจำ แล้ว export เป็น Prometheus text format ที่ HTTP /metrics (aiohttp ใน event loop ของบอท)
+    gauge คำนวณจากสถานะของบอทตอนที่ถูกอ่านเท่านั้น; ทุก method ต้องเรียกจาก event loop (thread อื่นใช้ loop.call_soon_threadsafe)
+    """
+    def __init__(self, collect_gauges):
+        self.histograms = {name: Histogram(METRICS_LATENCY_BUCKETS) for name in METRICS_HISTOGRAMS}
+        self.counters = {name: collections.Counter() for name in METRICS_COUNTERS}
+        self._collect_gauges = collect_gauges # () -> [(ชื่อ, ชนิด, คำอธิบาย, ค่า)]
+        self._runner = None
+
+    def observe(self, name: str, value: float):
+        self.histograms[name].observe(value)
+
+    def inc(self, name: str, label: str):
+        self.counters[name][label] += 1
+
+    def render(self) -> str:
+        lines = []
+        for name, histogram in self.histograms.items():
+            lines += [f"# HELP {name} {METRICS_HISTOGRAMS[name]}", f"# TYPE {name} histogram"]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f'{name}_bucket{{le="+Inf"}} {histogram.count}',
+                      f"{name}_sum {histogram.total}", f"{name}_count {histogram.count}"]
+        for name, counter in self.counters.items():
+            label, help_text = METRICS_COUNTERS[name]
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [f'{name}{{{label}="{value}"}} {count}' for value, count in sorted(counter.items())]
+        for name, kind, help_text, value in self._collect_gauges():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    async def start(self, host: str, port: int):
+        from aiohttp import web # import เฉพาะเมื่อเปิดใช้ metrics
+
+        async def handle(request):
+            return web.Response(text=self.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        print(f"เปิด metrics ที่ http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+class _FirstPacketSource(discord.AudioSource):
+    """ครอบ audio source เพื่อแจ้งเวลาที่อ่านแพ็กเก็ตเสียงแรก (ใช้เมื่อเปิด metrics เท่านั้น)"""
+    def __init__(self, source: discord.AudioSource, callback):
+        self.source = source
+        self._callback = callback # (time.perf_counter()) -> None ถูกเรียกครั้งเดียวใน thread ของ discord.py
+
+    def read(self) -> bytes:
+        data = self.source.read()
+        if self._callback:
+            callback, self._callback = self._callback, None
+            callback(time.perf_counter())
+        return data
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+# --- คลาสสำหรับจัดการเพลง (Music Cog) ---
+class MusicCog(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        # ข้อมูลต่อ guild (เซิร์ฟเวอร์)
+        self.players = {}        # {guild_id: GuildPlayer} (voice client, คิว, เพลงที่กำลังเล่น และสถานะของแต่ละ guild)
+        self.loop = bot.loop     # asyncio event loop
+        self.idle_timers = TimerWheel(self.loop, self._idle_expired, IDLE_WHEEL_TICK, IDLE_WHEEL_SLOTS) # key: guild_id
+        # เวลาก่อนเพลงจบที่ต้อง preload/crossfade (key: (PLAYER_PRELOAD หรือ PLAYER_CROSSFADE, guild_id))
+        self.track_timers = TimerWheel(self.loop, self._track_timer_due, IDLE_WHEEL_TICK, IDLE_WHEEL_SLOTS)
+        self.preloads_active = 0   # preload ที่กำลังเปิดหรือเปิดรอไว้ (ไม่เกิน PRELOAD_MAX_SOURCES)
+        self.preload_hits = 0      # เพลงที่เริ่มเล่นจาก FFMPEG ที่เปิดรอไว้
+        self.preload_rejected = 0  # preload ที่ไม่ได้ทำเพราะเกินจำนวนที่กำหนด
+        self.crossfades = 0
+        self.now_playing_stats = collections.Counter() # สถิติการอัปเดตข้อความเพลงที่กำลังเล่น (ดู CoalescedMessage)
+        self.broadcasts = {}                 # {ชื่อสถานีที่ normalize แล้ว: BroadcastStation}
+        self.broadcast_skipped_frames = 0    # แพ็กเก็ตที่ผู้ฟังที่ช้าไม่ได้อ่าน (รวมสถานีที่ปิดไปแล้ว)
+        self.governor = FFmpegGovernor(FFMPEG_MAX_PROCESSES)
+        self.stream_url_flights = SingleFlight() # การดึง stream URL ที่กำลังทำอยู่ (key: webpage_url)
+        self.song_list_flights = SingleFlight()  # การดึงข้อมูลเพลง/เพลย์ลิสต์ที่กำลังทำอยู่ (key: query ที่ normalize แล้ว)
+        self.playlist_progress = {}              # {key: _PlaylistProgress} ของเพลย์ลิสต์ที่กำลังทยอยดึงใน song_list_flights
+        # แคชที่ใช้ร่วมกันทุก guild
+        self.stream_url_cache = TTLCache(STREAM_CACHE_MAX_ENTRIES, STREAM_URL_DEFAULT_TTL) # {webpage_url: dict จาก _stream_info}
+        self.search_cache = TTLCache(SEARCH_CACHE_MAX_SONGS, SEARCH_CACHE_TTL)              # {query/URL ที่ normalize แล้ว: list[dict]}
+        self.metadata_store = MetadataStore(METADATA_DB_PATH)
+        self.ydl_pool = YoutubeDLPool(YDL_PROFILES)
+        self.extraction = ExtractionScheduler(EXTRACT_MAX_WORKERS, EXTRACT_MAX_PENDING, EXTRACT_MAX_PENDING_PER_GUILD)
+        self.metadata_refreshing = set() # query key ที่กำลังดึงข้อมูลใหม่เบื้องหลัง
+        self.store_writes = set()        # task ที่กำลังเขียนลง metadata_store ใน thread แยก (รอให้เสร็จก่อนปิดที่เก็บ)
+        self.queue_limits = {}           # {guild_id: จำนวนเพลงสูงสุดในคิว} ที่ตั้งด้วย /queuelimit (อ่านจากดิสก์ตอน cog_load)
+        self.autocomplete = AutocompleteIndex(AUTOCOMPLETE_MAX_TITLES) if AUTOCOMPLETE_MAX_TITLES else None
+        self.loudness_analyzer = LoudnessAnalyzer(self.metadata_store, LOUDNESS_ANALYSIS_WORKERS, self.governor, self._cached_audio_path)
+        self.audio_cache = None # AudioCache เมื่อเปิดใช้ (สร้างใน cog_load เพราะต้องมี event loop)
+        self.library = MusicLibrary(LIBRARY_DIR, LIBRARY_DB_PATH) if LIBRARY_DIR else None
+        self.journal = QueueJournal() if QUEUE_JOURNAL_ENABLED else None
+        self.metrics = Metrics(self._collect_gauges) if METRICS_PORT else None
+        self._journal_compacted_at = time.monotonic()
+
+    async def cog_load(self):
+        try:
+            self.queue_limits = await self.loop.run_in_executor(None, self.metadata_store.queue_limits)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะอ่านการตั้งค่าคิวของแต่ละ guild: {e}")
+        if AUDIO_CACHE_DIR:
+            # สแกนโฟลเดอร์และ index ใน thread แยก (index อยู่ใน SQLite ที่ worker อื่นอาจกำลังเขียนอยู่)
+            self.audio_cache = await self.loop.run_in_executor(
+                None, AudioCache, AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_MIN_PLAYS, self.metadata_store)
+        self.compact_metadata.start()
+        self.loudness_analyzer.start()
+        if self.autocomplete is not None:
+            self.loop.create_task(self._load_autocomplete())
+        # แบ่ง shard หลาย process: worker ที่มี shard แรกสแกนคนเดียว worker อื่นค้นหาจากไฟล์ index เดียวกัน
+        if self.library is not None and (not getattr(self.bot, 'shard_ids', None) or self.bot.shard_ids[0] == 0):
+            if LIBRARY_RESCAN_MINUTES > 0:
+                self.scan_library.start()
+            else:
+                self.loop.create_task(self._scan_library())
+        if NOW_PLAYING_REFRESH_SECONDS > 0:
+            self.refresh_now_playing.start()
+        if self.journal:
+            self.flush_journal.start()
+            self.loop.create_task(self._restore_sessions())
+        if self.metrics:
+            # shard ถูกแบ่งให้ worker แบบ round-robin shard แรกของ worker จึงเท่ากับลำดับของ worker
+            port = METRICS_PORT + (self.bot.shard_ids[0] if getattr(self.bot, 'shard_ids', None) else 0)
+            try:
+                await self.metrics.start(METRICS_HOST, port)
+            except OSError as e:
+                print(f"ไม่สามารถเปิด metrics ที่พอร์ต {port}: {e}")
+
+    async def cog_unload(self):
+        self.compact_metadata.cancel()
+        self.refresh_now_playing.cancel()
+        self.scan_library.cancel()
+        if self.journal:
+            self.flush_journal.cancel()
+            write = self._prepare_journal_write(compact=True) # บันทึกตำแหน่งเพลงล่าสุดก่อนปิด
+            if write:
+                try:
+                    write()
+                except sqlite3.Error as e:
+                    print(f"เกิดข้อผิดพลาดขณะบันทึกสถานะคิวก่อนปิด: {e}")
+        if self.metrics:
+            await self.metrics.stop()
+        for station in list(self.broadcasts.values()):
+            station.close()
+        for player in self.players.values():
+            player.close()
+            self._discard_preload(player)
+        self.idle_timers.stop()
+        self.track_timers.stop()
+        self.loudness_analyzer.stop()
+        self.extraction.shutdown()
+        if self.store_writes:
+            await asyncio.wait(self.store_writes)
+        self.metadata_store.close()
+        if self.library is not None:
+            self.library.close()
+
+    async def _load_autocomplete(self):
+        """สร้าง index ของ autocomplete จากเพลงที่ใช้ล่าสุดบนดิสก์ (อ่านใน thread แยก)"""
+        try:
+            rows = await self.loop.run_in_executor(None, self.metadata_store.recent_titles, AUTOCOMPLETE_MAX_TITLES)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะอ่านชื่อเพลงสำหรับ autocomplete: {e}")
+            return
+        self.autocomplete.load(rows)
+        print(f"โหลดชื่อเพลงสำหรับ autocomplete แล้ว {len(self.autocomplete)} เพลง")
+
+    @tasks.loop(hours=METADATA_COMPACT_INTERVAL_HOURS)
+    async def compact_metadata(self):
+        """ย่อขนาดที่เก็บข้อมูลเพลงเป็นระยะ (ทำใน thread แยกเพื่อไม่ให้ event loop ค้าง)"""
+        try:
+            await self.loop.run_in_executor(None, self.metadata_store.compact)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะย่อขนาดที่เก็บข้อมูลเพลง: {e}")
+
+    @tasks.loop(minutes=LIBRARY_RESCAN_MINUTES or 30)
+    async def scan_library(self):
+        """สแกนคลังเพลงในเครื่องตอนเริ่มบอทและเป็นระยะ (อ่านเฉพาะไฟล์ที่เปลี่ยน)"""
+        await self._scan_library()
+
+    async def _scan_library(self):
+        try:
+            await self.loop.run_in_executor(None, self.library.scan)
+        except (OSError, sqlite3.Error) as e:
+            print(f"เกิดข้อผิดพลาดขณะสแกนคลังเพลงในเครื่อง: {e}")
+            return
+        if self.library.scan_changes:
+            print(f"สแกนคลังเพลงในเครื่องแล้ว {len(self.library)} เพลง (เปลี่ยน {self.library.scan_changes} ไฟล์, "
+                  f"{self.library.scan_seconds:.1f} วินาที)")
+
+    @tasks.loop(seconds=NOW_PLAYING_REFRESH_SECONDS or 60)
+    async def refresh_now_playing(self):
+        """อัปเดตแถบความคืบหน้าของเพลงที่กำลังเล่นอยู่ (ไม่หยุดชั่วคราว) เป็นระยะ"""
+        for player in self.players.values():
+            if player.now_playing and player.current is not None and player.paused_at is None:
+                player.now_playing.update()
+
+    @tasks.loop(seconds=QUEUE_JOURNAL_FLUSH_SECONDS)
+    async def flush_journal(self):
+        """เขียนการเปลี่ยนแปลงคิวลง journal และรวมเป็น snapshot เป็นระยะ (เขียนใน thread แยก)"""
+        compact = time.monotonic() - self._journal_compacted_at >= QUEUE_JOURNAL_COMPACT_SECONDS
+        write = self._prepare_journal_write(compact)
+        if write is None:
+            return
+        try:
+            await self.loop.run_in_executor(None, write)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะบันทึก journal ของคิว: {e}")
+
+    def _prepare_journal_write(self, compact: bool):
+        """
+        เก็บข้อมูลที่ต้องเขียนจากสถานะในหน่วยความจำ (ต้องเรียกใน event loop)
+        คืนฟังก์ชันที่เขียนลง SQLite (เรียกใน thread ใดก็ได้) หรือ None ถ้าไม่มีอะไรต้องเขียน
+        """
+        pending = self.journal.take()
+        snapshots, positions = {}, {}
+        if compact:
+            # สถานะในหน่วยความจำรวมทุกรายการใน journal แล้ว จึงเขียนทับเป็น snapshot และลบ journal ของ guild นั้นได้
+            self._journal_compacted_at = time.monotonic()
+            self.journal.compactions += 1
+            dirty, self.journal.dirty = self.journal.dirty, set()
+            snapshots = {guild_id: self._queue_snapshot(guild_id) for guild_id in dirty}
+            positions = {guild_id: player.position() for guild_id, player in self.players.items()
+                         if player.current is not None and guild_id not in dirty}
+        if not pending and not snapshots and not positions:
+            return None
+
+        def write():
+            if pending:
+                self.metadata_store.append_journal(pending)
+            if snapshots or positions:
+                encoded = {guild_id: (json.dumps(snapshot[0]), snapshot[1]) if snapshot else None
+                           for guild_id, snapshot in snapshots.items()}
+                self.metadata_store.write_queue_snapshots(encoded, positions)
+        return write
+
+    def _queue_snapshot(self, guild_id: int) -> tuple[dict, float] | None:
+        """สถานะของ guild สำหรับเขียนเป็น snapshot (state, ตำแหน่งเพลง) หรือ None ถ้าไม่มีอะไรให้กู้คืน"""
+        player = self.players.get(guild_id)
+        if player is None or (not player.queue and player.current is None):
+            return None
+        voice_channel_id, text_channel_id = self._session_of(player)
+        state = {'voice_channel_id': voice_channel_id, 'text_channel_id': text_channel_id,
+                 'current': player.current.to_record() if player.current else None,
+                 'tracks': [track.to_record() for track in player.queue]}
+        return state, player.position()
+
+    def _session_of(self, player: GuildPlayer) -> tuple[int | None, int | None]:
+        voice_channel = player.voice_client.channel if player.voice_client else None
+        return getattr(voice_channel, 'id', None), getattr(player.text_channel, 'id', None)
+
+    def _queue_changed(self, guild_id: int, change: tuple):
+        """listener ของ TrackQueue: บันทึกลง journal และอัปเดตรายการเพลงถัดไปในข้อความเพลงที่กำลังเล่น"""
+        if self.journal:
+            self._record_queue_change(guild_id, change)
+        player = self.players.get(guild_id)
+        if player and player.now_playing:
+            player.now_playing.update()
+
+    def _record_queue_change(self, guild_id: int, change: tuple):
+        """เขียนการเปลี่ยนแปลงคิวหนึ่งครั้งลง journal (แปลง Track ใน args เป็น dict ที่บันทึกได้ด้วย to_record)"""
+        op, *args = change
+        self.journal.record(guild_id, op, *[arg.to_record() if isinstance(arg, Track) else arg for arg in args])
+
+    def _record_current(self, player: GuildPlayer):
+        """บันทึกเพลงที่เริ่มเล่น (หรือ None เมื่อหยุด) และตำแหน่งเริ่มต้นลง journal"""
+        if self.journal:
+            current = player.current.to_record() if player.current else None
+            self.journal.record(player.guild_id, 'current', current, player.position())
+
+    def _record_session(self, player: GuildPlayer):
+        """บันทึกช่องเสียง/ช่องข้อความของ guild ลง journal เมื่อเปลี่ยน"""
+        session = self._session_of(player)
+        if self.journal and session != player.journaled_session:
+            player.journaled_session = session
+            self.journal.record(player.guild_id, 'session', *session)
+
+    async def _restore_sessions(self):
+        """
+        กู้คืนคิวและเพลงที่เล่นค้างไว้จาก snapshot + journal หลังรีสตาร์ท
+        กลับเข้าช่องเสียงเฉพาะ guild ที่ยังมีผู้ฟังอยู่ และเว้นระยะ QUEUE_RESTORE_INTERVAL ระหว่าง guild เพื่อไม่ให้ดึง stream URL พร้อมกัน
+        """
+        await self.bot.wait_until_ready()
+        try:
+            sessions = await self.loop.run_in_executor(None, self.metadata_store.load_queue_sessions, QUEUE_RESTORE_MAX_AGE)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะอ่าน journal ของคิว: {e}")
+            return
+        restored = rejoined = 0
+        for guild_id, (state, position, ops) in sessions.items():
+            guild = self.bot.get_guild(guild_id)
+            if guild is None: # อยู่ใน shard อื่น หรือบอทไม่ได้อยู่ในเซิร์ฟเวอร์นี้แล้ว
+                continue
+            player = self._get_player(guild_id)
+            if player.queue or player.current: # มีคนสั่งเล่นเพลงไปแล้วก่อนกู้คืนเสร็จ
+                continue
+            voice_channel_id, text_channel_id = self._replay_session(player, state, position, ops)
+            self.journal.dirty.add(guild_id) # ให้ compaction ถัดไปเขียน snapshot ใหม่แทน journal เดิม
+            if not player.queue:
+                continue
+            restored += 1
+            player.text_channel = guild.get_channel(text_channel_id) if text_channel_id else None
+            channel = guild.get_channel(voice_channel_id) if voice_channel_id else None
+            if channel is None or _count_listeners(channel) == 0:
+                continue # ไม่มีผู้ฟังแล้ว เก็บคิวไว้ให้เล่นต่อเมื่อมีคนใช้ /play
+            try:
+                player.voice_client = await channel.connect()
+            except (asyncio.TimeoutError, discord.ClientException) as e:
+                print(f"ไม่สามารถกลับเข้าช่องเสียงใน Guild {guild_id}: {e}")
+                continue
+            player.listeners = _count_listeners(channel)
+            self._record_session(player)
+            rejoined += 1
+            if isinstance(player.text_channel, discord.TextChannel):
+                try:
+                    await player.text_channel.send(f"บอทรีสตาร์ทแล้ว กำลังเล่นต่อจากคิวเดิม ({len(player.queue)} เพลง)")
+                except discord.HTTPException as e:
+                    print(f"ไม่สามารถแจ้งการกู้คืนคิวใน Guild {guild_id}: {e}")
+            player.post(PLAYER_PLAY)
+            await asyncio.sleep(QUEUE_RESTORE_INTERVAL)
+        if restored:
+            print(f"กู้คืนคิวของ {restored} เซิร์ฟเวอร์ (กลับเข้าช่องเสียง {rejoined} เซิร์ฟเวอร์)")
+
+    def _replay_session(self, player: GuildPlayer, state: dict | None, position: float,
+                        ops: list[tuple[str, list]]) -> tuple[int | None, int | None]:
+        """สร้างคิวของ player จาก snapshot แล้วตามด้วยรายการใน journal คืนค่า (voice channel id, text channel id)"""
+        queue = player.queue
+        queue.listener = None # ไม่บันทึกซ้ำระหว่างกู้คืน
+        voice_channel_id = text_channel_id = current = None
+        if state:
+            voice_channel_id, text_channel_id = state['voice_channel_id'], state['text_channel_id']
+            current = state['current']
+            queue.extend(Track(**record) for record in state['tracks'])
+        for op, args in ops:
+            if op == 'append':
+                queue.append(Track(**args[0]))
+            elif op == 'insert':
+                queue.insert(args[0], Track(**args[1]))
+            elif op == 'pop':
+                if args[0] < len(queue):
+                    queue.pop(args[0])
+            elif op == 'clear':
+                queue.clear()
+            elif op == 'current':
+                current, position = args
+            elif op == 'session':
+                voice_channel_id, text_channel_id = args
+        if current:
+            track = Track(**current)
+            track.start_offset = position
+            queue.insert(0, track) # เล่นต่อจากตำแหน่งเดิมเป็นเพลงแรก
+        queue.listener = functools.partial(self._queue_changed, player.guild_id)
+        return voice_channel_id, text_channel_id
+
+    def _collect_gauges(self) -> list[tuple[str, str, str, float]]:
+        """ค่าปัจจุบันของบอทสำหรับ /metrics (คำนวณเฉพาะตอนที่ถูกอ่าน)"""
+        voice_clients = queued = longest = ffmpeg = 0
+        for player in self.players.values():
+            queued += len(player.queue)
+            longest = max(longest, len(player.queue))
+            if player.voice_client and player.voice_client.is_connected():
+                voice_clients += 1
+                source = getattr(player.voice_client, 'source', None)
+                while source is not None and not isinstance(source, discord.FFmpegAudio): # ตัวครอบ เช่น _FirstPacketSource
+                    source = getattr(source, 'source', None) or getattr(source, 'incoming', None)
+                process = getattr(source, '_process', None)
+                if process is not None and process.poll() is None:
+                    ffmpeg += 1
+        ffmpeg += sum(1 for station in self.broadcasts.values() if station.current is not None)
+        ffmpeg += self.loudness_analyzer.running + self.preloads_active + (self.audio_cache.downloading if self.audio_cache else 0)
+        return [
+            ('musicbot_voice_clients', 'gauge', "จำนวนช่องเสียงที่บอทเชื่อมต่ออยู่", voice_clients),
+            ('musicbot_queued_tracks', 'gauge', "จำนวนเพลงในคิวรวมทุกเซิร์ฟเวอร์", queued),
+            ('musicbot_queue_length_max', 'gauge', "ความยาวคิวที่มากที่สุดในบรรดาเซิร์ฟเวอร์", longest),
+            ('musicbot_extraction_pending', 'gauge', "งาน yt-dlp ที่รอคิวอยู่", self.extraction.pending),
+            ('musicbot_extraction_running', 'gauge', "งาน yt-dlp ที่กำลังทำ", self.extraction.running),
+            ('musicbot_extraction_rejected_total', 'counter', "งาน yt-dlp ที่ถูกปฏิเสธเพราะคิวเต็ม", self.extraction.rejected),
+            ('musicbot_ffmpeg_processes', 'gauge', "จำนวน FFMPEG ที่กำลังทำงาน (เล่นเพลง วัดความดัง และเก็บไฟล์)", ffmpeg),
+            ('musicbot_now_playing_updates_total', 'counter', "การเปลี่ยนแปลงที่ต้องแสดงในข้อความเพลงที่กำลังเล่น",
+             self.now_playing_stats['updates']),
+            ('musicbot_now_playing_writes_total', 'counter', "การเรียก Discord API เพื่อส่ง/แก้/ลบข้อความเพลงที่กำลังเล่น",
+             self.now_playing_stats['writes']),
+            ('musicbot_now_playing_saved_total', 'counter', "การเปลี่ยนแปลงที่ไม่ต้องเรียก API เพราะรวมกับการแก้ที่รออยู่หรือเนื้อหาเหมือนเดิม",
+             self.now_playing_stats['coalesced'] + self.now_playing_stats['unchanged']),
+            ('musicbot_broadcast_stations', 'gauge', "จำนวนสถานี broadcast ที่เปิดอยู่", len(self.broadcasts)),
+            ('musicbot_broadcast_listeners', 'gauge', "จำนวนเซิร์ฟเวอร์ที่ฟังสถานี broadcast อยู่",
+             sum(len(station.listeners) for station in self.broadcasts.values())),
+            ('musicbot_broadcast_skipped_frames_total', 'counter', "แพ็กเก็ตเสียงของ broadcast ที่ผู้ฟังที่ช้าถูกข้ามไป",
+             self.broadcast_skipped_frames + sum(station.buffer.skipped for station in self.broadcasts.values())),
+            ('musicbot_autocomplete_titles', 'gauge', "จำนวนเพลงใน index ของ autocomplete",
+             len(self.autocomplete) if self.autocomplete is not None else 0),
+            ('musicbot_library_tracks', 'gauge', "จำนวนเพลงในคลังเพลงในเครื่อง", len(self.library) if self.library is not None else 0),
+            ('musicbot_library_hits_total', 'counter', "คำค้นหาที่เจอเพลงในคลังเพลงในเครื่อง (ไม่ต้องเรียก yt-dlp)",
+             self.library.hits if self.library is not None else 0),
+            ('musicbot_preloaded_sources', 'gauge', "จำนวน FFMPEG ของเพลงถัดไปที่เปิดรอไว้", self.preloads_active),
+            ('musicbot_preload_hits_total', 'counter', "เพลงที่เริ่มเล่นจาก FFMPEG ที่เปิดรอไว้", self.preload_hits),
+            ('musicbot_preload_rejected_total', 'counter', "preload ที่ไม่ได้ทำเพราะเกิน PRELOAD_MAX_SOURCES", self.preload_rejected),
+            ('musicbot_crossfades_total', 'counter', "การเปลี่ยนเพลงแบบ crossfade", self.crossfades),
+            ('musicbot_governor_load', 'gauge', "load average 1 นาทีต่อ CPU core ที่ governor ใช้ตัดสิน", self.governor.load),
+            ('musicbot_governor_level', 'gauge', "ระดับที่ governor ตัดสิน (0 = ปกติ, 1 = ลดคุณภาพ, 2 = ให้เพลงใหม่รอ)", self.governor.level),
+            ('musicbot_governor_playback_processes', 'gauge', "FFMPEG ที่เล่นเพลงอยู่ตามที่ governor นับ", self.governor.running),
+            ('musicbot_governor_waiting', 'gauge', "เพลงที่กำลังรอ governor ก่อนเริ่มเล่น", self.governor.waiting),
+            ('musicbot_governor_queued_starts_total', 'counter', "เพลงที่ต้องรอก่อนเริ่มเล่น", self.governor.queued_starts),
+            ('musicbot_governor_degraded_starts_total', 'counter', "FFMPEG ที่เปิดแบบลดคุณภาพ", self.governor.degraded_starts),
+            ('musicbot_governor_load_bypassed_total', 'counter', "เพลงที่รอเพราะ load ครบเวลาแล้วเริ่มเลย", self.governor.load_bypassed),
+        ]
+
+    def _count_extraction_error(self, error: Exception):
+        """นับข้อผิดพลาดของ yt-dlp ตามชนิด (เรียกจาก thread ของ yt-dlp)"""
+        if self.metrics:
+            cause = getattr(error, 'exc_info', None) # DownloadError เก็บข้อผิดพลาดจริงของ extractor ไว้
+            kind = type(cause[1]).__name__ if cause and cause[1] else type(error).__name__
+            self.loop.call_soon_threadsafe(self.metrics.inc, 'musicbot_extraction_errors_total', kind)
+
+    def _watch_first_packet(self, player: GuildPlayer, source: discord.AudioSource,
+                            transition_started: float | None) -> discord.AudioSource:
+        """ครอบ source ของเพลงที่กำลังจะเริ่มด้วย _FirstPacketSource เพื่อวัดเวลาถึงแพ็กเก็ตแรก (เมื่อเปิด metrics)"""
+        if not self.metrics:
+            return source
+        requested_at, player.play_requested_at = player.play_requested_at, None
+        marks = functools.partial(self._first_packet, requested_at, transition_started)
+        return _FirstPacketSource(source, lambda sent_at: self.loop.call_soon_threadsafe(marks, sent_at))
+
+    def _record_cache_play(self, song: Track, stream_url: str, from_cache: bool):
+        """นับการเล่นเพลงที่ไม่ได้เล่นจากแคช ให้ AudioCache เก็บไฟล์เมื่อเล่นบ่อยพอ"""
+        video_id = _audio_cache_key(song.webpage_url)
+        if self.audio_cache and video_id and not from_cache and \
+           song.duration and song.duration <= AUDIO_CACHE_MAX_TRACK_SECONDS:
+            self.audio_cache.record_play(video_id, stream_url)
+
+    def _first_packet(self, requested_at: float | None, transition_started: float | None, sent_at: float):
+        """บันทึกเวลาถึงแพ็กเก็ตเสียงแรกของเพลงที่เพิ่งเริ่มเล่น"""
+        if requested_at is not None:
+            self.metrics.observe('musicbot_play_to_first_packet_seconds', sent_at - requested_at)
+        if transition_started is not None:
+            self.metrics.observe('musicbot_track_transition_seconds', sent_at - transition_started)
+
+    def _arm_track_timers(self, player: GuildPlayer):
+        """ตั้งเวลา preload/crossfade ตามเวลาที่เหลือของเพลงปัจจุบัน (ไม่ทำอะไรถ้าปิด preload หรือไม่รู้ความยาวเพลง)"""
+        if not PRELOAD_SECONDS or player.current is None or not player.current.duration:
+            return
+        remaining = player.current.duration - player.position()
+        self.track_timers.arm((PLAYER_PRELOAD, player.guild_id), remaining - PRELOAD_SECONDS)
+        if CROSSFADE_SECONDS:
+            self.track_timers.arm((PLAYER_CROSSFADE, player.guild_id), remaining - CROSSFADE_SECONDS)
+
+    def _cancel_track_timers(self, guild_id: int):
+        self.track_timers.cancel((PLAYER_PRELOAD, guild_id))
+        self.track_timers.cancel((PLAYER_CROSSFADE, guild_id))
+
+    def _track_timer_due(self, key: tuple[str, int]):
+        """callback ของ track_timers: ส่ง event ให้ลูปของ player ทำต่อ"""
+        event, guild_id = key
+        player = self.players.get(guild_id)
+        if player:
+            player.post(event)
+
+    def _start_preload(self, player: GuildPlayer, song: Track):
+        """เริ่มเปิด FFMPEG ของเพลงถัดไปเบื้องหลัง (ภายในจำนวนที่กำหนดรวมทุก guild)"""
+        if player.preload is not None:
+            if player.preload[0] is song:
+                return
+            self._discard_preload(player) # คิวเปลี่ยนหลัง preload ครั้งก่อน
+        if self.preloads_active >= PRELOAD_MAX_SOURCES:
+            self.preload_rejected += 1
+            return
+        self.preloads_active += 1
+        player.preload = (song, self.loop.create_task(self._preload_source(player, song)))
+
+    async def _preload_source(self, player: GuildPlayer, song: Track) -> _PreloadedSource | None:
+        """สร้าง audio source ของเพลงแล้วอ่านแพ็กเก็ตแรกรอไว้ คืน None ถ้าทำไม่ได้ (จะเปิดตามปกติตอนถึงคิวแทน)"""
+        video_id = _audio_cache_key(song.webpage_url)
+        # นับ hit/miss ของแคชตอนได้เล่นจริงใน _preload_used (preload อาจถูกทิ้งถ้าคิวเปลี่ยน)
+        cached_path = await self.audio_cache.lookup(video_id, count=False) if self.audio_cache and video_id else None
+        stream_url = cached_path or await self._get_streamable_url(song, player.guild_id, PRIORITY_BACKGROUND)
+        voice_client = player.voice_client
+        if not stream_url or not voice_client:
+            return None
+        if not self.governor.try_acquire():
+            self.preload_rejected += 1
+            return None
+        source = None
+        try:
+            source = _PreloadedSource(await self._create_governed_source(song, stream_url, voice_client), stream_url,
+                                      cached_path is not None)
+            await self.loop.run_in_executor(None, source.warm)
+            return source
+        except asyncio.CancelledError:
+            if source:
+                source.cleanup()
+            raise
+        except Exception as e:
+            print(f"ไม่สามารถเตรียมเพลง '{song.title}' ล่วงหน้า: {e}")
+            if source:
+                source.cleanup()
+            return None
 
-# --- คลาสสำหรับจัดการเพลง (Music Cog) ---
-class MusicCog(commands.Cog):
-    def __init__(self, bot: commands.Bot):
-        self.bot = bot
-        # ข้อมูลต่อ guild (เซิร์ฟเวอร์)
-        self.voice_clients = {}  # {guild_id: discord.VoiceClient}
-        self.song_queues = {}    # {guild_id: collections.deque}
-        self.current_songs = {}  # {guild_id: dict} (ข้อมูลเพลงที่กำลังเล่น)
-        self.is_playing = {}     # {guild_id: bool}
-        self.idle_timers = {}    # {guild_id: asyncio.Task} (สำหรับ auto-disconnect)
-        self.loop = bot.loop     # asyncio event loop
+    def _discard_preload(self, player: GuildPlayer):
+        """ยกเลิก preload ของ guild และปิด FFMPEG ที่เปิดรอไว้"""
+        preload, player.preload = player.preload, None
+        if preload is None:
+            return
+        self.preloads_active -= 1
+        task = preload[1]
+        if not task.done():
+            task.cancel() # _preload_source ปิด source เองเมื่อถูกยกเลิก
+        elif not task.cancelled() and task.result() is not None:
+            task.result().cleanup()
 
-    def _get_queue(self, guild_id: int) -> collections.deque:
+    async def _take_preloaded(self, player: GuildPlayer, song: Track) -> _PreloadedSource | None:
+        """คืน source ที่เปิดรอไว้ของเพลงนี้ (รอให้เสร็จถ้ายังเปิดไม่เสร็จ เพราะเร็วกว่าเปิดใหม่) หรือ None"""
+        if player.preload is None or player.preload[0] is not song:
+            self._discard_preload(player)
+            return None
+        task = player.preload[1]
+        player.preload = None
+        self.preloads_active -= 1
+        source = await task
+        if source is not None:
+            self._preload_used(song, source)
+        return source
+
+    def _preload_used(self, song: Track, source: _PreloadedSource):
+        """นับสถิติของ preload ที่ได้เล่นจริง (preload ที่ถูกทิ้งไม่นับ)"""
+        self.preload_hits += 1
+        if self.audio_cache and _audio_cache_key(song.webpage_url):
+            self.audio_cache.record_lookup(source.stream_url if source.from_cache else None)
+
+    def _crossfade(self, player: GuildPlayer, song: Track) -> bool:
+        """
+        เริ่มผสมเสียงท้ายเพลงปัจจุบันกับเพลงถัดไปที่ preload ไว้แล้ว คืนค่า False ถ้าทำไม่ได้
+        (ยัง preload ไม่เสร็จ, เป็นเสียง Opus, หรือเหลือเวลาน้อยเกินไป) ซึ่งจะเปลี่ยนเพลงตามปกติเมื่อเพลงจบ
+        """
+        voice_client = player.voice_client
+        outgoing = getattr(voice_client, 'source', None)
+        preload = player.preload
+        if outgoing is None or outgoing.is_opus() or not voice_client.is_playing() or \
+           preload is None or preload[0] is not song or not preload[1].done() or preload[1].cancelled():
+            return False
+        incoming = preload[1].result()
+        remaining = player.current.duration - player.position()
+        frames = int(min(CROSSFADE_SECONDS, remaining) / PCM_FRAME_SECONDS)
+        if incoming is None or incoming.is_opus() or frames < 10:
+            return False
+        started_at = time.perf_counter()
+        player.preload = None
+        self.preloads_active -= 1
+        self._preload_used(song, incoming)
+        self.crossfades += 1
+        voice_client.source = _CrossfadeSource(outgoing, self._watch_first_packet(player, incoming, started_at), frames)
+        player.track_started = time.monotonic()
+        player.paused_at = None
+        self._record_cache_play(song, incoming.stream_url, incoming.from_cache)
+        return True
+
+    def _get_player(self, guild_id: int) -> GuildPlayer:
+        """ดึง GuildPlayer ของ guild หรือสร้างใหม่ถ้ายังไม่มี (คิวใช้จำนวนเพลงสูงสุดที่ guild ตั้งไว้ด้วย /queuelimit)"""
+        player = self.players.get(guild_id)
+        if player is None:
+            maxlen = self.queue_limits.get(guild_id, QUEUE_MAX_LENGTH)
+            player = self.players[guild_id] = GuildPlayer(self, guild_id, TrackQueue(maxlen))
+            player.queue.listener = functools.partial(self._queue_changed, guild_id)
+        return player
+
+    def _get_queue(self, guild_id: int) -> TrackQueue:
         """ดึงคิวเพลงสำหรับ guild หรือสร้างใหม่ถ้ายังไม่มี"""
-        if guild_id not in self.song_queues:
-            self.song_queues[guild_id] = collections.deque(maxlen=50) # จำกัดคิวสูงสุด 50 เพลง
-        return self.song_queues[guild_id]
+        return self._get_player(guild_id).queue
+
+    def _voice_client(self, guild_id: int) -> discord.VoiceClient | None:
+        player = self.players.get(guild_id)
+        return player.voice_client if player else None
 
     async def _ensure_voice_client(self, interaction: discord.Interaction) -> discord.VoiceClient | None:
         """ตรวจสอบหรือสร้าง voice client สำหรับ guild ของ interaction"""
-        guild_id = interaction.guild_id
-        if guild_id not in self.voice_clients or not self.voice_clients[guild_id].is_connected():
+        player = self._get_player(interaction.guild_id)
+        if not player.voice_client or not player.voice_client.is_connected():
             if interaction.user.voice and interaction.user.voice.channel:
                 channel = interaction.user.voice.channel
                 try:
-                    self.voice_clients[guild_id] = await channel.connect()
+                    player.voice_client = await channel.connect()
+                    player.listeners = _count_listeners(channel)
+                    self._record_session(player)
                 except asyncio.TimeoutError:
                     await interaction.followup.send("ไม่สามารถเชื่อมต่อกับช่องเสียงได้: หมดเวลา", ephemeral=True)
                     return None
@@ -86,165 +2998,635 @@ class MusicCog(commands.Cog):
                 return None
         
         elif interaction.user.voice and interaction.user.voice.channel and \
-             self.voice_clients[guild_id].channel != interaction.user.voice.channel:
+             player.voice_client.channel != interaction.user.voice.channel:
             try:
-                await self.voice_clients[guild_id].move_to(interaction.user.voice.channel)
+                await player.voice_client.move_to(interaction.user.voice.channel)
+                player.listeners = _count_listeners(interaction.user.voice.channel)
+                self._record_session(player)
                 await interaction.followup.send(f"ย้ายไปยังช่อง: {interaction.user.voice.channel.name}", ephemeral=True)
             except Exception as e:
                 await interaction.followup.send(f"ไม่สามารถย้ายไปยังช่องเสียงของคุณได้: {e}", ephemeral=True)
         
-        return self.voice_clients.get(guild_id)
+        return player.voice_client
 
-    async def _fetch_song_data(self, query_or_url: str, requester: discord.User) -> list[dict] | None:
+    async def _fetch_song_data(self, query_or_url: str, requester: discord.User, guild_id: int) -> list[Track] | None:
         """
         ดึงข้อมูลเพลง/เพลย์ลิสต์จาก yt-dlp (ทำงานใน thread แยก)
-        คืนค่าเป็น list ของ dicts ที่มีข้อมูลเพลง หรือ None ถ้ามีข้อผิดพลาด
+        คืนค่าเป็น list ของ Track หรือ None ถ้ามีข้อผิดพลาด
+        ผลลัพธ์ถูกเก็บในแคชที่ใช้ร่วมกันทุก guild โดยแต่ละผู้ขอจะได้สำเนาของตัวเอง
+        raise ExtractionBusy ถ้าต้องเรียก yt-dlp แต่คิวงานเต็ม
+        """
+        started_at = time.perf_counter()
+        cache_key = _normalize_query(query_or_url)
+        songs = self._search_library(query_or_url) if self.library is not None else None
+        if songs is None:
+            songs = self.search_cache.get(cache_key)
+        if songs is None:
+            songs = await self._load_stored_song_list(cache_key, query_or_url, guild_id)
+        if songs is None:
+            # ผู้ใช้หลายคนที่ขอเพลงเดียวกันพร้อมกันจะรอผลจากการดึงครั้งเดียว
+            songs = await self.song_list_flights.do(
+                cache_key, lambda: self._extract_and_store_song_list(cache_key, query_or_url, guild_id))
+        self._observe_fetch(started_at)
+        if not songs:
+            return None
+        self._index_titles(songs)
+
+        return [Track(**song, requester=requester.mention) for song in songs]
+
+    def _observe_fetch(self, started_at: float):
+        if self.metrics:
+            self.metrics.observe('musicbot_fetch_song_data_seconds', time.perf_counter() - started_at)
+
+    def _index_titles(self, songs: list[dict]):
+        """เพิ่มชื่อเพลงที่ผู้ใช้ขอลง autocomplete ของ /play"""
+        if self.autocomplete is not None:
+            for song in songs:
+                self.autocomplete.add(song.get('title'), song.get('webpage_url'))
+
+    def _search_library(self, query_or_url: str) -> list[dict] | None:
+        """
+        หาเพลงในคลังเพลงในเครื่อง คืน None ถ้าไม่พบ (ให้ค้นหาใน YouTube ต่อ)
+        library:<id> ที่เลือกจาก autocomplete ใช้ไฟล์ในคลังเสมอ ส่วนคำค้นหาใช้คลังเฉพาะเมื่อทุกคำตรงทั้งคำกับชื่อเพลงหรือศิลปิน
+        (คำค้นที่ตรงแค่ต้นคำ อัลบั้ม หรือชื่อไฟล์ ยังค้นหาใน YouTube ตามเดิม ผู้ใช้เลือกไฟล์นั้นจาก 📁 ใน autocomplete ได้)
         """
-        ydl_opts_custom = YDL_OPTIONS_BASE.copy()
+        try:
+            if _is_library_url(query_or_url):
+                song = self.library.get(query_or_url)
+                return [song] if song else None
+            if query_or_url.startswith(('http://', 'https://')):
+                return None
+            return self.library.search(query_or_url, 1, prefix=False) or None
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะค้นหาในคลังเพลง '{query_or_url}': {e}")
+            return None
+
+    async def _extract_and_store_song_list(self, cache_key: str, query_or_url: str, guild_id: int) -> list[dict] | None:
+        """ดึงข้อมูลจาก yt-dlp แล้วเก็บลงแคช (ใช้ผ่าน song_list_flights)"""
+        songs = await self._extract_song_list(query_or_url, guild_id, PRIORITY_INTERACTIVE)
+        if songs:
+            self._store_song_list(cache_key, songs)
+        return songs
+
+    async def _load_stored_song_list(self, cache_key: str, query_or_url: str, guild_id: int) -> list[dict] | None:
+        """อ่านผลการค้นหา/เพลย์ลิสต์จากดิสก์ (ใน thread แยก) ถ้าข้อมูลเก่าแล้วจะดึงใหม่เบื้องหลังแต่ยังตอบด้วยข้อมูลเดิมทันที"""
+        try:
+            stored = await self.loop.run_in_executor(None, self.metadata_store.get_lookup, cache_key)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะอ่านข้อมูลเพลงจากดิสก์ '{cache_key}': {e}")
+            return None
+        if stored is None:
+            return None
+        songs, updated_at = stored
+        self.search_cache.put(cache_key, songs, weight=len(songs))
+        if time.time() - updated_at > METADATA_REFRESH_AGE and cache_key not in self.metadata_refreshing:
+            self.metadata_refreshing.add(cache_key)
+            self.loop.create_task(self._refresh_song_list(cache_key, query_or_url, guild_id))
+        return songs
+
+    async def _refresh_song_list(self, cache_key: str, query_or_url: str, guild_id: int):
+        """ดึงข้อมูลเพลงที่เก่าแล้วใหม่จาก yt-dlp เบื้องหลัง (ข้ามไปถ้าคิวงานเต็ม)"""
+        try:
+            songs = await self._extract_song_list(query_or_url, guild_id, PRIORITY_BACKGROUND)
+            if songs:
+                self._store_song_list(cache_key, songs)
+        except ExtractionBusy:
+            pass
+        finally:
+            self.metadata_refreshing.discard(cache_key)
+
+    def _store_song_list(self, cache_key: str, songs: list[dict]):
+        """เก็บผลลัพธ์จาก yt-dlp ลงแคชในหน่วยความจำ และบนดิสก์เบื้องหลัง"""
+        self.search_cache.put(cache_key, songs, weight=len(songs))
+        self._remember_stream_urls([(song['webpage_url'], _stream_info_of(song)) for song in songs if song.get('stream_url')])
+        self._write_store_later(f"บันทึกข้อมูลเพลงลงดิสก์ '{cache_key}'", self.metadata_store.put_lookup, cache_key, songs)
+
+    def _write_store_later(self, action: str, fn, *args):
+        """
+        เขียนลง metadata_store ใน thread แยกโดยไม่ให้ผู้เรียกรอ (ข้อมูลอยู่ในแคชหน่วยความจำแล้ว)
+        event loop จึงไม่ค้างแม้ worker อื่นถือ lock ของ SQLite อยู่ และ cog_unload รอให้เขียนเสร็จก่อนปิดที่เก็บ
+        """
+        task = self.loop.create_task(self._write_store(action, fn, *args))
+        self.store_writes.add(task)
+        task.add_done_callback(self.store_writes.discard)
+
+    async def _write_store(self, action: str, fn, *args):
+        try:
+            await self.loop.run_in_executor(None, fn, *args)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะ{action}: {e}")
+
+    async def _extract_song_list(self, query_or_url: str, guild_id: int, priority: int) -> list[dict] | None:
+        """เรียก yt-dlp แล้วแปลงผลลัพธ์เป็น list ของข้อมูลเพลง (ยังไม่มีผู้ขอ)"""
         is_url = query_or_url.startswith('http://') or query_or_url.startswith('https://')
 
         search_term = query_or_url
+        profile = 'playlist'
         if not is_url:
             search_term = f"ytsearch:{query_or_url}" 
-            ydl_opts_custom['extract_flat'] = False
-            ydl_opts_custom['noplaylist'] = True
+            profile = 'search'
 
         def extract():
             try:
-                with yt_dlp.YoutubeDL(ydl_opts_custom) as ydl:
-                    info = ydl.extract_info(search_term, download=False)
-                return info
-            except yt_dlp.utils.DownloadError as e:
+                return self.ydl_pool.get(profile).extract_info(search_term, download=False)
+            except _yt_dlp().utils.DownloadError as e:
                 print(f"เกิดข้อผิดพลาด yt-dlp ขณะดึงข้อมูล '{search_term}': {e}")
+                self._count_extraction_error(e)
                 return None
             except Exception as e:
                 print(f"เกิดข้อผิดพลาดทั่วไปขณะดึงข้อมูล '{search_term}': {e}")
+                self._count_extraction_error(e)
+                self.ydl_pool.discard(profile)
                 return None
 
-        data = await self.loop.run_in_executor(None, extract)
+        data = await self.extraction.submit(guild_id, extract, priority)
 
         if not data:
             return None
 
-        songs_to_queue = []
         if 'entries' in data: 
-            for entry in data.get('entries', []):
-                if entry: 
-                    songs_to_queue.append({
-                        'title': entry.get('title', 'เพลงไม่ทราบชื่อ'),
-                        'webpage_url': entry.get('webpage_url', entry.get('url')),
-                        'duration': entry.get('duration'),
-                        'thumbnail': entry.get('thumbnail'),
-                        'requester': requester.mention,
-                        'is_partial': True 
-                    })
-        else: 
-            songs_to_queue.append({
-                'title': data.get('title', 'เพลงไม่ทราบชื่อ'),
-                'webpage_url': data.get('webpage_url'),
-                'duration': data.get('duration'),
-                'thumbnail': data.get('thumbnail'),
-                'stream_url': data.get('url') if data.get('is_live') else None,
-                'requester': requester.mention,
-                'is_partial': not (data.get('url') and not data.get('is_live'))
-            })
-        return songs_to_queue
-
-    async def _get_streamable_url(self, song_data: dict) -> str | None:
+            return [_song_from_entry(entry, not is_url) for entry in data.get('entries', []) if entry]
+        return [_song_from_video(data)]
+
+    async def _stream_playlist(self, url: str, requester: discord.User, guild_id: int):
+        """
+        async generator ที่ทยอยคืนเพลงในเพลย์ลิสต์เป็นชุด (list ของ Track ที่มีผู้ขอแล้ว)
+        ชุดแรกมีแค่เพลงแรกเพื่อให้เริ่มเล่นได้ทันที ใช้กับ contextlib.aclosing เพื่อหยุดการดึงเมื่อเลิกอ่านกลางคัน
+        การดึงใช้ song_list_flights ร่วมกับ _fetch_song_data ผู้ขอเพลย์ลิสต์เดียวกันพร้อมกันจึงดึงจาก yt-dlp ครั้งเดียว
+        raise ExtractionBusy ถ้าคิวงานดึงข้อมูลเต็ม
+        """
+        started_at = time.perf_counter()
+        cache_key = _normalize_query(url)
+        songs = self.search_cache.get(cache_key)
+        if songs is None:
+            songs = await self._load_stored_song_list(cache_key, url, guild_id)
+        if songs is not None:
+            self._observe_fetch(started_at)
+            self._index_titles(songs)
+            yield [Track(**song, requester=requester.mention) for song in songs]
+            return
+
+        def start_extraction():
+            progress = self.playlist_progress[cache_key] = _PlaylistProgress()
+            return self._extract_playlist_lazily(cache_key, url, guild_id, progress)
+
+        flight = self.song_list_flights.start(cache_key, start_extraction)
+        progress = self.playlist_progress.get(cache_key)
+        if progress is None:
+            # รวมเข้ากับ _fetch_song_data ที่ดึงเพลย์ลิสต์นี้อยู่แล้ว: ได้ทั้งเพลย์ลิสต์ทีเดียวตอนดึงเสร็จ
+            songs = await asyncio.shield(flight)
+            self._observe_fetch(started_at)
+            if songs:
+                self._index_titles(songs)
+                yield [Track(**song, requester=requester.mention) for song in songs]
+            return
+
+        progress.readers += 1
+        read = 0
+        batch = []
+        try:
+            while True:
+                if read == len(progress.songs):
+                    if progress.done:
+                        break
+                    try:
+                        await (asyncio.wait_for(progress.wait(), PLAYLIST_BATCH_FLUSH_SECONDS) if batch else progress.wait())
+                    except asyncio.TimeoutError:
+                        yield batch
+                        batch = []
+                    continue
+                song = progress.songs[read]
+                read += 1
+                batch.append(Track(**song, requester=requester.mention))
+                if read == 1 or len(batch) >= PLAYLIST_BATCH_SIZE:
+                    if read == 1:
+                        self._observe_fetch(started_at) # เวลาจนได้เพลงแรก (ผู้ใช้รอแค่นี้ก่อนเริ่มเล่น)
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            await asyncio.shield(flight) # ส่ง ExtractionBusy ต่อให้ผู้เรียก
+            if not read:
+                self._observe_fetch(started_at)
+        finally:
+            progress.readers -= 1
+            if not progress.readers and not progress.done:
+                # ไม่มีใครอ่านแล้ว: ให้ yt-dlp หยุดที่เพลงถัดไป และให้คำขอใหม่เริ่มดึงใหม่แทนการได้เพลย์ลิสต์ไม่ครบ
+                progress.stop.set()
+                self.song_list_flights.forget(cache_key)
+
+    async def _extract_playlist_lazily(self, cache_key: str, url: str, guild_id: int,
+                                       progress: _PlaylistProgress) -> list[dict] | None:
+        """ดึงเพลย์ลิสต์ทีละเพลงลง progress ให้ _stream_playlist อ่าน (ใช้ผ่าน song_list_flights) เก็บลงแคชเมื่อได้ครบ"""
+        loop = self.loop
+
+        def extract_lazily() -> bool:
+            """วนอ่าน entries ของเพลย์ลิสต์ (yt-dlp ดึงทีละหน้าเมื่ออ่านถึง) คืน True ถ้าอ่านครบทั้งเพลย์ลิสต์"""
+            ydl = self.ydl_pool.get('playlist')
+            try:
+                info = ydl.extract_info(url, download=False, process=False)
+                while info and info.get('_type') in ('url', 'url_transparent'):
+                    info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+                if not info:
+                    return False
+                if info.get('_type') not in ('playlist', 'multi_video'):
+                    info = ydl.process_ie_result(info, download=False)
+                    loop.call_soon_threadsafe(progress.add, _song_from_video(info))
+                    return True
+                for entry in info.get('entries') or []:
+                    if progress.stop.is_set():
+                        return False
+                    if entry:
+                        loop.call_soon_threadsafe(progress.add, _song_from_entry(entry, False))
+                return True
+            except _yt_dlp().utils.DownloadError as e:
+                print(f"เกิดข้อผิดพลาด yt-dlp ขณะดึงเพลย์ลิสต์ '{url}': {e}")
+                self._count_extraction_error(e)
+                return False
+            except Exception as e:
+                print(f"เกิดข้อผิดพลาดทั่วไปขณะดึงเพลย์ลิสต์ '{url}': {e}")
+                self._count_extraction_error(e)
+                self.ydl_pool.discard('playlist')
+                return False
+
+        try:
+            # เพลงที่ thread ส่งมาด้วย call_soon_threadsafe ถึง progress ก่อนที่ job นี้จะเสร็จเสมอ
+            complete = await self.extraction.submit(guild_id, extract_lazily, PRIORITY_INTERACTIVE)
+        finally:
+            progress.finish()
+            if self.playlist_progress.get(cache_key) is progress:
+                del self.playlist_progress[cache_key]
+        self._index_titles(progress.songs)
+        if complete and progress.songs: # เก็บลงแคชเฉพาะเมื่อได้ครบทั้งเพลย์ลิสต์
+            self._store_song_list(cache_key, progress.songs)
+        return progress.songs or None
+
+    def _remember_stream_urls(self, entries: list[tuple[str, dict]]):
+        """เก็บข้อมูล stream [(webpage_url, ข้อมูล stream)] ลงแคช โดยให้หมดอายุก่อนเวลา expire= จริงเล็กน้อย"""
+        shared = []
+        for webpage_url, stream_info in entries:
+            expires_at = stream_info['stream_expires'] - STREAM_URL_EXPIRY_MARGIN
+            self.stream_url_cache.put(webpage_url, stream_info, expires_at=expires_at)
+            shared.append((webpage_url, stream_info, expires_at))
+        if SHARED_STREAM_CACHE and shared:
+            self._write_store_later(f"บันทึก stream URL ที่ใช้ร่วมกัน {len(shared)} เพลง", self.metadata_store.put_stream_infos, shared)
+
+    async def _load_shared_stream_url(self, webpage_url: str) -> dict | None:
+        """อ่าน stream URL ที่ worker อื่นดึงไว้ (เฉพาะตอนแบ่ง shard, อ่านใน thread แยก) แล้วเก็บลงแคชในหน่วยความจำด้วย"""
+        if not SHARED_STREAM_CACHE:
+            return None
+        try:
+            stored = await self.loop.run_in_executor(None, self.metadata_store.get_stream_info, webpage_url)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะอ่าน stream URL ที่ใช้ร่วมกัน '{webpage_url}': {e}")
+            return None
+        if stored is None:
+            return None
+        stream_info, expires_at = stored
+        self.stream_url_cache.put(webpage_url, stream_info, expires_at=expires_at)
+        return stream_info
+
+    def _has_fresh_stream_url(self, song_data: Track) -> bool:
+        """ตรวจว่าเพลงมี stream URL ที่ยังไม่หมดอายุหรือไม่"""
+        if not song_data.stream_url:
+            return False
+        return song_data.stream_expires - STREAM_URL_EXPIRY_MARGIN > time.time()
+
+    async def _get_streamable_url(self, song_data: Track, guild_id: int, priority: int = PRIORITY_PLAYBACK) -> str | None:
         """
         ดึง URL ที่สามารถสตรีมได้สำหรับเพลง (ถ้าจำเป็น)
+        ใช้ URL ที่ดึงไว้ล่วงหน้าถ้ายังไม่หมดอายุ และรอผลเดิมถ้ากำลังดึงเพลงเดียวกันอยู่
         """
-        if song_data.get('stream_url') and not song_data.get('is_partial'):
-            return song_data['stream_url']
+        if not self.metrics or priority != PRIORITY_PLAYBACK: # วัดเฉพาะเพลงที่กำลังจะเล่น ไม่นับ prefetch
+            return await self._resolve_stream_url(song_data, guild_id, priority)
+        started_at = time.perf_counter()
+        try:
+            return await self._resolve_stream_url(song_data, guild_id, priority)
+        finally:
+            self.metrics.observe('musicbot_stream_url_seconds', time.perf_counter() - started_at)
+
+    async def _resolve_stream_url(self, song_data: Track, guild_id: int, priority: int) -> str | None:
+        if _is_library_url(song_data.webpage_url): # เพลงในคลังเพลงเล่นจากไฟล์บนดิสก์ ไม่เรียก yt-dlp
+            return self._library_path(song_data)
+        if self._has_fresh_stream_url(song_data):
+            return song_data.stream_url
+
+        webpage_url = song_data.webpage_url
+        cached = self.stream_url_cache.get(webpage_url) or await self._load_shared_stream_url(webpage_url)
+        if cached:
+            song_data.apply_stream_info(cached)
+            return song_data.stream_url
 
-        ydl_opts_single = YDL_OPTIONS_BASE.copy()
-        ydl_opts_single['extract_flat'] = False 
-        ydl_opts_single['noplaylist'] = True   
+        if webpage_url in self.stream_url_flights:
+            # อาจเป็นงาน prefetch ที่ยังรอคิวอยู่ ให้เลื่อนขึ้นมาตามความสำคัญของผู้รอคนนี้
+            self.extraction.promote(('stream', webpage_url), priority)
+        result = await self.stream_url_flights.do(
+            webpage_url, lambda: self._extract_stream_url(song_data, guild_id, priority))
+        if not result:
+            return None
+        song_data.apply_stream_info(result)
+        return song_data.stream_url
+
+    def _library_path(self, song_data: Track) -> str | None:
+        if self.library is None:
+            return None
+        try:
+            return self.library.path_of(song_data.webpage_url)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะอ่านไฟล์ของเพลง '{song_data.title}' จากคลังเพลง: {e}")
+            return None
 
+    async def _extract_stream_url(self, song_data: Track, guild_id: int, priority: int) -> dict | None:
+        """เรียก yt-dlp เพื่อดึงข้อมูล stream (ดู _stream_info) หรือ None ถ้าไม่สำเร็จ/คิวเต็ม"""
         def extract_single():
             try:
-                with yt_dlp.YoutubeDL(ydl_opts_single) as ydl:
-                    info = ydl.extract_info(song_data['webpage_url'], download=False)
-                    return info.get('url') 
+                info = self.ydl_pool.get('single').extract_info(song_data.webpage_url, download=False)
+                return _stream_info(info)
+            except _yt_dlp().utils.DownloadError as e:
+                print(f"เกิดข้อผิดพลาดขณะดึง stream URL สำหรับ '{song_data.title}': {e}")
+                self._count_extraction_error(e)
+                return None
             except Exception as e:
-                print(f"เกิดข้อผิดพลาดขณะดึง stream URL สำหรับ '{song_data.get('title')}': {e}")
+                print(f"เกิดข้อผิดพลาดขณะดึง stream URL สำหรับ '{song_data.title}': {e}")
+                self._count_extraction_error(e)
+                self.ydl_pool.discard('single')
                 return None
         
-        stream_url = await self.loop.run_in_executor(None, extract_single)
-        return stream_url
+        try:
+            stream_info = await self.extraction.submit(guild_id, extract_single, priority,
+                                                       key=('stream', song_data.webpage_url))
+        except ExtractionBusy:
+            return None
+        if not stream_info or not stream_info['stream_url']:
+            return None
+        self._remember_stream_urls([(song_data.webpage_url, stream_info)])
+        return stream_info
 
-    async def _play_next_song(self, interaction: discord.Interaction):
-        """เล่นเพลงถัดไปในคิว"""
-        guild_id = interaction.guild_id
+    def _schedule_prefetch(self, guild_id: int):
+        """เริ่มดึง stream URL ของเพลงถัดไปในคิวล่วงหน้า (ถ้ายังไม่ได้ทำอยู่)"""
+        if PREFETCH_AHEAD <= 0:
+            return
+        player = self._get_player(guild_id)
+        if player.prefetch_task and not player.prefetch_task.done():
+            return
+        player.prefetch_task = self.loop.create_task(self._prefetch_upcoming(guild_id))
+
+    def _cancel_prefetch(self, guild_id: int):
+        """ยกเลิกการดึง stream URL ล่วงหน้าของ guild"""
+        player = self.players.get(guild_id)
+        if player and player.prefetch_task:
+            player.prefetch_task.cancel()
+            player.prefetch_task = None
+
+    async def _prefetch_upcoming(self, guild_id: int):
+        """ดึง stream URL ของเพลง PREFETCH_AHEAD เพลงแรกในคิว ระหว่างที่เพลงปัจจุบันกำลังเล่น"""
         queue = self._get_queue(guild_id)
-        voice_client = self.voice_clients.get(guild_id)
+        attempted = set() # id ของเพลงที่ลองดึงแล้ว (กันการวนซ้ำเมื่อดึงไม่สำเร็จ)
+        # คิวอาจเปลี่ยนระหว่างรอ จึงตรวจหัวคิวใหม่ทุกรอบ
+        while True:
+            pending = [song for song in itertools.islice(queue, PREFETCH_AHEAD)
+                       if id(song) not in attempted and not self._has_fresh_stream_url(song)]
+            if not pending:
+                return
+            song = pending[0]
+            attempted.add(id(song))
+            await self._get_streamable_url(song, guild_id, PRIORITY_BACKGROUND)
 
-        if not voice_client or not voice_client.is_connected():
-            self.is_playing[guild_id] = False
-            self.current_songs[guild_id] = None
-            return
+    async def _play_song(self, player: GuildPlayer, song_to_play: Track, generation: int,
+                         transition_started: float | None = None) -> bool:
+        """
+        เริ่มเล่นเพลงหนึ่งเพลง (เรียกจากลูปของ GuildPlayer) คืนค่า False ถ้าเล่นไม่ได้และควรข้ามไปเพลงถัดไป
+        transition_started คือ time.perf_counter() ตอนที่เพลงก่อนหน้าจบ/ถูกข้าม (ใช้กับ metrics)
+        """
+        guild_id = player.guild_id
+        video_id = _audio_cache_key(song_to_play.webpage_url)
+        preloaded = await self._take_preloaded(player, song_to_play)
+        if preloaded:
+            stream_url, from_cache = preloaded.stream_url, preloaded.from_cache
+        else:
+            cached_path = await self.audio_cache.lookup(video_id) if self.audio_cache and video_id else None
+            from_cache = cached_path is not None
+            # เพลงที่มีไฟล์ในแคชเล่นจากดิสก์ได้เลย ไม่ต้องดึง stream URL
+            stream_url = cached_path or await self._get_streamable_url(song_to_play, guild_id)
+        self._schedule_prefetch(guild_id)
+        if not stream_url:
+            self._add_notice(player, f"ไม่สามารถดึง URL สตรีมสำหรับเพลง '{song_to_play.title}' ได้ จึงข้ามไป")
+            return False
 
-        if self.is_playing.get(guild_id, False) and not voice_client.is_playing() and not voice_client.is_paused():
-            pass 
+        voice_client = player.voice_client
+        if not voice_client or not voice_client.is_connected(): # ออกจากช่องเสียงระหว่างรอ stream URL
+            return False
+        audio_source = preloaded
+        if audio_source is None:
+            await self.governor.acquire(transition_started is not None, lambda: self._notify_start_queued(player, song_to_play))
+            if not voice_client.is_connected(): # ออกจากช่องเสียงระหว่างรอ FFMPEG
+                self.governor.release()
+                return False
+        try:
+            audio_source = audio_source or await self._create_governed_source(song_to_play, stream_url, voice_client)
+            audio_source = self._watch_first_packet(player, audio_source, transition_started)
+            voice_client.play(audio_source, after=lambda e: player._track_finished(generation, e))
+            player.track_started = time.monotonic() - song_to_play.start_offset
+            player.paused_at = None
+            song_to_play.start_offset = 0 # เล่นซ้ำ (เช่น /loop) ให้เริ่มจากต้นเพลง
+            self._arm_track_timers(player)
+            self._record_cache_play(song_to_play, stream_url, from_cache)
+        except Exception as e:
+            if audio_source is not None:
+                audio_source.cleanup() # ปิด FFMPEG และคืนช่องให้ governor
+            self._add_notice(player, f"เกิดข้อผิดพลาดขณะพยายามเล่นเพลง '{song_to_play.title}': {e}")
+            print(f"Playback error for '{song_to_play.title}': {e}")
+            return False
 
-        if not queue:
-            self.is_playing[guild_id] = False
-            self.current_songs[guild_id] = None
-            # Ensure interaction.channel is a TextChannel before sending
-            if isinstance(interaction.channel, discord.TextChannel):
-                 await interaction.channel.send("คิวเพลงหมดแล้ว")
-            self._start_idle_timer(guild_id, interaction.channel) 
-            return
+        self._update_now_playing(player, repost=True)
+        return True
 
-        self._cancel_idle_timer(guild_id) 
+    def _update_now_playing(self, player: GuildPlayer, repost: bool = False):
+        """นัดอัปเดตข้อความเพลงที่กำลังเล่นของ guild (รวมการเปลี่ยนแปลงที่ถี่เป็นการแก้ข้อความครั้งเดียว)"""
+        if player.now_playing is None:
+            if player.current is None and not player.notices:
+                return # ยังไม่เคยแสดงอะไร ไม่ต้องส่งข้อความว่าไม่มีเพลง
+            if not isinstance(player.text_channel, discord.TextChannel):
+                return
+            player.now_playing = CoalescedMessage(self.loop, functools.partial(self._render_now_playing, player),
+                                                  NOW_PLAYING_EDIT_INTERVAL, self.now_playing_stats)
+        player.now_playing.update(player.text_channel, repost)
 
-        song_to_play = queue.popleft()
-        self.current_songs[guild_id] = song_to_play
+    def _add_notice(self, player: GuildPlayer, text: str):
+        """แสดงข้อความแจ้งเตือนในข้อความเพลงที่กำลังเล่น (แทนการส่งข้อความใหม่ทุกครั้ง)"""
+        player.notices.append(text)
+        del player.notices[:-NOW_PLAYING_MAX_NOTICES]
+        self._update_now_playing(player)
+
+    def _render_now_playing(self, player: GuildPlayer) -> dict:
+        """embed ของเพลงที่กำลังเล่น พร้อมแถบความคืบหน้า เพลงถัดไป และการแจ้งเตือนของการเปลี่ยนเพลงครั้งล่าสุด"""
+        station = player.broadcast
+        if station is not None:
+            embed = discord.Embed(title=f"📻 กำลังฟังสถานี '{station.name}'", color=discord.Color.purple())
+            if station.current is not None:
+                embed.description = f"[{station.current.title}]({_link_url(station.current.webpage_url)})"
+                embed.add_field(name="ขอโดย", value=station.current.requester, inline=True)
+                if station.current.thumbnail:
+                    embed.set_thumbnail(url=station.current.thumbnail)
+            embed.add_field(name="ผู้ฟัง", value=f"{len(station.listeners)} เซิร์ฟเวอร์", inline=True)
+            if station.tracks:
+                embed.add_field(name="ถัดไปในสถานี", value=station.tracks[0].queue_line(), inline=False)
+            return {'embed': embed}
+        song = player.current
+        if song is None:
+            embed = discord.Embed(title="⏹️ ไม่มีเพลงที่กำลังเล่น", description="คิวเพลงหมดแล้ว", color=discord.Color.dark_grey())
+        else:
+            paused = player.paused_at is not None
+            embed = discord.Embed(title="⏸️ หยุดชั่วคราว" if paused else "🎧 กำลังเล่นเพลง",
+                                  description=f"[{song.title}]({_link_url(song.webpage_url)})", color=discord.Color.blue())
+            if song.duration:
+                position = min(player.position(), song.duration)
+                progress = _progress_bar(position, song.duration)
+                if paused:
+                    progress += f"\n{self._format_duration(position)} / {self._format_duration(song.duration)}"
+                else:
+                    # Discord นับเวลาถอยหลังให้เอง จึงไม่ต้องแก้ข้อความทุกวินาที
+                    ends_at = int(time.time() + song.duration - position)
+                    progress += f"\n{self._format_duration(song.duration)} • จบ <t:{ends_at}:R>"
+                embed.add_field(name="ความคืบหน้า", value=progress, inline=False)
+            embed.add_field(name="ขอโดย", value=song.requester, inline=True)
+            if song.thumbnail:
+                embed.set_thumbnail(url=song.thumbnail)
+            queue = player.queue
+            if queue:
+                lines = [f"{number}. {track.queue_line()}" for number, track in enumerate(queue[:NOW_PLAYING_UP_NEXT], start=1)]
+                if len(queue) > NOW_PLAYING_UP_NEXT:
+                    lines.append(f"และอีก {len(queue) - NOW_PLAYING_UP_NEXT} เพลง")
+                embed.add_field(name="ถัดไป", value="\n".join(lines), inline=False)
+        if player.notices:
+            embed.add_field(name="แจ้งเตือน", value="\n".join(player.notices)[:1024], inline=False)
+        return {'embed': embed}
 
-        stream_url = await self._get_streamable_url(song_to_play)
+    async def _open_broadcast_source(self, station: BroadcastStation, track: Track) -> discord.AudioSource | None:
+        """เปิด FFMPEG ของเพลงถัดไปของสถานี (เข้ารหัส Opus ครั้งเดียวให้ทุกห้อง และนับรวมใน governor เหมือนเพลงปกติ)"""
+        for guild_id in station.listeners:
+            self._update_now_playing(self.players[guild_id])
+        stream_url = await self._get_streamable_url(track, station.owner_guild_id)
         if not stream_url:
-            if isinstance(interaction.channel, discord.TextChannel):
-                await interaction.channel.send(f"ไม่สามารถดึง URL สตรีมสำหรับเพลง '{song_to_play['title']}' ได้ กำลังข้าม...")
-            self.current_songs[guild_id] = None
-            self.loop.create_task(self._play_next_song(interaction))
-            return
+            print(f"ไม่สามารถดึง URL สตรีมสำหรับเพลง '{track.title}' ของสถานี '{station.name}' จึงข้ามไป")
+            return None
+        await self.governor.acquire(True, lambda: None)
+        try:
+            source = await self._create_opus_source(track, stream_url, BROADCAST_BITRATE, self.governor.degraded())
+        except Exception as e:
+            self.governor.release()
+            print(f"ไม่สามารถเปิดเพลง '{track.title}' ของสถานี '{station.name}': {e}")
+            return None
+        return _GovernedSource(source, self._release_governor_slot)
 
+    async def _load_broadcast_playlist(self, station: BroadcastStation, url: str, requester: discord.User):
+        """ทยอยเพิ่มเพลงจากเพลย์ลิสต์เข้าสถานี (สถานีเริ่มเล่นตั้งแต่ได้เพลงแรก)"""
         try:
-            audio_source = discord.FFmpegPCMAudio(stream_url, **FFMPEG_OPTIONS)
-            voice_client.play(audio_source, after=lambda e: self._song_finished(guild_id, interaction, e))
-            self.is_playing[guild_id] = True
-            
-            embed = discord.Embed(title="🎧 กำลังเล่นเพลง", color=discord.Color.blue())
-            embed.add_field(name="ชื่อเพลง", value=f"[{song_to_play.get('title', 'N/A')}]({song_to_play.get('webpage_url', '#')})", inline=False)
-            if song_to_play.get('duration'):
-                embed.add_field(name="ความยาว", value=self._format_duration(song_to_play['duration']), inline=True)
-            embed.add_field(name="ขอโดย", value=song_to_play.get('requester', 'N/A'), inline=True)
-            if song_to_play.get('thumbnail'):
-                embed.set_thumbnail(url=song_to_play['thumbnail'])
-            
-            if isinstance(interaction.channel, discord.TextChannel):
-                await interaction.channel.send(embed=embed)
+            async with contextlib.aclosing(self._stream_playlist(url, requester, station.owner_guild_id)) as batches:
+                async for batch in batches:
+                    if station.closed:
+                        break
+                    station.add_tracks(batch[:QUEUE_HARD_LIMIT - len(station.tracks)])
+                    if len(station.tracks) >= QUEUE_HARD_LIMIT:
+                        break
+        except ExtractionBusy:
+            print(f"คิวงานดึงข้อมูลเต็ม หยุดโหลดเพลย์ลิสต์ของสถานี '{station.name}'")
+        finally:
+            station.finish_loading()
 
-        except Exception as e:
-            if isinstance(interaction.channel, discord.TextChannel):
-                await interaction.channel.send(f"เกิดข้อผิดพลาดขณะพยายามเล่นเพลง '{song_to_play.get('title', 'N/A')}': {e}")
-            print(f"Playback error for '{song_to_play.get('title', 'N/A')}': {e}")
-            self.is_playing[guild_id] = False
-            self.current_songs[guild_id] = None
-            self.loop.create_task(self._play_next_song(interaction)) 
+    def _broadcast_closed(self, station: BroadcastStation):
+        """callback เมื่อสถานีปิด (ผู้ฟังแต่ละ guild กลับไปเล่นคิวของตัวเองผ่าน event จบเพลงของ discord.py)"""
+        key = _station_key(station.name)
+        if self.broadcasts.get(key) is station:
+            del self.broadcasts[key]
+        self.broadcast_skipped_frames += station.buffer.skipped
+        print(f"ปิดสถานี broadcast '{station.name}' แล้ว")
 
-    def _song_finished(self, guild_id: int, interaction: discord.Interaction, error=None):
-        """Callback เมื่อเพลงเล่นจบ"""
-        if error:
-            print(f"เกิดข้อผิดพลาดระหว่างเล่นเพลงใน Guild {guild_id}: {error}")
+    def _notify_start_queued(self, player: GuildPlayer, song: Track):
+        """แจ้งผู้ใช้ว่าเพลงต้องรอก่อนเริ่มเล่นเพราะเครื่องทำงานหนัก"""
+        self._add_notice(player, f"ตอนนี้บอทกำลังเล่นเพลงในหลายเซิร์ฟเวอร์ เพลง '{song.title}' จะเริ่มเล่นเมื่อเครื่องว่างพอ")
 
-        vc = self.voice_clients.get(guild_id)
-        if not vc or not vc.is_connected():
-            self.is_playing[guild_id] = False
-            self.current_songs[guild_id] = None
-            return
+    async def _create_governed_source(self, song_data: Track, stream_url: str, voice_client: discord.VoiceClient) -> discord.AudioSource:
+        """สร้าง audio source หลังจองช่องจาก governor แล้ว (คืนช่องเมื่อ source ถูก cleanup หรือสร้างไม่สำเร็จ)"""
+        try:
+            source = await self._create_audio_source(song_data, stream_url, voice_client, self.governor.degraded())
+        except BaseException:
+            self.governor.release()
+            raise
+        return _GovernedSource(source, self._release_governor_slot)
+
+    def _release_governor_slot(self):
+        """คืนช่องของ governor จาก thread ใดก็ได้ (source อาจถูก cleanup หลัง loop ปิดไปแล้วตอนบอทหยุดทำงาน)"""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.governor.release)
+
+    async def _create_audio_source(self, song_data: Track, stream_url: str, voice_client: discord.VoiceClient,
+                                   degraded: bool = False) -> discord.AudioSource:
+        """
+        สร้าง audio source ตาม PLAYBACK_MODE (passthrough จะถอยกลับไปใช้การแปลงเสียงแบบเดิมถ้าทำไม่ได้)
+        degraded=True ใช้ filter ที่กิน CPU น้อยกว่า (ตอนเครื่องทำงานหนัก)
+        """
+        if PLAYBACK_MODE == 'passthrough':
+            try:
+                return await self._create_opus_source(song_data, stream_url, getattr(voice_client.channel, 'bitrate', 64000), degraded)
+            except Exception as e:
+                print(f"ไม่สามารถเล่นแบบ passthrough สำหรับ '{song_data.title}': {e} กำลังใช้การแปลงเสียงแบบเดิม")
+        volume_filter = await self._measured_volume_filter(song_data, stream_url)
+        if degraded:
+            return discord.FFmpegPCMAudio(stream_url, before_options=_ffmpeg_before_options(stream_url, song_data.start_offset),
+                                          options=f'-vn -filter:a {volume_filter or PASSTHROUGH_VOLUME_FILTER},{FFMPEG_DEGRADED_RESAMPLE}')
+        if volume_filter:
+            return discord.FFmpegPCMAudio(stream_url, before_options=_ffmpeg_before_options(stream_url, song_data.start_offset),
+                                          options=f'-vn -filter:a {volume_filter}')
+        return discord.FFmpegPCMAudio(stream_url, before_options=_ffmpeg_before_options(stream_url, song_data.start_offset),
+                                      options=FFMPEG_OPTIONS['options'])
+
+    def _cached_audio_path(self, video_id: str) -> str | None:
+        """path ของเพลงใน AudioCache (ให้ LoudnessAnalyzer วัดจากไฟล์แทน stream)"""
+        return self.audio_cache.cached_path(_audio_cache_name(video_id)) if self.audio_cache else None
+
+    async def _measured_volume_filter(self, song_data: Track, stream_url: str) -> str | None:
+        """
+        คืน volume filter จากความดังที่วัดไว้ของเพลง
+        ถ้ายังไม่เคยวัดจะส่งไปวัดเบื้องหลังและคืน None (ให้ใช้ filter เดิมไปก่อน)
+        """
+        video_id = _video_id(song_data.webpage_url)
+        if not video_id:
+            return None
+        try:
+            measured = await self.loudness_analyzer.lookup(video_id)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะอ่านค่าความดังของเพลง '{video_id}': {e}")
+            return None
+        if measured is None:
+            if song_data.duration: # ไม่วัด live stream
+                self.loudness_analyzer.submit(video_id, stream_url)
+            return None
+        return f'volume={_loudness_gain(*measured):.4f}'
 
-        self.loop.create_task(self._play_next_song(interaction))
+    async def _create_opus_source(self, song_data: Track, stream_url: str, channel_bitrate: int,
+                                  degraded: bool = False) -> discord.FFmpegOpusAudio:
+        """
+        คัดลอกแพ็กเก็ต Opus ตรงไปยัง Discord ถ้า stream เป็น Opus และ bitrate ไม่สูงเกินห้อง (channel_bitrate เป็น bps)
+        ไม่เช่นนั้นให้ FFmpeg เข้ารหัส Opus เอง (ไม่ต้องผ่าน PCM และตัวเข้ารหัสใน Python)
+        """
+        is_local = not stream_url.startswith(('http://', 'https://'))
+        # ไฟล์ในแคชอาจมาจาก format อื่นที่ไม่ใช่ของ stream ปัจจุบัน จึง probe เสมอ (ไฟล์ในเครื่อง probe ได้เร็ว)
+        codec, bitrate = (None, None) if is_local else (song_data.stream_acodec, song_data.stream_abr)
+        if not codec:
+            codec, bitrate = await discord.FFmpegOpusAudio.probe(stream_url)
+        channel_kbps = max(16, min(512, channel_bitrate // 1000))
+
+        if codec == 'opus' and bitrate and bitrate <= channel_kbps * OPUS_PASSTHROUGH_MAX_BITRATE_RATIO:
+            # codec='opus' ทำให้ discord.py สั่ง FFmpeg ใช้ -c:a copy
+            return discord.FFmpegOpusAudio(stream_url, codec='opus', before_options=_ffmpeg_before_options(stream_url, song_data.start_offset),
+                                           options='-vn')
+        volume_filter = await self._measured_volume_filter(song_data, stream_url) or PASSTHROUGH_VOLUME_FILTER
+        if degraded:
+            return discord.FFmpegOpusAudio(stream_url, bitrate=channel_kbps, before_options=_ffmpeg_before_options(stream_url, song_data.start_offset),
+                                           options=f'-vn -filter:a {volume_filter},{FFMPEG_DEGRADED_RESAMPLE} {FFMPEG_DEGRADED_OPUS_OPTIONS}')
+        return discord.FFmpegOpusAudio(stream_url, bitrate=channel_kbps, before_options=_ffmpeg_before_options(stream_url, song_data.start_offset),
+                                       options=f'-vn -filter:a {volume_filter}')
 
     def _format_duration(self, duration_seconds: int) -> str:
         """แปลงวินาทีเป็นรูปแบบ HH:MM:SS หรือ MM:SS"""
@@ -263,47 +3645,48 @@ class MusicCog(commands.Cog):
         """เริ่มนับเวลาถอยหลังเพื่อตัดการเชื่อมต่อเมื่อไม่ได้ใช้งาน"""
         self._cancel_idle_timer(guild_id) 
 
-        async def disconnect_after_idle():
-            await asyncio.sleep(60) 
-            voice_client = self.voice_clients.get(guild_id)
-            if voice_client and voice_client.is_connected() and not self.is_playing.get(guild_id, False):
-                queue = self._get_queue(guild_id)
-                if not queue and not self.is_playing.get(guild_id, False) : 
-                    await voice_client.disconnect()
-                    self.voice_clients.pop(guild_id, None)
-                    self.is_playing.pop(guild_id, None)
-                    self.current_songs.pop(guild_id, None)
-                    # Try to send to the original interaction's channel if possible,
-                    # otherwise fall back to a known text channel.
-                    target_channel = text_channel_like
-                    if not isinstance(target_channel, discord.TextChannel): # If it was an interaction.channel that's not TextChannel
-                        guild = self.bot.get_guild(guild_id)
-                        if guild and guild.text_channels:
-                             target_channel = guild.text_channels[0] # Fallback
-                        else:
-                            target_channel = None # Cannot send message
-
-                    if target_channel and isinstance(target_channel, discord.abc.Messageable):
-                        try:
-                            await target_channel.send("ออกจากช่องเสียงเนื่องจากไม่มีการใช้งานเป็นเวลา 1 นาที")
-                        except discord.Forbidden:
-                            print(f"Bot lacks permission to send messages in {target_channel.name} (guild {guild_id})")
-                        except Exception as e:
-                            print(f"Error sending auto-disconnect message: {e}")
-            self.idle_timers.pop(guild_id, None)
-
-        voice_client = self.voice_clients.get(guild_id)
+        player = self._get_player(guild_id)
+        voice_client = player.voice_client
         if voice_client and voice_client.is_connected():
-            is_bot_alone = len(voice_client.channel.members) <= 1 
-            queue = self._get_queue(guild_id)
-            if (not queue and not self.is_playing.get(guild_id, False)) or is_bot_alone:
-                self.idle_timers[guild_id] = self.loop.create_task(disconnect_after_idle())
+            is_bot_alone = player.listeners == 0
+            if (not player.queue and not player.is_playing) or is_bot_alone:
+                player.idle_channel = text_channel_like
+                self.idle_timers.arm(guild_id, IDLE_TIMEOUT_SECONDS)
 
     def _cancel_idle_timer(self, guild_id: int):
         """ยกเลิก timer การตัดการเชื่อมต่ออัตโนมัติ"""
-        if guild_id in self.idle_timers:
-            self.idle_timers[guild_id].cancel()
-            self.idle_timers.pop(guild_id, None)
+        self.idle_timers.cancel(guild_id)
+
+    def _idle_expired(self, guild_id: int):
+        """callback ของ idle_timers เมื่อ guild ไม่ได้ใช้งานครบเวลา"""
+        self.loop.create_task(self._disconnect_idle(guild_id))
+
+    async def _disconnect_idle(self, guild_id: int):
+        """ออกจากช่องเสียงถ้ายังไม่มีการใช้งาน แล้วแจ้งในช่องข้อความ"""
+        player = self._get_player(guild_id)
+        voice_client = player.voice_client
+        if voice_client and voice_client.is_connected() and not player.is_playing:
+            if not player.queue and not player.is_playing:
+                await voice_client.disconnect()
+                player.reset()
+                # Try to send to the original interaction's channel if possible,
+                # otherwise fall back to a known text channel.
+                target_channel = player.idle_channel
+                if not isinstance(target_channel, discord.TextChannel): # If it was an interaction.channel that's not TextChannel
+                    guild = self.bot.get_guild(guild_id)
+                    if guild and guild.text_channels:
+                         target_channel = guild.text_channels[0] # Fallback
+                    else:
+                        target_channel = None # Cannot send message
+
+                if target_channel and isinstance(target_channel, discord.abc.Messageable):
+                    try:
+                        await target_channel.send(f"ออกจากช่องเสียงเนื่องจากไม่มีการใช้งานเป็นเวลา {IDLE_TIMEOUT_SECONDS:g} วินาที")
+                    except discord.Forbidden:
+                        print(f"Bot lacks permission to send messages in {target_channel.name} (guild {guild_id})")
+                    except Exception as e:
+                        print(f"Error sending auto-disconnect message: {e}")
+        player.idle_channel = None
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
@@ -312,37 +3695,36 @@ class MusicCog(commands.Cog):
             return
 
         guild_id = member.guild.id
-        voice_client = self.voice_clients.get(guild_id)
+        player = self.players.get(guild_id)
+        voice_client = player.voice_client if player else None
 
         if not voice_client or not voice_client.is_connected():
             return 
 
-        if member.id == self.bot.user.id and after.channel is None:
-            self.is_playing.pop(guild_id, None)
-            self.current_songs.pop(guild_id, None)
-            self.voice_clients.pop(guild_id, None)
-            self._cancel_idle_timer(guild_id)
-            print(f"บอทถูกตัดการเชื่อมต่อจากช่องเสียงใน Guild {guild_id}")
+        if member.id == self.bot.user.id:
+            if after.channel is None:
+                player.reset()
+                print(f"บอทถูกตัดการเชื่อมต่อจากช่องเสียงใน Guild {guild_id}")
+            elif before.channel != after.channel: # บอทถูกย้ายช่อง นับผู้ฟังในช่องใหม่ครั้งเดียว
+                player.listeners = _count_listeners(after.channel)
+                self._record_session(player)
             return
 
-        text_channel_for_notification = voice_client.channel.guild.text_channels[0] if voice_client.channel.guild.text_channels else None
-
-
-        if before.channel == voice_client.channel and after.channel != voice_client.channel:
-            if len(voice_client.channel.members) <= 1: 
-                queue = self._get_queue(guild_id)
-                if not queue and not self.is_playing.get(guild_id, False):
-                    if text_channel_for_notification:
-                        self._start_idle_timer(guild_id, text_channel_for_notification)
-                elif len(voice_client.channel.members) <= 1: 
-                     if text_channel_for_notification:
-                        self._start_idle_timer(guild_id, text_channel_for_notification)
+        if before.channel == after.channel: # เปลี่ยนแค่สถานะ mute/deafen
+            return
 
+        # นับผู้ฟังแบบ incremental จากการเข้า/ออกของสมาชิก แทนการนับ channel.members ใหม่ทุก event
+        if before.channel == voice_client.channel:
+            player.listeners = max(0, player.listeners - 1)
+            if player.listeners == 0:
+                text_channel_for_notification = voice_client.channel.guild.text_channels[0] if voice_client.channel.guild.text_channels else None
+                if text_channel_for_notification:
+                    self._start_idle_timer(guild_id, text_channel_for_notification)
 
-        if after.channel == voice_client.channel and member.id != self.bot.user.id:
+        elif after.channel == voice_client.channel:
+            player.listeners += 1
             if guild_id in self.idle_timers:
-                if len(voice_client.channel.members) > 1:
-                    self._cancel_idle_timer(guild_id)
+                self._cancel_idle_timer(guild_id)
 
     # --- Slash Commands ---
     @discord.app_commands.command(name="join", description="ให้บอทเข้าร่วมช่องเสียงของคุณ")
@@ -357,19 +3739,16 @@ class MusicCog(commands.Cog):
     async def leave(self, interaction: discord.Interaction):
         await interaction.response.defer()
         guild_id = interaction.guild_id
-        voice_client = self.voice_clients.get(guild_id)
+        player = self._get_player(guild_id)
+        voice_client = player.voice_client
 
         if voice_client and voice_client.is_connected():
-            queue = self._get_queue(guild_id)
-            queue.clear() 
-            self.is_playing[guild_id] = False
-            self.current_songs[guild_id] = None
+            player.queue.clear() 
+            player.reset()
             if voice_client.is_playing() or voice_client.is_paused():
                 voice_client.stop()
             
             await voice_client.disconnect()
-            self.voice_clients.pop(guild_id, None)
-            self._cancel_idle_timer(guild_id)
             await interaction.followup.send("ออกจากช่องเสียงแล้ว และล้างคิวเพลงทั้งหมด")
         else:
             await interaction.followup.send("บอทไม่ได้อยู่ในช่องเสียงใดๆ", ephemeral=True)
@@ -385,16 +3764,31 @@ class MusicCog(commands.Cog):
 
         guild_id = interaction.guild_id
         self._cancel_idle_timer(guild_id) 
+        player = self._get_player(guild_id)
+        player.text_channel = interaction.channel
+        self._record_session(player)
+        if self.metrics and not player.is_playing:
+            player.play_requested_at = time.perf_counter()
+
+        if _is_playlist_url(query):
+            await self._play_streamed_playlist(interaction, query)
+            return
 
-        songs_data = await self._fetch_song_data(query, interaction.user)
+        try:
+            songs_data = await self._fetch_song_data(query, interaction.user, guild_id)
+        except ExtractionBusy:
+            await interaction.followup.send("ตอนนี้บอทกำลังดึงข้อมูลเพลงอยู่หลายรายการ โปรดลองใหม่อีกครั้งในอีกสักครู่")
+            if not player.queue and not player.is_playing:
+                self._start_idle_timer(guild_id, interaction.channel)
+            return
 
         if not songs_data:
             await interaction.followup.send(f"ไม่พบผลลัพธ์สำหรับ '{query}' หรือเกิดข้อผิดพลาดในการดึงข้อมูล")
-            if not self._get_queue(guild_id) and not self.is_playing.get(guild_id, False):
+            if not player.queue and not player.is_playing:
                 self._start_idle_timer(guild_id, interaction.channel)
             return
 
-        queue = self._get_queue(guild_id)
+        queue = player.queue
         added_count = 0
         is_playlist = len(songs_data) > 1
 
@@ -403,133 +3797,152 @@ class MusicCog(commands.Cog):
                 queue.append(song_info)
                 added_count += 1
             else:
-                await interaction.followup.send(f"คิวเต็มแล้ว (สูงสุด {queue.maxlen} เพลง). ไม่สามารถเพิ่ม '{song_info.get('title', 'N/A')}' ได้", ephemeral=True)
+                await interaction.followup.send(f"คิวเต็มแล้ว (สูงสุด {queue.maxlen} เพลง). ไม่สามารถเพิ่ม '{song_info.title}' ได้", ephemeral=True)
                 break 
 
-        if added_count == 0 and not songs_data: 
-             await interaction.followup.send(f"ไม่พบเพลงสำหรับ '{query}'")
-             return
-        elif added_count == 0 and songs_data: 
-            pass
-
-
         if is_playlist and added_count > 0:
             await interaction.followup.send(f"เพิ่ม {added_count} เพลงจากเพลย์ลิสต์เข้าคิวเรียบร้อยแล้ว")
         elif not is_playlist and added_count > 0:
-             await interaction.followup.send(f"เพิ่มเพลง '{songs_data[0].get('title', 'N/A')}' เข้าคิวแล้ว")
+             await interaction.followup.send(f"เพิ่มเพลง '{songs_data[0].title}' เข้าคิวแล้ว")
 
 
-        if not self.is_playing.get(guild_id, False) and queue:
-            self.loop.create_task(self._play_next_song(interaction))
-        elif not queue and not self.is_playing.get(guild_id, False):
+        if queue:
+            player.post(PLAYER_PLAY)
+        elif not player.is_playing:
             self._start_idle_timer(guild_id, interaction.channel)
 
 
+    async def _play_streamed_playlist(self, interaction: discord.Interaction, url: str):
+        """เพิ่มเพลงจากเพลย์ลิสต์เข้าคิวทีละชุดระหว่างที่ยังโหลดอยู่ เริ่มเล่นตั้งแต่ได้เพลงแรก แล้วสรุปครั้งเดียวตอนจบ"""
+        guild_id = interaction.guild_id
+        player = self._get_player(guild_id)
+        queue = player.queue
+        added_count = 0
+        queue_full = False
+        try:
+            async with contextlib.aclosing(self._stream_playlist(url, interaction.user, guild_id)) as batches:
+                async for batch in batches:
+                    for song_info in batch:
+                        if len(queue) >= queue.maxlen:
+                            queue_full = True
+                            break
+                        queue.append(song_info)
+                        added_count += 1
+                    if queue:
+                        player.post(PLAYER_PLAY) # เพลงแรกเริ่มเล่นทันที ชุดต่อ ๆ ไปแค่เตรียม stream URL ล่วงหน้า
+                    if queue_full:
+                        break
+        except ExtractionBusy:
+            await interaction.followup.send("ตอนนี้บอทกำลังดึงข้อมูลเพลงอยู่หลายรายการ โปรดลองใหม่อีกครั้งในอีกสักครู่")
+            if not queue and not player.is_playing:
+                self._start_idle_timer(guild_id, interaction.channel)
+            return
+
+        if added_count == 0 and not queue_full:
+            await interaction.followup.send(f"ไม่พบผลลัพธ์สำหรับ '{url}' หรือเกิดข้อผิดพลาดในการดึงข้อมูล")
+            if not queue and not player.is_playing:
+                self._start_idle_timer(guild_id, interaction.channel)
+            return
+
+        if added_count == 0:
+            await interaction.followup.send(f"คิวเต็มแล้ว (สูงสุด {queue.maxlen} เพลง) ไม่สามารถเพิ่มเพลงจากเพลย์ลิสต์ได้", ephemeral=True)
+            return
+
+        summary = f"เพิ่ม {added_count} เพลงจากเพลย์ลิสต์เข้าคิวเรียบร้อยแล้ว"
+        if queue_full:
+            summary += f" (คิวเต็มแล้ว สูงสุด {queue.maxlen} เพลง เพลงที่เหลือจึงไม่ถูกเพิ่ม)"
+        await interaction.followup.send(summary)
+
+    @play.autocomplete('query')
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str) -> list[discord.app_commands.Choice[str]]:
+        """
+        แนะนำเพลงจากคลังเพลงในเครื่องก่อน ตามด้วยเพลงที่เคยขอจาก index ในหน่วยความจำ
+        (ไม่เรียก yt-dlp เพราะ Discord ให้เวลาตอบแค่ 3 วินาที)
+        """
+        if current.lstrip().startswith(('http://', 'https://')):
+            return []
+        suggestions = []
+        if self.library is not None:
+            try:
+                suggestions = [("📁 " + song['title'], song['webpage_url']) for song in self.library.search(current, AUTOCOMPLETE_CHOICES)]
+            except sqlite3.Error as e:
+                print(f"เกิดข้อผิดพลาดขณะค้นหาในคลังเพลง '{current}': {e}")
+        if self.autocomplete is not None and len(suggestions) < AUTOCOMPLETE_CHOICES:
+            listed = {webpage_url for _, webpage_url in suggestions}
+            suggestions += [suggestion for suggestion in self.autocomplete.search(current, AUTOCOMPLETE_CHOICES)
+                            if suggestion[1] not in listed]
+        choices = []
+        for title, webpage_url in suggestions[:AUTOCOMPLETE_CHOICES]:
+            if len(title) > AUTOCOMPLETE_CHOICE_MAX_CHARS:
+                title = title[:AUTOCOMPLETE_CHOICE_MAX_CHARS - 3] + "..."
+            choices.append(discord.app_commands.Choice(name=title, value=webpage_url))
+        return choices
+
     @discord.app_commands.command(name="skip", description="ข้ามเพลงปัจจุบัน")
     async def skip(self, interaction: discord.Interaction):
         await interaction.response.defer()
         guild_id = interaction.guild_id
-        voice_client = self.voice_clients.get(guild_id)
+        player = self.players.get(guild_id)
 
-        if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
-            voice_client.stop() 
+        if player and player.broadcast is not None:
+            await interaction.followup.send("กำลังฟังสถานี broadcast อยู่ ใช้ /broadcast leave เพื่อกลับมาเล่นคิวของเซิร์ฟเวอร์นี้", ephemeral=True)
+        elif player and player.is_playing:
+            player.post(PLAYER_SKIP)
             await interaction.followup.send("ข้ามเพลงปัจจุบันแล้ว")
         else:
             await interaction.followup.send("ไม่มีเพลงกำลังเล่นอยู่", ephemeral=True)
 
+    def _queue_page_embed(self, guild_id: int, page: int) -> tuple[discord.Embed, int, int]:
+        """
+        สร้าง embed ของหน้า page ในคิว คืนค่า (embed, หน้าที่แสดงจริง, จำนวนหน้า)
+        อ่านเฉพาะเพลงในหน้านั้น (slice ของ list ขนาดเท่าหน้า) และใช้ embed เดิมถ้าคิวกับเพลงที่กำลังเล่นไม่เปลี่ยน
+        """
+        player = self._get_player(guild_id)
+        queue = player.queue
+        current_song = player.current
+        page_count = max(1, math.ceil(len(queue) / QUEUE_PAGE_SIZE))
+        page = max(1, min(page, page_count))
+
+        cached = player.queue_pages
+        # maxlen อยู่ใน footer แต่ /queuelimit เปลี่ยนโดยไม่เพิ่ม version จึงต้องอยู่ใน key ด้วย
+        key = (queue.version, queue.maxlen)
+        if cached is None or cached[0][0] != key or cached[0][1] is not current_song:
+            cached = player.queue_pages = ((key, current_song), {})
+        embed = cached[1].get(page)
+        if embed is not None:
+            return embed, page, page_count
+
+        embed = discord.Embed(title="🎶 คิวเพลงปัจจุบัน 🎶", color=discord.Color.purple())
+        if current_song:
+            embed.add_field(name="▶️ กำลังเล่น", value=current_song.queue_line(), inline=False)
+        if queue:
+            start = (page - 1) * QUEUE_PAGE_SIZE
+            embed.description = "\n".join(f"{start + i + 1}. {song_data.queue_line()}"
+                                           for i, song_data in enumerate(queue[start:start + QUEUE_PAGE_SIZE]))
+        else:
+            embed.description = "ไม่มีเพลงในคิว"
+        embed.set_footer(text=f"หน้า {page}/{page_count} • จำนวนเพลงในคิว: {len(queue)}/{queue.maxlen}")
+        cached[1][page] = embed
+        return embed, page, page_count
+
     @discord.app_commands.command(name="queue", description="แสดงคิวเพลงปัจจุบัน")
-    async def show_queue(self, interaction: discord.Interaction):
+    @discord.app_commands.describe(page="หน้าที่ต้องการดู")
+    async def show_queue(self, interaction: discord.Interaction, page: discord.app_commands.Range[int, 1] = 1):
         await interaction.response.defer(ephemeral=True)
         guild_id = interaction.guild_id
-        queue = self._get_queue(guild_id)
-        current_song = self.current_songs.get(guild_id)
+        player = self._get_player(guild_id)
+        queue = player.queue
+        current_song = player.current
 
         if not queue and not current_song:
             await interaction.followup.send("คิวเพลงว่างเปล่า และไม่มีเพลงกำลังเล่น", ephemeral=True)
             return
 
-        embed = discord.Embed(title="🎶 คิวเพลงปัจจุบัน 🎶", color=discord.Color.purple())
-        
-        if current_song:
-            embed.add_field(
-                name="▶️ กำลังเล่น",
-                value=f"[{current_song.get('title', 'N/A')}]({current_song.get('webpage_url', '#')}) (ขอโดย: {current_song.get('requester', 'N/A')})",
-                inline=False
-            )
-        
-        # --- MODIFIED SECTION FOR QUEUE DISPLAY ---
-        if queue:
-            queue_list = list(queue) 
-            output_lines = []
-            current_char_count = 0
-            MAX_CHARS = 1024 
-            REMAINDER_MSG_BUFFER = 35 # Approx chars for "... และอีก XX เพลง"
-
-            num_songs_actually_displayed = 0
-
-            for i, song_data in enumerate(queue_list):
-                line = f"{i + 1}. [{song_data.get('title', 'เพลงไม่ทราบชื่อ')}]({song_data.get('webpage_url', '#')}) (ขอโดย: {song_data.get('requester', 'ไม่ระบุ')})\n"
-
-                if len(line) > MAX_CHARS: # Highly unlikely for a single line, but a safeguard
-                    line = line[:MAX_CHARS - 4] + "...\n" 
-
-                # Check if adding this line would exceed the allowed space before the "remainder" message
-                # or if it's the very first line and it's too long even for the full MAX_CHARS
-                if (current_char_count + len(line) > MAX_CHARS - REMAINDER_MSG_BUFFER and num_songs_actually_displayed > 0) or \
-                   (num_songs_actually_displayed == 0 and len(line) > MAX_CHARS): # First line itself is too long
-                    if num_songs_actually_displayed == 0 and len(line) > MAX_CHARS: # First song is too long for the whole field
-                        output_lines.append(line[:MAX_CHARS - 4] + "...\n")
-                        current_char_count += len(output_lines[0])
-                        num_songs_actually_displayed = 1
-                    break 
-                
-                # If it's the first song and it fits (even if it uses up most of the space)
-                if num_songs_actually_displayed == 0 and current_char_count + len(line) > MAX_CHARS:
-                     output_lines.append(line[:MAX_CHARS -4] + "...\n")
-                     current_char_count += len(output_lines[0])
-                     num_songs_actually_displayed = 1
-                     break
-
-
-                output_lines.append(line)
-                current_char_count += len(line)
-                num_songs_actually_displayed += 1
-            
-            final_queue_text = "".join(output_lines)
-            remaining_in_queue_count = len(queue_list) - num_songs_actually_displayed
-
-            if remaining_in_queue_count > 0:
-                remainder_msg_str = f"\n... และอีก {remaining_in_queue_count} เพลง"
-                if current_char_count + len(remainder_msg_str) <= MAX_CHARS:
-                    final_queue_text += remainder_msg_str
-                else: # Not enough space for full remainder, just add ellipsis if possible
-                    if MAX_CHARS - current_char_count > 3: # Check if there's space for "..."
-                         final_queue_text = final_queue_text[:MAX_CHARS - 3] + "..."
-                    else: # No space at all, final_queue_text might already be at MAX_CHARS or truncated
-                         final_queue_text = final_queue_text[:MAX_CHARS-3] + "..."
-
-
-            if not final_queue_text and queue_list: 
-                final_queue_text = "คิวเพลงยาวเกินไปที่จะแสดงผลทั้งหมด"
-            elif not queue_list and not current_song: # No queue and no current song was handled earlier
-                final_queue_text = "ไม่มีเพลงในคิว"
-            elif not queue_list and current_song: # Current song exists, but queue is empty
-                 final_queue_text = "ไม่มีเพลงในคิว"
-
-
-            # Final safety truncate
-            if len(final_queue_text) > MAX_CHARS:
-                final_queue_text = final_queue_text[:MAX_CHARS - 3] + "..."
-            
-            field_title = f"📜 รายการถัดไป ({num_songs_actually_displayed}/{len(queue_list)})" if queue_list else "📜 รายการถัดไป"
-            embed.add_field(name=field_title, value=final_queue_text if final_queue_text else "ไม่มีเพลงในคิว", inline=False)
-        elif current_song : # Current song exists, but queue is empty
-            embed.add_field(name="📜 รายการถัดไป", value="ไม่มีเพลงในคิว", inline=False)
-        # If no current_song and no queue, it's handled by the initial check.
-        # --- END OF MODIFIED SECTION ---
-
-        embed.set_footer(text=f"จำนวนเพลงในคิว: {len(queue)}/{queue.maxlen}")
-        await interaction.followup.send(embed=embed, ephemeral=True)
+        embed, page, page_count = self._queue_page_embed(guild_id, page)
+        if page_count > 1:
+            await interaction.followup.send(embed=embed, view=QueuePageView(self, guild_id, page, page_count), ephemeral=True)
+        else:
+            await interaction.followup.send(embed=embed, ephemeral=True)
 
     @discord.app_commands.command(name="remove", description="ลบเพลงออกจากคิวตามหมายเลข")
     @discord.app_commands.describe(index="หมายเลขเพลงในคิวที่จะลบ (ดูจาก /queue)")
@@ -544,16 +3957,49 @@ class MusicCog(commands.Cog):
 
         if 1 <= index <= len(queue):
             try:
-                temp_list = list(queue)
-                removed_song = temp_list.pop(index - 1)
-                queue.clear()
-                queue.extend(temp_list) 
-                await interaction.followup.send(f"ลบเพลง '{removed_song.get('title', 'N/A')}' ออกจากคิวแล้ว", ephemeral=True)
+                removed_song = queue.pop(index - 1)
+                await interaction.followup.send(f"ลบเพลง '{removed_song.title}' ออกจากคิวแล้ว", ephemeral=True)
             except IndexError:
                  await interaction.followup.send("หมายเลขเพลงไม่ถูกต้อง", ephemeral=True)
         else:
             await interaction.followup.send(f"โปรดระบุหมายเลขระหว่าง 1 ถึง {len(queue)}", ephemeral=True)
 
+    @discord.app_commands.command(name="move", description="ย้ายเพลงในคิวไปยังตำแหน่งใหม่")
+    @discord.app_commands.describe(source="หมายเลขเพลงที่จะย้าย (ดูจาก /queue)", destination="ตำแหน่งใหม่ในคิว")
+    async def move(self, interaction: discord.Interaction, source: int, destination: int):
+        await interaction.response.defer(ephemeral=True)
+        guild_id = interaction.guild_id
+        queue = self._get_queue(guild_id)
+
+        if not queue:
+            await interaction.followup.send("คิวเพลงว่างเปล่า", ephemeral=True)
+            return
+
+        if 1 <= source <= len(queue) and 1 <= destination <= len(queue):
+            moved_song = queue.move(source - 1, destination - 1)
+            await interaction.followup.send(f"ย้ายเพลง '{moved_song.title}' ไปยังตำแหน่งที่ {destination} แล้ว", ephemeral=True)
+            if destination <= PREFETCH_AHEAD:
+                self._schedule_prefetch(guild_id)
+        else:
+            await interaction.followup.send(f"โปรดระบุหมายเลขระหว่าง 1 ถึง {len(queue)}", ephemeral=True)
+
+    @discord.app_commands.command(name="queuelimit", description="ตั้งจำนวนเพลงสูงสุดในคิวของเซิร์ฟเวอร์นี้")
+    @discord.app_commands.describe(limit=f"จำนวนเพลงสูงสุด (1 ถึง {QUEUE_HARD_LIMIT})")
+    @discord.app_commands.default_permissions(manage_guild=True)
+    async def queuelimit(self, interaction: discord.Interaction, limit: discord.app_commands.Range[int, 1, QUEUE_HARD_LIMIT]):
+        await interaction.response.defer(ephemeral=True)
+        guild_id = interaction.guild_id
+        queue = self._get_queue(guild_id)
+        try:
+            await self.loop.run_in_executor(None, self.metadata_store.put_queue_limit, guild_id, limit)
+        except sqlite3.Error as e:
+            print(f"เกิดข้อผิดพลาดขณะบันทึกการตั้งค่าคิวของ guild {guild_id}: {e}")
+            await interaction.followup.send("ไม่สามารถบันทึกการตั้งค่าได้ โปรดลองใหม่อีกครั้ง", ephemeral=True)
+            return
+        self.queue_limits[guild_id] = limit
+        queue.maxlen = limit # เพลงที่อยู่ในคิวแล้วเกินจำนวนใหม่จะไม่ถูกลบ แค่เพิ่มเพลงใหม่ไม่ได้จนกว่าคิวจะสั้นลง
+        await interaction.followup.send(f"ตั้งจำนวนเพลงสูงสุดในคิวเป็น {limit} เพลงแล้ว (ตอนนี้มี {len(queue)} เพลง)", ephemeral=True)
+
     @discord.app_commands.command(name="clear", description="ล้างคิวเพลงทั้งหมด")
     async def clear(self, interaction: discord.Interaction):
         await interaction.response.defer()
@@ -570,10 +4016,10 @@ class MusicCog(commands.Cog):
     async def pause(self, interaction: discord.Interaction):
         await interaction.response.defer()
         guild_id = interaction.guild_id
-        voice_client = self.voice_clients.get(guild_id)
+        voice_client = self._voice_client(guild_id)
 
         if voice_client and voice_client.is_playing():
-            voice_client.pause()
+            self._get_player(guild_id).pause()
             self._cancel_idle_timer(guild_id) 
             self._start_idle_timer(guild_id, interaction.channel) 
             await interaction.followup.send("หยุดเล่นเพลงชั่วคราว ⏸️")
@@ -584,10 +4030,10 @@ class MusicCog(commands.Cog):
     async def resume(self, interaction: discord.Interaction):
         await interaction.response.defer()
         guild_id = interaction.guild_id
-        voice_client = self.voice_clients.get(guild_id)
+        voice_client = self._voice_client(guild_id)
 
         if voice_client and voice_client.is_paused():
-            voice_client.resume()
+            self._get_player(guild_id).resume()
             self._cancel_idle_timer(guild_id) 
             await interaction.followup.send("เล่นเพลงต่อ ▶️")
         else:
@@ -597,45 +4043,329 @@ class MusicCog(commands.Cog):
     async def nowplaying(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
         guild_id = interaction.guild_id
-        current_song = self.current_songs.get(guild_id)
-        voice_client = self.voice_clients.get(guild_id)
-
-        if current_song and voice_client and (voice_client.is_playing() or voice_client.is_paused()):
-            status = "กำลังเล่น" if voice_client.is_playing() else "หยุดชั่วคราว"
-            embed = discord.Embed(title=f"🎧 เพลงปัจจุบัน ({status})", color=discord.Color.green())
-            embed.add_field(name="ชื่อเพลง", value=f"[{current_song.get('title', 'N/A')}]({current_song.get('webpage_url', '#')})", inline=False)
-            if current_song.get('duration'):
-                embed.add_field(name="ความยาว", value=self._format_duration(current_song['duration']), inline=True)
-            embed.add_field(name="ขอโดย", value=current_song.get('requester', 'N/A'), inline=True)
-            if current_song.get('thumbnail'):
-                embed.set_thumbnail(url=current_song['thumbnail'])
-            await interaction.followup.send(embed=embed, ephemeral=True)
+        player = self._get_player(guild_id)
+        current_song = player.current
+        voice_client = player.voice_client
+
+        if (current_song or player.broadcast) and voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+            await interaction.followup.send(**self._render_now_playing(player), ephemeral=True)
         else:
             await interaction.followup.send("ไม่มีเพลงกำลังเล่นอยู่", ephemeral=True)
 
-# --- Event Listener ของ Bot ---
-@bot.event
-async def on_ready():
-    print(f'{bot.user.name} ออนไลน์แล้ว!')
-    print(f'ID: {bot.user.id}')
-    print(f'เชื่อมต่อกับ {len(bot.guilds)} เซิร์ฟเวอร์')
-    try:
+    broadcast = discord.app_commands.Group(name="broadcast", description="เล่นเพลงเดียวกันในหลายเซิร์ฟเวอร์พร้อมกัน โดยถอดรหัสเสียงครั้งเดียว")
+
+    @broadcast.command(name="start", description="เปิดสถานีจากชื่อเพลง, URL หรือเพลย์ลิสต์ แล้วเริ่มฟังในเซิร์ฟเวอร์นี้")
+    @discord.app_commands.describe(name="ชื่อสถานี (เซิร์ฟเวอร์อื่นใช้ชื่อนี้กับ /broadcast join)",
+                                   query="ชื่อเพลง, URL ของ Youtube, Mix หรือ Playlist")
+    async def broadcast_start(self, interaction: discord.Interaction, name: str, query: str):
+        await interaction.response.defer()
+        key = _station_key(name)
+        if not key:
+            await interaction.followup.send("กรุณาตั้งชื่อสถานี", ephemeral=True)
+            return
+        if key in self.broadcasts:
+            await interaction.followup.send(f"มีสถานีชื่อ '{self.broadcasts[key].name}' อยู่แล้ว ใช้ /broadcast join เพื่อฟัง", ephemeral=True)
+            return
+        if len(self.broadcasts) >= BROADCAST_MAX_STATIONS:
+            await interaction.followup.send(f"เปิดสถานีพร้อมกันได้ไม่เกิน {BROADCAST_MAX_STATIONS} สถานี", ephemeral=True)
+            return
+        if not await self._ensure_voice_client(interaction):
+            return
+
+        guild_id = interaction.guild_id
+        station = BroadcastStation(" ".join(name.split()), guild_id, self.loop)
+        if _is_playlist_url(query):
+            station.loading = True
+        else:
+            try:
+                songs = await self._fetch_song_data(query, interaction.user, guild_id)
+            except ExtractionBusy:
+                await interaction.followup.send("ตอนนี้บอทกำลังดึงข้อมูลเพลงอยู่หลายรายการ โปรดลองใหม่อีกครั้งในอีกสักครู่")
+                return
+            if not songs:
+                await interaction.followup.send(f"ไม่พบผลลัพธ์สำหรับ '{query}' หรือเกิดข้อผิดพลาดในการดึงข้อมูล")
+                return
+            station.add_tracks(songs)
+        if key in self.broadcasts or len(self.broadcasts) >= BROADCAST_MAX_STATIONS: # มีคนเปิดก่อนระหว่างรอข้อมูลเพลง
+            await interaction.followup.send(f"ไม่สามารถเปิดสถานี '{station.name}' ได้ โปรดลองใหม่อีกครั้ง", ephemeral=True)
+            return
+        self.broadcasts[key] = station
+        if station.loading:
+            self.loop.create_task(self._load_broadcast_playlist(station, query, interaction.user))
+        station.start(functools.partial(self._open_broadcast_source, station), self._broadcast_closed)
+
+        player = self._get_player(guild_id)
+        player.text_channel = interaction.channel
+        self._record_session(player)
+        player.post(PLAYER_BROADCAST, station)
+        await interaction.followup.send(f"📻 เปิดสถานี '{station.name}' แล้ว เซิร์ฟเวอร์อื่นฟังได้ด้วย `/broadcast join {station.name}`")
+
+    @broadcast.command(name="join", description="ฟังสถานีที่เปิดอยู่ (คิวของเซิร์ฟเวอร์นี้จะรอไว้จนออกจากสถานี)")
+    @discord.app_commands.describe(name="ชื่อสถานี")
+    async def broadcast_join(self, interaction: discord.Interaction, name: str):
+        await interaction.response.defer()
+        station = self.broadcasts.get(_station_key(name))
+        if station is None or station.closed:
+            await interaction.followup.send(f"ไม่พบสถานี '{name}' (ดูสถานีที่เปิดอยู่ได้ด้วย /broadcast list)", ephemeral=True)
+            return
+        if not await self._ensure_voice_client(interaction):
+            return
+        player = self._get_player(interaction.guild_id)
+        player.text_channel = interaction.channel
+        self._record_session(player)
+        player.post(PLAYER_BROADCAST, station)
+        await interaction.followup.send(f"📻 กำลังฟังสถานี '{station.name}' (ผู้ฟัง {len(station.listeners) + 1} เซิร์ฟเวอร์)")
+
+    @broadcast.command(name="leave", description="ออกจากสถานีแล้วกลับมาเล่นคิวของเซิร์ฟเวอร์นี้")
+    async def broadcast_leave(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        player = self.players.get(interaction.guild_id)
+        if player is None or player.broadcast is None:
+            await interaction.followup.send("เซิร์ฟเวอร์นี้ไม่ได้ฟังสถานีใดอยู่", ephemeral=True)
+            return
+        name = player.broadcast.name
+        player.post(PLAYER_BROADCAST, None)
+        await interaction.followup.send(f"ออกจากสถานี '{name}' แล้ว")
+
+    @broadcast.command(name="stop", description="ปิดสถานีที่เปิดจากเซิร์ฟเวอร์นี้")
+    @discord.app_commands.describe(name="ชื่อสถานี")
+    async def broadcast_stop(self, interaction: discord.Interaction, name: str):
+        await interaction.response.defer()
+        station = self.broadcasts.get(_station_key(name))
+        if station is None:
+            await interaction.followup.send(f"ไม่พบสถานี '{name}'", ephemeral=True)
+            return
+        if station.owner_guild_id != interaction.guild_id:
+            await interaction.followup.send("ปิดสถานีได้เฉพาะจากเซิร์ฟเวอร์ที่เปิดสถานีนั้น", ephemeral=True)
+            return
+        listeners = len(station.listeners)
+        station.close()
+        await interaction.followup.send(f"ปิดสถานี '{station.name}' แล้ว (มีผู้ฟัง {listeners} เซิร์ฟเวอร์)")
+
+    @broadcast.command(name="list", description="แสดงสถานีที่เปิดอยู่")
+    async def broadcast_list(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+        if not self.broadcasts:
+            await interaction.followup.send("ยังไม่มีสถานีที่เปิดอยู่ เปิดได้ด้วย /broadcast start", ephemeral=True)
+            return
+        embed = discord.Embed(title="📻 สถานีที่เปิดอยู่", color=discord.Color.purple())
+        for station in list(self.broadcasts.values())[:25]: # embed มีได้ไม่เกิน 25 field
+            playing = station.current.queue_line() if station.current else "กำลังเตรียมเพลง"
+            embed.add_field(name=station.name, value=f"{playing}\nผู้ฟัง: {len(station.listeners)} เซิร์ฟเวอร์ • "
+                                                     f"รอเล่น: {len(station.tracks)} เพลง", inline=False)
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    @broadcast_join.autocomplete('name')
+    @broadcast_stop.autocomplete('name')
+    async def broadcast_name_autocomplete(self, interaction: discord.Interaction, current: str) -> list[discord.app_commands.Choice[str]]:
+        current = _station_key(current)
+        return [discord.app_commands.Choice(name=station.name, value=station.name)
+                for key, station in self.broadcasts.items() if current in key][:AUTOCOMPLETE_CHOICES]
+
+    @discord.app_commands.command(name="stats", description="แสดงสถิติการทำงานของบอท")
+    async def stats(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+        embed = discord.Embed(title="📊 สถิติการทำงาน", color=discord.Color.dark_grey())
+        embed.add_field(name="แคช stream URL", value=self._format_cache_stats(self.stream_url_cache), inline=True)
+        embed.add_field(name="แคชผลการค้นหา", value=self._format_cache_stats(self.search_cache), inline=True)
+        embed.add_field(name="งานดึงข้อมูล",
+                        value=f"กำลังทำ: {self.extraction.running}/{self.extraction.max_workers}\n"
+                              f"รอคิว: {self.extraction.pending}\n"
+                              f"ปฏิเสธ (ไม่ว่าง): {self.extraction.rejected}", inline=True)
+        embed.add_field(name="วัดความดังของเพลง",
+                        value=f"วัดแล้ว: {self.loudness_analyzer.measured}\n"
+                              f"ไม่สำเร็จ: {self.loudness_analyzer.failed}", inline=True)
+        if self.audio_cache:
+            cache_stats = self.audio_cache.stats()
+            embed.add_field(name="แคชไฟล์เสียง",
+                            value=f"ไฟล์: {cache_stats['files']} ({cache_stats['bytes'] / 1024 ** 2:.0f} MB)\n"
+                                  f"hit/miss: {cache_stats['hits']}/{cache_stats['misses']} ({cache_stats['hit_ratio']:.0%})\n"
+                                  f"เล่นจากดิสก์: {cache_stats['bytes_served'] / 1024 ** 2:.0f} MB\n"
+                                  f"ถูกลบออก: {cache_stats['evictions']}", inline=True)
+        if self.library is not None:
+            library = self.library
+            scanned = (f"{library.scan_seconds:.1f} วินาที (เปลี่ยน {library.scan_changes} ไฟล์)"
+                       if library.scan_seconds is not None else "ยังไม่ได้สแกน")
+            embed.add_field(name="คลังเพลงในเครื่อง",
+                            value=f"เพลง: {len(library)}\n"
+                                  f"ค้นเจอ: {library.hits}/{library.searches}\n"
+                                  f"สแกนล่าสุด: {scanned}", inline=True)
+        embed.add_field(name="การดึงซ้ำที่รวมเป็นครั้งเดียว",
+                        value=f"ข้อมูลเพลง: {self.song_list_flights.coalesced}\n"
+                              f"stream URL: {self.stream_url_flights.coalesced}", inline=True)
+        if self.journal:
+            embed.add_field(name="journal ของคิว",
+                            value=f"บันทึกแล้ว: {self.journal.written}\n"
+                                  f"รวมเป็น snapshot: {self.journal.compactions} ครั้ง", inline=True)
+        now_playing = self.now_playing_stats
+        embed.add_field(name="ข้อความเพลงที่กำลังเล่น",
+                        value=f"การเปลี่ยนแปลง: {now_playing['updates']}\n"
+                              f"เรียก API: {now_playing['writes']}\n"
+                              f"ประหยัดได้: {now_playing['coalesced'] + now_playing['unchanged']}", inline=True)
+        if self.autocomplete is not None:
+            embed.add_field(name="autocomplete ของ /play",
+                            value=f"เพลงใน index: {len(self.autocomplete)}/{self.autocomplete.max_titles}\n"
+                                  f"ค้นหาแล้ว: {self.autocomplete.lookups}\n"
+                                  f"ถูกลบออก: {self.autocomplete.evictions}", inline=True)
+        governor = self.governor
+        embed.add_field(name="FFMPEG ที่เล่นเพลง",
+                        value=f"กำลังทำงาน: {governor.running}/{governor.max_processes or '∞'}\n"
+                              f"รอเริ่ม: {governor.waiting} (เคยรอ {governor.queued_starts})\n"
+                              f"load ต่อ core: {governor.load:.2f}\n"
+                              f"ลดคุณภาพ: {governor.degraded_starts}", inline=True)
+        player = self.players.get(interaction.guild_id)
+        if player and player.transitions:
+            embed.add_field(name="การเปลี่ยนเพลง (เซิร์ฟเวอร์นี้)",
+                            value=f"จำนวน: {player.transitions}\n"
+                                  f"เฉลี่ย: {player.transition_total / player.transitions * 1000:.0f} ms\n"
+                                  f"สูงสุด: {player.transition_max * 1000:.0f} ms", inline=True)
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    def _format_cache_stats(self, cache: TTLCache) -> str:
+        """แปลงสถิติของแคชเป็นข้อความสำหรับ embed"""
+        stats = cache.stats()
+        return (f"รายการ: {stats['entries']}\n"
+                f"hit/miss: {stats['hits']}/{stats['misses']} ({stats['hit_ratio']:.0%})\n"
+                f"ถูกลบออก: {stats['evictions']}")
+
+# --- สร้างและรันบอท ---
+def _command_tree_hash(bot: commands.Bot) -> str:
+    """sha256 ของ global slash commands ในรูปแบบที่ส่งให้ Discord ตอน sync (รวม application id เผื่อเปลี่ยน token)"""
+    payload = sorted((command.to_dict() for command in bot.tree.get_commands()),
+                     key=lambda command: (command.get('type', 1), command['name']))
+    data = json.dumps({'application_id': bot.application_id, 'commands': payload}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+async def sync_commands(bot: commands.Bot) -> bool:
+    """sync slash commands เมื่อ command tree ต่างจากตอน sync สำเร็จครั้งก่อน คืน True ถ้า sync จริง"""
+    digest = _command_tree_hash(bot)
+    if COMMAND_SYNC_HASH_PATH:
+        try:
+            with open(COMMAND_SYNC_HASH_PATH, encoding='utf-8') as f:
+                if f.read().strip() == digest:
+                    print("slash commands ไม่เปลี่ยนจากครั้งก่อน ข้ามการ sync")
+                    return False
+        except OSError:
+            pass # ยังไม่เคย sync หรืออ่านไฟล์ไม่ได้
+    synced = await bot.tree.sync()
+    print(f"ซิงค์ {len(synced)} คำสั่งเรียบร้อยแล้ว")
+    if COMMAND_SYNC_HASH_PATH:
+        try:
+            part_path = COMMAND_SYNC_HASH_PATH + '.part'
+            with open(part_path, 'w', encoding='utf-8') as f:
+                f.write(digest)
+            os.replace(part_path, COMMAND_SYNC_HASH_PATH)
+        except OSError as e:
+            print(f"ไม่สามารถบันทึก hash ของ slash commands: {e}")
+    return True
+
+def create_bot(shard_ids: list[int] | None = None, shard_count: int | None = None) -> commands.Bot:
+    """สร้างบอท (AutoShardedBot เมื่อกำหนด shard ให้ ใช้ใน worker process)"""
+    if shard_count:
+        bot = commands.AutoShardedBot(command_prefix=commands.when_mentioned_or("!"), intents=intents,
+                                      shard_ids=shard_ids, shard_count=shard_count)
+    else:
+        bot = commands.Bot(command_prefix=commands.when_mentioned_or("!"), intents=intents) # prefix แทบไม่ได้ใช้เมื่อมี slash commands
+    started = time.perf_counter()
+
+    # setup_hook ถูกเรียกครั้งเดียวหลัง login ก่อนต่อ gateway ส่วน on_ready ถูกเรียกซ้ำทุกครั้งที่ต่อ gateway ใหม่
+    async def setup_hook():
         await bot.add_cog(MusicCog(bot))
-        synced = await bot.tree.sync()
-        print(f"ซิงค์ {len(synced)} คำสั่งเรียบร้อยแล้ว")
+        if shard_ids is None or 0 in shard_ids: # คำสั่งเป็นแบบ global ให้ worker เดียว (worker 0) sync
+            try:
+                await sync_commands(bot)
+            except discord.HTTPException as e:
+                print(f"เกิดข้อผิดพลาดระหว่างการ sync commands: {e}")
 
+    bot.setup_hook = setup_hook
+
+    # --- Event Listener ของ Bot ---
+    @bot.event
+    async def on_ready():
+        print(f'{bot.user.name} ออนไลน์แล้ว!' + (f' (shard {shard_ids})' if shard_ids else '') +
+              f' (เริ่มบอทมาแล้ว {time.perf_counter() - started:.1f} วินาที)')
+        print(f'ID: {bot.user.id}')
+        print(f'เชื่อมต่อกับ {len(bot.guilds)} เซิร์ฟเวอร์')
+
+    return bot
+
+def run_bot(bot: commands.Bot) -> int:
+    """รันบอทจนกว่าจะปิด คืนค่า exit code (WORKER_EXIT_FATAL ถ้า token ไม่ถูกต้อง)"""
+    try:
+        bot.run(BOT_TOKEN)
+    except discord.LoginFailure:
+        print("Login ไม่สำเร็จ: Token ไม่ถูกต้องหรือมีปัญหาในการเชื่อมต่อ")
+        return WORKER_EXIT_FATAL
     except Exception as e:
-        print(f"เกิดข้อผิดพลาดระหว่างการ sync commands: {e}")
+        print(f"เกิดข้อผิดพลาดขณะรันบอท: {e}")
+        return 1
+    return 0
+
+def _run_shard_worker(shard_ids: list[int], shard_count: int):
+    """จุดเริ่มของ worker process"""
+    raise SystemExit(run_bot(create_bot(shard_ids, shard_count)))
+
+def run_supervisor(workers: int, shard_count: int):
+    """
+    เปิด worker process ละหนึ่งชุด shard (แบ่งแบบ round-robin) และเปิดใหม่เมื่อ worker ล่ม
+    โดยรอนานขึ้นเป็นเท่าตัวถ้าล่มซ้ำเร็ว ๆ (สูงสุด SHARD_RESTART_BACKOFF_MAX วินาที)
+    """
+    if shard_count < workers: # worker ที่เกินจะได้ shard ว่าง และ create_bot([]) จะทำงานเหมือนไม่แบ่ง shard
+        print(f"SHARD_COUNT ({shard_count}) น้อยกว่า SHARD_WORKERS ({workers}) จะเปิด worker แค่ {shard_count} ตัว")
+        workers = shard_count
+    context = multiprocessing.get_context("spawn") # ไม่ fork event loop/thread ของ process หลัก
+    shard_slices = [list(range(index, shard_count, workers)) for index in range(workers)]
+    processes = {}   # {หมายเลข worker: Process}
+    started_at = {}  # {หมายเลข worker: เวลาที่เริ่ม}
+    backoff = {index: 1.0 for index in range(workers)}
+
+    def start(index: int):
+        process = context.Process(target=_run_shard_worker, args=(shard_slices[index], shard_count),
+                                  name=f"soulyu-shard-worker-{index}")
+        process.start()
+        processes[index] = process
+        started_at[index] = time.monotonic()
+        print(f"เริ่ม worker {index} (pid {process.pid}) สำหรับ shard {shard_slices[index]} จากทั้งหมด {shard_count}")
+
+    # systemd/docker หยุดบอทด้วย SIGTERM ให้ออกผ่าน finally เพื่อปิด worker ด้วย
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    for index in range(workers):
+        start(index)
+    restart_at = {} # {หมายเลข worker: เวลาที่จะเปิดใหม่}
+    try:
+        while processes or restart_at:
+            timeout = max(0.0, min(restart_at.values()) - time.monotonic()) if restart_at else None
+            ready = multiprocessing.connection.wait([process.sentinel for process in processes.values()], timeout)
+            for index, process in list(processes.items()):
+                if process.sentinel not in ready:
+                    continue
+                process.join()
+                del processes[index]
+                if process.exitcode == WORKER_EXIT_FATAL:
+                    print(f"worker {index} หยุดทำงานเพราะข้อผิดพลาดที่แก้ไม่ได้ กำลังปิด worker ทั้งหมด")
+                    raise SystemExit(WORKER_EXIT_FATAL)
+                if time.monotonic() - started_at[index] > SHARD_WORKER_STABLE_SECONDS:
+                    backoff[index] = 1.0
+                print(f"worker {index} หยุดทำงาน (exit code {process.exitcode}) จะเปิดใหม่ในอีก {backoff[index]:.0f} วินาที")
+                restart_at[index] = time.monotonic() + backoff[index]
+                backoff[index] = min(backoff[index] * 2, SHARD_RESTART_BACKOFF_MAX)
+            for index, when in list(restart_at.items()):
+                if when <= time.monotonic():
+                    del restart_at[index]
+                    start(index)
+    except KeyboardInterrupt:
+        print("กำลังปิด worker ทั้งหมด...")
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join(10)
 
 # --- การรันบอท ---
 if __name__ == "__main__":
     if not BOT_TOKEN:
         print("กรุณาตั้งค่า BOT_TOKEN ก่อนรันบอท")
+    elif SHARD_WORKERS > 1:
+        run_supervisor(SHARD_WORKERS, SHARD_COUNT)
     else:
-        try:
-            bot.run(BOT_TOKEN)
-        except discord.LoginFailure:
-            print("Login ไม่สำเร็จ: Token ไม่ถูกต้องหรือมีปัญหาในการเชื่อมต่อ")
-        except Exception as e:
-            print(f"เกิดข้อผิดพลาดขณะรันบอท: {e}")
-
+        run_bot(create_bot())